@@ -0,0 +1,219 @@
+import logging
+import math
+import threading
+from datetime import datetime, time, timezone
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone as django_timezone
+
+from app import analytics, availability, ical, models, pubsub
+from app.mutations import check_booking_limits, check_booking_times
+
+logger = logging.getLogger(__name__)
+
+
+# Booking request queue ================================================================================================
+# When a court's booking window moves on at midnight, everyone wants the new day's evening slots at once. Rather than
+# racing each other through createBooking, where every loser still queues for the day lock only to fail the clash
+# check, clients can make a requestBooking, which just validates the request and inserts a BookingRequest row, then
+# poll bookingRequest or subscribe to bookingRequestDecided for the outcome. The allocator takes the pending requests
+# a batch at a time and books the first free choice of each, with one transaction, one read of the existing bookings
+# and one bulk insert per batch, as create_bookings does.
+#
+# ORDER (BOOKING_QUEUE in config/settings.py) is ARRIVAL for first come, first served, or LOTTERY, where requests are
+# decided in rounds of LOTTERY_WINDOW seconds on the clock (so one starts at midnight) and the requests of a round are
+# taken in a random order once it is over, so being a few milliseconds quicker off the mark doesn't win the slot.
+#
+# The allocator runs in a thread of the server process (ALLOCATOR "thread"), woken by each request, or on its own
+# with the allocate_bookings command. A batch reads back which of its requests are still pending only once it holds
+# the day locks of all their choices, so two allocators can't book one request twice, but only a single allocator
+# keeps to the order.
+
+ARRIVAL = "ARRIVAL"
+LOTTERY = "LOTTERY"
+
+THREAD = "thread"
+COMMAND = "command"
+
+DEFAULT_SETTINGS = {
+    "ALLOCATOR": THREAD,
+    "ORDER": ARRIVAL,
+    "LOTTERY_WINDOW": 10,
+    "BATCH_SIZE": 200,
+    "POLL_INTERVAL": 0.5,
+}
+
+
+def get_settings():
+    return {**DEFAULT_SETTINGS, **getattr(settings, "BOOKING_QUEUE", {})}
+
+
+def choices(request):
+    # (court_id, start_time, end_time) for each of a request's choices, in order of preference
+    yield request.court_id, request.start_time, request.end_time
+    for court_id, start_time, end_time in request.preferences:
+        yield int(court_id), time.fromisoformat(start_time), time.fromisoformat(end_time)
+
+
+def _round_end(created_at, window):
+    # End of the lottery round created_at falls in
+    return datetime.fromtimestamp((math.floor(created_at.timestamp() / window) + 1) * window, tz=timezone.utc)
+
+
+def next_batch(options=None):
+    """
+    The next pending requests to decide, in order, or an empty list if there are none or the current lottery round
+    isn't over yet.
+    """
+    options = options or get_settings()
+    pending = models.BookingRequest.objects.filter(status=models.BookingRequest.PENDING)
+    window = options["LOTTERY_WINDOW"]
+    if options["ORDER"] == LOTTERY and window > 0:
+        first = pending.order_by('created_at', 'id').values_list('created_at', flat=True).first()
+        if first is None or django_timezone.now() < _round_end(first, window):
+            return []
+        pending = pending.filter(created_at__lt=_round_end(first, window)).order_by('lottery_key', 'id')
+    else:
+        pending = pending.order_by('created_at', 'id')
+    return list(pending[:options["BATCH_SIZE"]])
+
+
+def allocate(requests):
+    """
+    Books the first free choice of each request, in the order given, and rejects those with none. Returns the number
+    of (accepted, rejected) requests.
+    """
+    if not requests:
+        return 0, 0
+    courts = models.Court.objects.in_bulk({court_id for request in requests for court_id, _, _ in choices(request)})
+    days = {}
+    for request in requests:
+        for court_id, _, _ in choices(request):
+            if court_id in courts:
+                days.setdefault(court_id, set()).add(request.date)
+
+    with transaction.atomic():
+        for court_id in sorted(days):
+            models.CourtDayLock.acquire_many(court_id, days[court_id])
+        # Anything another allocator decided while this one waited for the locks is left alone
+        pending = set(models.BookingRequest.objects.filter(
+            pk__in=[request.pk for request in requests], status=models.BookingRequest.PENDING,
+        ).values_list('pk', flat=True))
+        requests = [request for request in requests if request.pk in pending]
+
+        booked = {}
+        for court_id, date, start_time, end_time in models.Booking.objects.filter(
+                site_id__in={courts[court_id].site_id for court_id in days}, court_id__in=list(days),
+                date__in={date for dates in days.values() for date in dates},
+        ).order_by().values_list('court_id', 'date', 'start_time', 'end_time'):
+            booked.setdefault((court_id, date), []).append((start_time, end_time))
+
+        decided_at = django_timezone.now()
+        accepted = []
+        for request in requests:
+            reasons = []
+            for court_id, start_time, end_time in choices(request):
+                court = courts.get(court_id)
+                try:
+                    if court is None:
+                        raise ValueError("Invalid Court ID")
+                    # The request may have waited past the start of its day, or out of the limits
+                    check_booking_times(court, request.date, start_time, end_time)
+                    if not request.bypass_limits:
+                        check_booking_limits(court, request.date, start_time, end_time)
+                except ValueError as e:
+                    reasons.append(str(e))
+                    continue
+                day = booked.setdefault((court_id, request.date), [])
+                if any(start_time < end and end_time > start for start, end in day):
+                    reasons.append(f"{court.name} {start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')} "
+                                   f"is already booked")
+                    continue
+                day.append((start_time, end_time))
+                request.booking = models.Booking(
+                    date=request.date, start_time=start_time, end_time=end_time, user_id=request.user_id, court=court,
+                    site_id=court.site_id, description=request.description)
+                accepted.append(request.booking)
+                request.status = models.BookingRequest.ACCEPTED
+                break
+            else:
+                request.status = models.BookingRequest.REJECTED
+                request.reason = "; ".join(reasons)
+            request.decided_at = decided_at
+
+        bookings = models.Booking.objects.bulk_create(accepted)
+        for court_id in {booking.court_id for booking in bookings}:
+            availability.mark_booked_many(courts[court_id], [b for b in bookings if b.court_id == court_id])
+        analytics.add_bookings(bookings)
+        models.BookingRequest.objects.bulk_update(requests, ['status', 'reason', 'booking', 'decided_at'])
+        pubsub.bookings_created([booking.pk for booking in bookings])
+        pubsub.requests_decided([request.pk for request in requests])
+        ical.bookings_changed([b.user_id for b in bookings], [b.court_id for b in bookings])
+    return len(bookings), len(requests) - len(bookings)
+
+
+def drain(options=None):
+    # Decides batches until no more are ready. Returns the number of (accepted, rejected) requests
+    options = options or get_settings()
+    accepted = rejected = 0
+    while True:
+        batch = next_batch(options)
+        if not batch:
+            return accepted, rejected
+        batch_accepted, batch_rejected = allocate(batch)
+        accepted += batch_accepted
+        rejected += batch_rejected
+
+
+# In-process allocator =================================================================================================
+
+class AllocatorThread(object):
+    """
+    Drains the queue in a daemon thread whenever wake() is called, and every POLL_INTERVAL seconds while requests are
+    pending (for lottery rounds to end, and for requests queued by other processes).
+    """
+
+    def __init__(self):
+        self.wanted = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def wake(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="booking-allocator", daemon=True)
+                self.thread.start()
+        self.wanted.set()
+
+    def run(self):
+        pending = True
+        while True:
+            self.wanted.wait(get_settings()["POLL_INTERVAL"] if pending else None)
+            self.wanted.clear()
+            close_old_connections()
+            try:
+                drain()
+                pending = models.BookingRequest.objects.filter(status=models.BookingRequest.PENDING).exists()
+            except Exception:
+                # The batch stays pending and is retried after POLL_INTERVAL
+                logger.exception("Booking allocation failed")
+                pending = True
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def get_allocator():
+    global _allocator
+    with _allocator_lock:
+        if _allocator is None:
+            _allocator = AllocatorThread()
+    return _allocator
+
+
+def request_queued():
+    # Called once a request is committed, to wake the in-process allocator unless a separate one is running
+    if get_settings()["ALLOCATOR"] == THREAD:
+        get_allocator().wake()
@@ -0,0 +1,219 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from app import cache, models
+
+
+# Court usage rollups ==================================================================================================
+# DailyCourtUsage holds the booked minutes per court, day and hour. New bookings are added to it as they are created
+# (from the Booking signals in app/signals.py, and by create_bookings for bulk inserts), and a day is recounted from
+# its bookings whenever one is edited or deleted. Archived bookings stay counted, so reports cover the whole history
+# while reading at most one row per court and opening hour of each day. The rebuild_usage command recounts a range
+# from scratch.
+
+HOUR = "HOUR"
+DAY = "DAY"
+WEEK = "WEEK"
+MONTH = "MONTH"
+
+# Most periods (per court) one report may return
+MAX_PERIODS = 400
+# Longest window one report may cover, checked before the window is split into periods
+MAX_DAYS = 5 * 366
+
+BATCH_SIZE = 5000
+
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def hour_minutes(start_time, end_time):
+    # {hour: minutes of that hour between start_time and end_time}
+    start, end = _minutes(start_time), _minutes(end_time)
+    return {hour: min(end, hour * 60 + 60) - max(start, hour * 60) for hour in range(start // 60, -(-end // 60))}
+
+
+def _count(totals, court_id, date, start_time, end_time):
+    # Adds one booking to {(court_id, date, hour): [minutes, bookings]}
+    for hour, minutes in hour_minutes(start_time, end_time).items():
+        totals.setdefault((court_id, date, hour), [0, 0])[0] += minutes
+    totals.setdefault((court_id, date, start_time.hour), [0, 0])[1] += 1
+
+
+def _lock_days(days):
+    for court_id in {court_id for court_id, date in days}:
+        models.CourtDayLock.acquire_many(court_id, {date for day_court_id, date in days if day_court_id == court_id})
+
+
+def add_bookings(bookings):
+    """
+    Adds new bookings to the rollups, in one read and a bulk insert and update however many there are.
+    """
+    totals = {}
+    for booking in bookings:
+        _count(totals, booking.court_id, booking.date, booking.start_time, booking.end_time)
+    if not totals:
+        return
+    days = {(court_id, date) for court_id, date, hour in totals}
+
+    with transaction.atomic():
+        _lock_days(days)
+        rows = {
+            (row.court_id, row.date, row.hour): row
+            for row in models.DailyCourtUsage.objects.filter(
+                court_id__in={court_id for court_id, date in days}, date__in={date for court_id, date in days})
+        }
+        created, updated = [], []
+        for (court_id, date, hour), (minutes, count) in totals.items():
+            row = rows.get((court_id, date, hour))
+            if row is None:
+                created.append(models.DailyCourtUsage(
+                    court_id=court_id, date=date, hour=hour, booked_minutes=minutes, bookings=count))
+            else:
+                row.booked_minutes += minutes
+                row.bookings += count
+                updated.append(row)
+        models.DailyCourtUsage.objects.bulk_create(created)
+        models.DailyCourtUsage.objects.bulk_update(updated, ['booked_minutes', 'bookings'])
+
+
+def _recount(court_ids, from_date, to_date):
+    # [DailyCourtUsage] for the given courts and days, from Booking and BookingArchive
+    totals = {}
+    # The courts' sites, for the booking indexes, as recounts also run outside requests (rebuild_usage)
+    site_ids = models.Court._base_manager.filter(pk__in=court_ids).values('site_id')
+    for model in (models.Booking, models.BookingArchive):
+        for court_id, date, start_time, end_time in model.objects.filter(
+                site_id__in=site_ids, court_id__in=court_ids, date__gte=from_date, date__lte=to_date,
+        ).order_by().values_list('court_id', 'date', 'start_time', 'end_time').iterator(chunk_size=BATCH_SIZE):
+            _count(totals, court_id, date, start_time, end_time)
+    return [
+        models.DailyCourtUsage(court_id=court_id, date=date, hour=hour, booked_minutes=minutes, bookings=count)
+        for (court_id, date, hour), (minutes, count) in totals.items()
+    ]
+
+
+def refresh(court_id, date):
+    # Recounts one day, for edited and deleted bookings
+    with transaction.atomic():
+        models.CourtDayLock.acquire(court_id, date)
+        models.DailyCourtUsage.objects.filter(court_id=court_id, date=date).delete()
+        models.DailyCourtUsage.objects.bulk_create(_recount([court_id], date, date))
+
+
+def rebuild(court, from_date, to_date):
+    # Recounts every day of a court between from_date and to_date. Returns the number of rows written
+    with transaction.atomic():
+        models.DailyCourtUsage.objects.filter(court=court, date__gte=from_date, date__lte=to_date).delete()
+        rows = models.DailyCourtUsage.objects.bulk_create(_recount([court.id], from_date, to_date),
+                                                          batch_size=BATCH_SIZE)
+    return len(rows)
+
+
+# Reports ==============================================================================================================
+
+class CourtUsage(object):
+    def __init__(self, court, period, hour, booked_minutes, open_minutes, bookings):
+        self.court = court
+        self.court_id = court.id
+        self.period = period
+        self.hour = hour
+        self.booked_minutes = booked_minutes
+        self.open_minutes = open_minutes
+        self.utilisation = booked_minutes / open_minutes if open_minutes else None
+        self.bookings = bookings
+
+
+class Booker(object):
+    def __init__(self, user_id, booked_minutes, bookings):
+        self.user_id = user_id
+        self.booked_minutes = booked_minutes
+        self.bookings = bookings
+
+
+def _period_start(date, granularity):
+    if granularity == WEEK:
+        return date - timedelta(days=date.weekday())
+    if granularity == MONTH:
+        return date.replace(day=1)
+    return date
+
+
+def _periods(from_date, to_date, granularity):
+    # {first day of each period: days of it inside the window}
+    periods = {}
+    date = from_date
+    while date <= to_date:
+        start = _period_start(date, granularity)
+        periods[start] = periods.get(start, 0) + 1
+        date += timedelta(days=1)
+    return periods
+
+
+def _courts(court_id):
+    return [court for court in cache.get_courts() if court_id is None or str(court.id) == str(court_id)]
+
+
+def utilisation(from_date, to_date, granularity=DAY, court_id=None):
+    """
+    Booked and open minutes per court and period (day, week or month) between from_date and to_date, or per court and
+    hour of the day across the whole window for HOUR. Every period is listed, including those with no bookings.
+    """
+    if from_date > to_date:
+        raise ValueError("Start of the date window must not be after the end")
+    if to_date - from_date >= timedelta(days=MAX_DAYS):
+        raise ValueError(f"Date window is too long (max {MAX_DAYS} days)")
+    courts = _courts(court_id)
+    periods = _periods(from_date, to_date, DAY if granularity == HOUR else granularity)
+    if granularity != HOUR and len(periods) > MAX_PERIODS:
+        raise ValueError(f"Too many periods (max {MAX_PERIODS}), use a coarser granularity or a shorter window")
+
+    usage = models.DailyCourtUsage.objects.filter(
+        court__in=courts, date__gte=from_date, date__lte=to_date).order_by()
+    # Summed per day (or hour) in the database. Days are folded into weeks and months here rather than with
+    # TruncWeek/TruncMonth, which SQLite runs as a Python function on every row
+    usage = usage.values_list('court_id', 'hour' if granularity == HOUR else 'date').annotate(
+        total_minutes=Sum('booked_minutes'), total_bookings=Sum('bookings'))
+    totals = {}
+    for court_id, key, minutes, count in usage:
+        if granularity != HOUR:
+            key = _period_start(key, granularity)
+        total = totals.setdefault((court_id, key), [0, 0])
+        total[0] += minutes
+        total[1] += count
+
+    report = []
+    for court in courts:
+        opening, closing = _minutes(court.opening_time), _minutes(court.closing_time)
+        if granularity == HOUR:
+            days = len(periods)
+            for hour in range(opening // 60, -(-closing // 60)):
+                open_minutes = (min(closing, hour * 60 + 60) - max(opening, hour * 60)) * days
+                booked_minutes, bookings = totals.get((court.id, hour), (0, 0))
+                report.append(CourtUsage(court, None, hour, booked_minutes, open_minutes, bookings))
+            continue
+        for period, days in periods.items():
+            booked_minutes, bookings = totals.get((court.id, period), (0, 0))
+            report.append(CourtUsage(court, period, None, booked_minutes, (closing - opening) * days, bookings))
+    return report
+
+
+def top_bookers(from_date, to_date, first=10, court_id=None):
+    # The users with the most booked time between from_date and to_date, archived bookings included
+    if from_date > to_date:
+        raise ValueError("Start of the date window must not be after the end")
+    totals = {}
+    for model in (models.Booking, models.BookingArchive):
+        bookings = model.objects.filter(date__gte=from_date, date__lte=to_date)
+        if court_id is not None:
+            bookings = bookings.filter(court_id=court_id)
+        for row in bookings.order_by().values('user_id').annotate(
+                duration=Sum(F('end_time') - F('start_time')), count=Count('id')):
+            total = totals.setdefault(row['user_id'], [timedelta(), 0])
+            total[0] += row['duration']
+            total[1] += row['count']
+    ranked = sorted(totals.items(), key=lambda item: (-item[1][0], item[0]))[:first]
+    return [Booker(user_id, int(duration.total_seconds() // 60), count) for user_id, (duration, count) in ranked]
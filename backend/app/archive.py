@@ -0,0 +1,50 @@
+from datetime import date
+
+from django.db import transaction
+
+from app import ical, models
+
+
+# Booking archival =====================================================================================================
+# Bookings before a cutoff day move from Booking to BookingArchive a batch at a time, each batch copied and deleted in
+# one transaction, so an interrupted run leaves every booking in exactly one of the tables and can simply be rerun.
+# Nothing can be booked in the past, so the archived days' availability bitmaps and day locks go too.
+
+FIELDS = ('id', 'start_time', 'end_time', 'date', 'created_at', 'description', 'user_id', 'court_id', 'site_id')
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def archive_before(cutoff, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Archives every booking before cutoff, yielding the number moved after each batch.
+    """
+    if cutoff > date.today():
+        raise ValueError("Only past bookings can be archived")
+    # A site at a time, which reads each batch in order from the (site, date) index
+    for site_id in models.Site.objects.order_by('id').values_list('id', flat=True):
+        yield from _archive_site(site_id, cutoff, batch_size)
+
+    models.CourtAvailability.objects.filter(date__lt=cutoff).delete()
+    models.CourtDayLock.objects.filter(date__lt=cutoff).delete()
+
+
+def _archive_site(site_id, cutoff, batch_size):
+    while True:
+        with transaction.atomic():
+            rows = list(models.Booking.objects.filter(site_id=site_id, date__lt=cutoff).order_by('date').values(
+                *FIELDS)[:batch_size])
+            if not rows:
+                break
+            ids = [row['id'] for row in rows]
+            models.BookingArchive.objects.bulk_create([
+                models.BookingArchive(booking_id=row.pop('id'), **row) for row in rows
+            ])
+            # A plain DELETE: the Booking signals would rebuild availability and publish a change for every row, for
+            # days that are over
+            moved = models.Booking.objects.filter(pk__in=ids)
+            # Which also skips the SET_NULL on the requests that made them
+            models.BookingRequest.objects.filter(booking__in=moved).update(booking=None)
+            moved._raw_delete(moved.db)
+            ical.bookings_changed([row['user_id'] for row in rows], [row['court_id'] for row in rows])
+        yield len(rows)
@@ -0,0 +1,161 @@
+from datetime import timedelta
+
+from django.db import transaction
+
+from app import models
+
+
+# Per-court, per-day availability bitmaps ==============================================================================
+# A court's day is split into slots of min_booking_length_minutes starting at its opening time. Bit i of a day's
+# bitmap is set when some booking overlaps slot i, so a zero bitmap over a requested range means it is definitely free.
+# Stale rows (the court's hours or slot length changed) are recomputed on read and rewritten on the next update.
+# When bookings don't line up with the slots (e.g. captains booking odd lengths), a set bit only means the slot is
+# partly taken, which is why CreateBooking still asks the database for the conflicting row once a bit is set.
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def slot_minutes(court):
+    return court.min_booking_length_minutes or 60
+
+
+def slot_count(court):
+    size = slot_minutes(court)
+    return -(-(_minutes(court.closing_time) - _minutes(court.opening_time)) // size)
+
+
+def mask(court, start_time, end_time):
+    # The bits for every slot that [start_time, end_time) overlaps
+    size = slot_minutes(court)
+    opening = _minutes(court.opening_time)
+    first = max((_minutes(start_time) - opening) // size, 0)
+    last = min(-(-(_minutes(end_time) - opening) // size), slot_count(court))
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def compute_bits(court, date):
+    # Rebuilds a day's bitmap from its Booking rows. The site is given for the booking indexes, as this also runs
+    # outside requests (the allocator, check_availability)
+    bits = 0
+    for start_time, end_time in models.Booking.objects.filter(
+            site_id=court.site_id, court=court, date=date).order_by().values_list('start_time', 'end_time'):
+        bits |= mask(court, start_time, end_time)
+    return bits
+
+
+def _is_current(row, court):
+    return row.opening_time == court.opening_time and row.slot_minutes == slot_minutes(court)
+
+
+def get_bits(court, date):
+    row = models.CourtAvailability.objects.filter(court=court, date=date).first()
+    if row is None:
+        return 0
+    if not _is_current(row, court):
+        return compute_bits(court, date)
+    return row.bits
+
+
+def get_range(court, from_date, to_date):
+    # Bitmaps for every day in [from_date, to_date], as a {date: bits} dict, in one query unless some rows are stale
+    rows = {row.date: row for row in models.CourtAvailability.objects.filter(
+        court=court, date__gte=from_date, date__lte=to_date)}
+    days = {}
+    date = from_date
+    while date <= to_date:
+        row = rows.get(date)
+        if row is None:
+            days[date] = 0
+        elif _is_current(row, court):
+            days[date] = row.bits
+        else:
+            days[date] = compute_bits(court, date)
+        date += timedelta(days=1)
+    return days
+
+
+def is_free(court, date, start_time, end_time):
+    return not get_bits(court, date) & mask(court, start_time, end_time)
+
+
+# Incremental maintenance, driven by the Booking signals in app/signals.py. Each update holds the court's day lock so
+# it can't interleave with a concurrent CreateBooking for the same day.
+
+def mark_booked(court, date, start_time, end_time):
+    with transaction.atomic():
+        models.CourtDayLock.acquire(court.id, date)
+        row = models.CourtAvailability.objects.filter(court=court, date=date).first()
+        if row is None or not _is_current(row, court):
+            bits = compute_bits(court, date)
+        else:
+            bits = row.bits | mask(court, start_time, end_time)
+        _store(court, date, row, bits)
+
+
+def mark_booked_many(court, bookings):
+    # For bulk inserts, which send no signals. The caller must already hold the day locks for every day touched
+    days = {}
+    for booking in bookings:
+        days[booking.date] = days.get(booking.date, 0) | mask(court, booking.start_time, booking.end_time)
+
+    rows = {row.date: row for row in models.CourtAvailability.objects.filter(court=court, date__in=days)}
+    created, updated = [], []
+    for date, bits in days.items():
+        row = rows.get(date)
+        if row is None:
+            row = models.CourtAvailability(court=court, date=date)
+            created.append(row)
+        else:
+            updated.append(row)
+            bits = row.bits | bits if _is_current(row, court) else compute_bits(court, date)
+        row.opening_time = court.opening_time
+        row.slot_minutes = slot_minutes(court)
+        row.bits = bits
+    models.CourtAvailability.objects.bulk_create(created)
+    models.CourtAvailability.objects.bulk_update(updated, ['opening_time', 'slot_minutes', 'bitmap'])
+
+
+def refresh(court, date):
+    # Clearing a booking's bits could clear a slot another booking still partly covers, so removals rebuild the day
+    with transaction.atomic():
+        models.CourtDayLock.acquire(court.id, date)
+        row = models.CourtAvailability.objects.filter(court=court, date=date).first()
+        bits = compute_bits(court, date)
+        _store(court, date, row, bits)
+    return bits
+
+
+def _store(court, date, row, bits):
+    if row is None:
+        row = models.CourtAvailability(court=court, date=date)
+    row.opening_time = court.opening_time
+    row.slot_minutes = slot_minutes(court)
+    row.bits = bits
+    row.save()
+
+
+def check(courts, from_date, to_date, fix=False):
+    """
+    Rebuilds the bitmap for every stored day of the given courts between from_date and to_date, and for every day
+    that has bookings, from the Booking rows. Returns a list of (court, date, stored bits, actual bits) for the days
+    that differ, and rewrites them if fix is set.
+    """
+    diffs = []
+    for court in courts:
+        stored = {row.date: row for row in models.CourtAvailability.objects.filter(
+            court=court, date__gte=from_date, date__lte=to_date)}
+        booked_days = models.Booking.objects.filter(
+            site_id=court.site_id, court=court, date__gte=from_date, date__lte=to_date,
+        ).order_by().values_list('date', flat=True).distinct()
+        for date in sorted(set(stored) | set(booked_days)):
+            row = stored.get(date)
+            actual = compute_bits(court, date)
+            stored_bits = row.bits if row is not None and _is_current(row, court) else None
+            if stored_bits != actual and not (row is None and actual == 0):
+                diffs.append((court, date, stored_bits, actual))
+                if fix:
+                    refresh(court, date)
+    return diffs
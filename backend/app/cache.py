@@ -0,0 +1,82 @@
+from django.core.cache import cache
+
+from app import models
+
+
+# Read-mostly data served from Django's cache framework. Site and Court only change when an admin edits them, so the
+# entries live until the signal handlers in app/signals.py delete them (or the cache's TIMEOUT expires them). Each
+# site's courts are cached under its own key, so one site's edits never empty another's entry.
+
+# {host name or ID: site} for every site (see app/sites.py). There is one site per college, so they all fit in one
+# entry, and a name that isn't any site's is answered from it too: made-up X-Site headers cost neither a query nor a
+# cache entry of their own
+SITES_KEY = 'graphql:sites'
+# The first site, for requests to any other host
+DEFAULT_SITE_KEY = 'graphql:site'
+# Keyed by site ID, or "all" outside a request
+COURTS_KEY = 'graphql:courts:{}'
+# Tells a missing entry apart from a cached None (no Site yet)
+_MISSING = object()
+
+
+def _courts_key():
+    site = models.current_site.get()
+    return COURTS_KEY.format(site.pk if site is not None else "all")
+
+
+def _sites_by_name():
+    names = {}
+    for site in models.Site.objects.all():
+        names[str(site.pk)] = site
+        if site.domain:
+            names[site.domain.lower()] = site
+    return names
+
+
+def find_site(name):
+    return cache.get_or_set(SITES_KEY, _sites_by_name).get(name)
+
+
+def get_default_site():
+    return cache.get_or_set(DEFAULT_SITE_KEY, lambda: models.Site.objects.order_by('id').first())
+
+
+def get_site():
+    # The current request's site, or the first site outside a request
+    site = models.current_site.get()
+    return site if site is not None else get_default_site()
+
+
+def get_courts():
+    # The current site's courts
+    return cache.get_or_set(_courts_key(), lambda: list(models.Court.objects.all()))
+
+
+# Async versions for the resolvers, which run on the event loop
+
+async def aget_site():
+    site = models.current_site.get()
+    if site is not None:
+        return site
+    site = await cache.aget(DEFAULT_SITE_KEY, _MISSING)
+    if site is _MISSING:
+        site = await models.Site.objects.order_by('id').afirst()
+        await cache.aadd(DEFAULT_SITE_KEY, site)
+    return site
+
+
+async def aget_courts():
+    key = _courts_key()
+    courts = await cache.aget(key, _MISSING)
+    if courts is _MISSING:
+        courts = [court async for court in models.Court.objects.all()]
+        await cache.aadd(key, courts)
+    return courts
+
+
+def invalidate_site():
+    cache.delete_many([DEFAULT_SITE_KEY, SITES_KEY])
+
+
+def invalidate_courts(*site_ids):
+    cache.delete_many([COURTS_KEY.format("all"), *(COURTS_KEY.format(site_id) for site_id in site_ids)])
@@ -0,0 +1,71 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+
+from app import cache, models
+
+
+# Compact booking grid for the calendar ================================================================================
+# The booking list queries repeat the whole court and user on every booking, which is most of their bytes. This
+# payload lists each court and user once and refers to them by index, with each day's bookings as rows of numbers:
+#
+#   {
+#     "courts": [[id, name], ...],
+#     "users": [[id, firstName, lastName, email], ...],
+#     "days": {"2026-10-19": [[courtIdx, startMinute, endMinute, userIdx, bookingId], ...], ...},
+#     "descriptions": {bookingId: description}   (only bookings that have one)
+#   }
+#
+# Minutes are from midnight. It is built from values_list() rows, so no model instances are created.
+
+# Longest window one request may ask for
+MAX_DAYS = 62
+
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def _courts(courts, court_id):
+    return [court for court in courts if court_id is None or str(court.id) == str(court_id)]
+
+
+def build(from_date, to_date, court_id=None):
+    if from_date > to_date:
+        raise ValueError("Start of the date window must not be after the end")
+    if to_date - from_date >= timedelta(days=MAX_DAYS):
+        raise ValueError(f"Date window is too long (max {MAX_DAYS} days)")
+
+    bookings = models.Booking.objects.filter(date__gte=from_date, date__lte=to_date)
+    if court_id is not None:
+        bookings = bookings.filter(court_id=court_id)
+    rows = list(bookings.order_by('date', 'start_time').values_list(
+        'id', 'court_id', 'date', 'start_time', 'end_time', 'user_id', 'description'))
+
+    # Courts come from the cache, so only the bookings and their users hit the database. Unless a court was added by
+    # another process since this one cached them, whose signal handler only cleared its own cache
+    courts = _courts(cache.get_courts(), court_id)
+    court_index = {court.id: i for i, court in enumerate(courts)}
+    if any(row[1] not in court_index for row in rows):
+        courts = _courts(models.Court.objects.all(), court_id)
+        court_index = {court.id: i for i, court in enumerate(courts)}
+
+    user_ids = sorted({row[5] for row in rows})
+    users = list(User.objects.filter(pk__in=user_ids).order_by('pk').values_list(
+        'id', 'first_name', 'last_name', 'email'))
+    user_index = {user[0]: i for i, user in enumerate(users)}
+
+    days, descriptions = {}, {}
+    for booking_id, booking_court_id, date, start_time, end_time, user_id, description in rows:
+        days.setdefault(date.isoformat(), []).append([
+            court_index[booking_court_id], _minutes(start_time), _minutes(end_time), user_index[user_id], booking_id,
+        ])
+        if description:
+            descriptions[booking_id] = description
+
+    return {
+        "courts": [[court.id, court.name] for court in courts],
+        "users": [list(user) for user in users],
+        "days": days,
+        "descriptions": descriptions,
+    }
@@ -0,0 +1,41 @@
+import re
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+# Brotli is optional: without the brotli package installed, responses are only gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+re_accepts_brotli = re.compile(r"\bbr\b")
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    Django's GZipMiddleware, except that clients accepting brotli get that instead when the brotli package is
+    installed. Streaming responses are always gzipped.
+    """
+    brotli_quality = 5
+
+    def process_response(self, request, response):
+        if brotli is None or response.streaming or response.has_header("Content-Encoding") or \
+                not re_accepts_brotli.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+            return super().process_response(request, response)
+        if len(response.content) < 200:
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        compressed = brotli.compress(response.content, quality=self.brotli_quality)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response["Content-Length"] = str(len(response.content))
+
+        # Same as GZipMiddleware: the compressed body is no longer byte-for-byte what the ETag was made from
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response["ETag"] = "W/" + etag
+        response["Content-Encoding"] = "br"
+        return response
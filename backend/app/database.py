@@ -0,0 +1,59 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from graphql import OperationType
+
+
+# Connection tuning and read routing ===================================================================================
+# Every new SQLite connection gets the pragmas in SQLITE_PRAGMAS (config/settings.py). In WAL mode readers don't wait
+# for the writer or it for them, so with synchronous = NORMAL a commit is an append to the log rather than two fsyncs
+# of the database file.
+#
+# GraphQL queries read through the "replica" connection when DATABASES has one, and everything else (mutations, the
+# auth middleware, the admin, management commands) uses "default". For SQLite the replica is a second, query-only
+# connection to the same file, so it sees every commit straight away. On PostgreSQL it can be a streaming replica,
+# where a query sent straight after a mutation may not see its result yet.
+
+REPLICA = "replica"
+
+# Set while a GraphQL query is executing. sync_to_async carries it over to the ORM's thread
+_reading_replica = ContextVar("reading_replica", default=False)
+
+
+def configure_connection(connection):
+    # Called for every new connection, from the connection_created signal
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, "SQLITE_PRAGMAS", {}).items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        if connection.alias == REPLICA:
+            cursor.execute("PRAGMA query_only = ON")
+
+
+@contextmanager
+def route_operation(operation_ast):
+    # Sends the reads of a GraphQL query to the replica, for as long as the block runs
+    token = _reading_replica.set(
+        operation_ast is not None and operation_ast.operation == OperationType.QUERY and REPLICA in settings.DATABASES)
+    try:
+        yield
+    finally:
+        _reading_replica.reset(token)
+
+
+class ReadReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return REPLICA if _reading_replica.get() else None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
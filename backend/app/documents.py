@@ -0,0 +1,123 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponseBadRequest
+from graphene_django.views import HttpError
+from graphql import GraphQLError, parse, specified_rules, validate
+
+from app.limits import QueryLimitsRule, operation_costs
+
+
+# Parsed and validated GraphQL documents, keyed by the SHA-256 of their text ==========================================
+# The frontend only ever sends the handful of documents in frontend/src/queries.ts, so after the first request for
+# each one the parse and validation steps are skipped entirely. Clients using Apollo's automatic persisted queries
+# send just the hash, and the full text only when the server answers PersistedQueryNotFound.
+
+class PersistedQueryNotFound(GraphQLError):
+    def __init__(self):
+        super().__init__("PersistedQueryNotFound", extensions={"code": "PERSISTED_QUERY_NOT_FOUND"})
+
+
+class PersistedQueryNotAllowed(GraphQLError):
+    def __init__(self):
+        super().__init__(
+            "This query is not on the server's allowlist", extensions={"code": "PERSISTED_QUERY_NOT_ALLOWED"})
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+class DocumentCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            document = self.documents.get(key)
+            if document is not None:
+                self.documents.move_to_end(key)
+            return document
+
+    def put(self, key, document):
+        with self.lock:
+            self.documents[key] = document
+            self.documents.move_to_end(key)
+            while len(self.documents) > self.maxsize:
+                self.documents.popitem(last=False)
+
+
+class DocumentStore(object):
+    """
+    Turns a request's query text and/or persisted query hash into a validated DocumentNode, rejecting documents over
+    the cost and depth limits.
+
+    With an allowlist (an Apollo persisted query manifest, see GRAPHQL_PERSISTED_QUERIES in config/settings.py) only
+    the documents listed in it are accepted, whether they arrive as text or as a hash.
+    """
+
+    def __init__(self, schema, cache_size=100, allowlist=None):
+        self.schema = schema
+        self.cache = DocumentCache(cache_size)
+        self.allowlist = None
+        if allowlist is not None:
+            with open(allowlist) as f:
+                manifest = json.load(f)
+            self.allowlist = {operation["id"]: operation["body"] for operation in manifest["operations"]}
+
+    def get(self, query=None, sha256=None):
+        # Returns (document, costs, errors), costs being the estimated cost of each operation by name (see
+        # app/limits.py)
+        if sha256 is None:
+            sha256 = query_hash(query)
+        elif query is not None and query_hash(query) != sha256:
+            return None, None, [GraphQLError("provided sha does not match query")]
+
+        cached = self.cache.get(sha256)
+        if cached is not None:
+            return cached[0], cached[1], []
+
+        if self.allowlist is not None:
+            if sha256 not in self.allowlist:
+                return None, None, [PersistedQueryNotAllowed()]
+            query = self.allowlist[sha256]
+        elif query is None:
+            return None, None, [PersistedQueryNotFound()]
+
+        try:
+            document = parse(query)
+        except GraphQLError as e:
+            return None, None, [e]
+        errors = validate(self.schema.graphql_schema, document, (*specified_rules, QueryLimitsRule))
+        if errors:
+            # Invalid documents aren't cached, so junk queries can't push the real ones out
+            return None, None, errors
+        costs = operation_costs(self.schema.graphql_schema, document)
+        self.cache.put(sha256, (document, costs))
+        return document, costs, []
+
+
+def get_persisted_query_hash(request, data):
+    # Apollo sends {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": ...}}}, as a JSON string for GETs
+    extensions = request.GET.get("extensions") or data.get("extensions")
+    if isinstance(extensions, str):
+        try:
+            extensions = json.loads(extensions)
+        except ValueError:
+            return None
+    if not isinstance(extensions, dict) or extensions.get("persistedQuery") is None:
+        return None
+    persisted_query = extensions["persistedQuery"]
+    if not isinstance(persisted_query, dict) or not isinstance(persisted_query.get("sha256Hash", ""), str):
+        raise HttpError(HttpResponseBadRequest("persistedQuery must be an object with a sha256Hash string"))
+    return persisted_query.get("sha256Hash") or None
+
+
+def document_store_settings():
+    options = getattr(settings, "GRAPHQL_PERSISTED_QUERIES", {})
+    return {"cache_size": options.get("CACHE_SIZE", 100), "allowlist": options.get("ALLOWLIST")}
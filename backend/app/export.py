@@ -0,0 +1,105 @@
+import csv
+import json
+
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from app import models
+
+
+# Streaming booking export =============================================================================================
+# Rows are read with values() and iterator(), so only one chunk of plain tuples is held at a time however many
+# bookings are exported (on PostgreSQL through a server-side cursor), and each one is written out as soon as it is
+# read. The header goes out before the query runs, so the download starts straight away.
+
+COLUMNS = ("id", "date", "start_time", "end_time", "court", "first_name", "last_name", "email", "description",
+           "created_at")
+# The Booking and BookingArchive fields behind each column
+FIELDS = ("id", "date", "start_time", "end_time", "court__name", "user__first_name", "user__last_name", "user__email",
+          "description", "created_at")
+ARCHIVE_FIELDS = ("booking_id",) + FIELDS[1:]
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+
+CHUNK_SIZE = 2000
+# Lines are sent in pieces of about this many characters, rather than one write (and one gzip flush) per row
+BUFFER_SIZE = 32 * 1024
+
+
+def filter_bookings(queryset, from_date=None, to_date=None, court_id=None, group=None):
+    # Works on both Booking and BookingArchive
+    if from_date is not None:
+        queryset = queryset.filter(date__gte=from_date)
+    if to_date is not None:
+        queryset = queryset.filter(date__lte=to_date)
+    if court_id is not None:
+        queryset = queryset.filter(court_id=court_id)
+    if group is not None:
+        # A subquery rather than a join, which would repeat the bookings of users in several matching groups
+        queryset = queryset.filter(user_id__in=User.objects.filter(groups__name__iexact=group).values('pk'))
+    return queryset
+
+
+def rows(bookings, archived=None):
+    # Tuples in COLUMNS order, archived bookings (which are all older) first
+    if archived is not None:
+        yield from archived.order_by('date', 'start_time').values_list(*ARCHIVE_FIELDS).iterator(chunk_size=CHUNK_SIZE)
+    yield from bookings.order_by('date', 'start_time').values_list(*FIELDS).iterator(chunk_size=CHUNK_SIZE)
+
+
+class _Echo(object):
+    # csv.writer writes into this, and each row comes straight back as a string
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(rows):
+    encoder = DjangoJSONEncoder(separators=(",", ":"))
+    for row in rows:
+        yield encoder.encode(dict(zip(COLUMNS, row))) + "\n"
+
+
+def _buffered(lines):
+    # The first line goes out on its own, so the client sees the response start before the query has run
+    lines = iter(lines)
+    yield next(lines, "")
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def streaming_response(rows, export_format, filename="bookings"):
+    content_type, extension = FORMATS[export_format]
+    lines = csv_lines(rows) if export_format == "csv" else ndjson_lines(rows)
+    response = StreamingHttpResponse(_buffered(lines), content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{filename}.{extension}"'
+    return response
+
+
+def export_response(export_format, from_date=None, to_date=None, court_id=None, group=None, include_archived=False):
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown export format {export_format}, expected one of {', '.join(FORMATS)}")
+    if from_date is not None and to_date is not None and from_date > to_date:
+        raise ValueError("Start of the date window must not be after the end")
+    bookings = filter_bookings(models.Booking.objects.all(), from_date, to_date, court_id, group)
+    archived = None
+    if include_archived:
+        archived = filter_bookings(models.BookingArchive.objects.all(), from_date, to_date, court_id, group)
+    return streaming_response(rows(bookings, archived), export_format)
@@ -0,0 +1,200 @@
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from app import models
+
+
+# iCalendar feeds ======================================================================================================
+# /calendar/user/<token>.ics has a user's bookings (the same ones as bookingsByUser) and /calendar/court/<id>.ics a
+# court's, for calendar apps to subscribe to. Each feed has a version in Django's cache, which is the time its bookings
+# last changed and is replaced (once the change commits) whenever one of them is created, moved or deleted. The ETag
+# and Last-Modified come from it, so a calendar app's refresh of an unchanged feed gets a 304 without touching the
+# database, and the feed itself is cached under its version. A feed that isn't cached is streamed straight from the
+# database, and cached once it has all been sent.
+#
+# With the default per-process cache, a process only sees another's changes once its own version expires, which is
+# what CALENDAR_FEED_CACHE_TIMEOUT bounds. Set CACHE_DIR to share the cache between processes.
+#
+# Booking times are the club's wall clock times, so they are written as floating times (no time zone), which calendar
+# apps show as they are.
+
+UID_DOMAIN = "catz-court-booking"
+
+USER = "user"
+COURT = "court"
+
+CHUNK_SIZE = 2000
+# Events are sent in pieces of about this many characters, as in app/export.py
+BUFFER_SIZE = 32 * 1024
+
+# A user's feed URL grants nothing but the feed, unlike their API token
+_signer = signing.Signer(salt="app.ical")
+
+
+def user_token(user_id):
+    return _signer.sign(str(user_id))
+
+
+def user_id_from_token(token):
+    # None if the token wasn't made by user_token
+    try:
+        return int(_signer.unsign(token))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+def _timeout():
+    return getattr(settings, "CALENDAR_FEED_CACHE_TIMEOUT", 600)
+
+
+def _version_key(kind, pk):
+    return f"ics:{kind}:{pk}:version"
+
+
+def get_version(kind, pk):
+    # Nanoseconds since the epoch when the feed last changed, or since it was first asked for
+    key = _version_key(kind, pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), _timeout())
+        version = cache.get(key)
+    return version
+
+
+def bookings_changed(user_ids=(), court_ids=()):
+    # Gives the feeds new versions once the current transaction commits, so a feed built in the meantime can't be
+    # cached under a version that claims to include the change
+    def bump():
+        version = time.time_ns()
+        cache.set_many({_version_key(USER, pk): version for pk in set(user_ids)}, _timeout())
+        cache.set_many({_version_key(COURT, pk): version for pk in set(court_ids)}, _timeout())
+    transaction.on_commit(bump)
+
+
+# Writing ==============================================================================================================
+
+def escape(text):
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\r\n", "\\n").replace(
+        "\n", "\\n")
+
+
+def fold(line):
+    # Lines are at most 75 octets, continued on lines starting with a space, and end with CRLF (RFC 5545 3.1)
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts, start = [], 0
+    while start < len(encoded):
+        end = min(start + (75 if not parts else 74), len(encoded))
+        # Never split a UTF-8 sequence
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode())
+        start = end
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def _utc(moment):
+    return moment.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def _local(day, moment):
+    return datetime.combine(day, moment).strftime("%Y%m%dT%H%M%S")
+
+
+def calendar_lines(name, events):
+    yield fold("BEGIN:VCALENDAR")
+    yield fold("VERSION:2.0")
+    yield fold("PRODID:-//Catz Court Booking//Bookings//EN")
+    yield fold("CALSCALE:GREGORIAN")
+    yield fold("METHOD:PUBLISH")
+    yield fold("X-WR-CALNAME:" + escape(name))
+    for booking_id, day, start_time, end_time, created_at, summary, location, description in events:
+        yield (
+            "BEGIN:VEVENT\r\n"
+            + fold(f"UID:booking-{booking_id}@{UID_DOMAIN}")
+            + fold("DTSTAMP:" + _utc(created_at))
+            + fold("DTSTART:" + _local(day, start_time))
+            + fold("DTEND:" + _local(day, end_time))
+            + fold("SUMMARY:" + escape(summary))
+            + fold("LOCATION:" + escape(location))
+            + (fold("DESCRIPTION:" + escape(description)) if description else "")
+            + "END:VEVENT\r\n"
+        )
+    yield fold("END:VCALENDAR")
+
+
+# The querysets are made straight away, in the view, so they keep the request's site (see app/sites.py) while the
+# events are streamed
+
+def user_events(user_id):
+    bookings = models.Booking.objects.filter(user__pk=user_id).order_by('date', 'start_time').values_list(
+        'id', 'date', 'start_time', 'end_time', 'created_at', 'court__name', 'description')
+    return (
+        (booking_id, day, start_time, end_time, created_at, court, court, description)
+        for booking_id, day, start_time, end_time, created_at, court, description
+        in bookings.iterator(chunk_size=CHUNK_SIZE)
+    )
+
+
+def court_events(court):
+    bookings = models.Booking.objects.filter(court=court).order_by('date', 'start_time').values_list(
+        'id', 'date', 'start_time', 'end_time', 'created_at', 'user__first_name', 'user__last_name', 'description')
+    return (
+        (booking_id, day, start_time, end_time, created_at, f"{first_name} {last_name}".strip() or "Booked",
+         court.name, description)
+        for booking_id, day, start_time, end_time, created_at, first_name, last_name, description
+        in bookings.iterator(chunk_size=CHUNK_SIZE)
+    )
+
+
+# Serving ==============================================================================================================
+
+def _buffered_and_cached(lines, key):
+    # Sends the lines in pieces and caches the whole feed once it has all gone out
+    parts, buffer, size = [], [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            chunk = "".join(buffer).encode()
+            parts.append(chunk)
+            yield chunk
+            buffer, size = [], 0
+    chunk = "".join(buffer).encode()
+    parts.append(chunk)
+    yield chunk
+    cache.set(key, b"".join(parts), _timeout())
+
+
+def feed_response(request, kind, pk, name, events, public):
+    version = get_version(kind, pk)
+    # A user's feed has their bookings at the request's site
+    site = models.current_site.get()
+    scope = f"{pk}-{site.pk}" if site is not None else f"{pk}"
+    etag = f'"{kind}-{scope}-{version}"'
+    last_modified = version // 10 ** 9
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        key = f"ics:{kind}:{scope}:{version}"
+        body = cache.get(key)
+        if body is not None:
+            response = HttpResponse(body, content_type="text/calendar; charset=utf-8")
+        else:
+            response = StreamingHttpResponse(_buffered_and_cached(calendar_lines(name, events()), key),
+                                             content_type="text/calendar; charset=utf-8")
+        response["Content-Disposition"] = f'inline; filename="{kind}-{pk}.ics"'
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    # Calendar apps can keep the feed, but must check it is still current, which is what the 304s are for
+    patch_cache_control(response, **{"public" if public else "private": True}, no_cache=True)
+    return response
@@ -0,0 +1,106 @@
+import hashlib
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+
+# Site logo variants ===================================================================================================
+# The logo is uploaded at whatever size the admin had to hand, which is far more than a phone's navbar needs. When a
+# Site is saved with a new logo (see app/signals.py), it is resized to each of WIDTHS in SITE_LOGO_VARIANTS (and its
+# own width, if that is smaller) and saved as WebP, and as PNG for the odd client without WebP, under VARIANT_DIR in
+# MEDIA_ROOT. Site.logo_variants lists them, and SiteType.logo(width) picks the smallest one at least as wide as asked.
+#
+# Variant names end in a hash of their content, so a name always has the same content and the variants can be served
+# with a year long, immutable Cache-Control: repeat loads don't even revalidate, and a new logo gets new names. The
+# variant view in app/views.py serves them like that; a web server serving MEDIA_ROOT itself should do the same for
+# VARIANT_DIR.
+
+WEBP = "webp"
+PNG = "png"
+FORMATS = (WEBP, PNG)
+
+CONTENT_TYPES = {WEBP: "image/webp", PNG: "image/png"}
+
+VARIANT_DIR = "site/logo/variants"
+
+# Seconds browsers may keep a variant without asking again
+MAX_AGE = 365 * 24 * 60 * 60
+
+DEFAULT_SETTINGS = {
+    "WIDTHS": [64, 128, 256, 512],
+    "WEBP_QUALITY": 85,
+}
+
+
+def get_settings():
+    return {**DEFAULT_SETTINGS, **getattr(settings, "SITE_LOGO_VARIANTS", {})}
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def _encode(image, image_format, options):
+    out = io.BytesIO()
+    if image_format == WEBP:
+        image.save(out, "WEBP", quality=options["WEBP_QUALITY"], method=6)
+    else:
+        image.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+def make_variants(data, name, options=None):
+    """
+    Writes the variants of an image (its bytes, and its file name for the variants' names) to the default storage.
+    Returns {"source": hash of the original, format: {width: variant name}}.
+    """
+    options = options or get_settings()
+    stem = os.path.splitext(os.path.basename(name))[0]
+    with Image.open(io.BytesIO(data)) as original:
+        original = original.convert("RGBA")
+        widths = sorted({min(width, original.width) for width in options["WIDTHS"]})
+        variants = {"source": _digest(data)}
+        for image_format in FORMATS:
+            variants[image_format] = {}
+        for width in widths:
+            height = max(1, round(original.height * width / original.width))
+            image = original if width == original.width else original.resize((width, height), Image.LANCZOS)
+            for image_format in FORMATS:
+                content = _encode(image, image_format, options)
+                path = f"{VARIANT_DIR}/{stem}-{width}.{_digest(content)}.{image_format}"
+                # The same name always has the same content, so an existing file is already right
+                if not default_storage.exists(path):
+                    default_storage.save(path, ContentFile(content))
+                variants[image_format][str(width)] = path
+    return variants
+
+
+def update_logo_variants(site):
+    # Called before a Site is saved. Only a new logo gets new variants
+    if not site.logo:
+        site.logo_variants = {}
+        return
+    committed = site.logo._committed
+    site.logo.open("rb")
+    try:
+        data = site.logo.read()
+    finally:
+        # An upload is still to be written to storage by the save, so only a stored file is closed
+        if committed:
+            site.logo.close()
+        else:
+            site.logo.seek(0)
+    if site.logo_variants.get("source") != _digest(data):
+        site.logo_variants = make_variants(data, site.logo.name)
+
+
+def pick(variants, width, image_format=WEBP):
+    # Name of the narrowest variant at least width wide (or the widest there is), or None if there are none
+    sizes = sorted((int(size), path) for size, path in variants.get(image_format, {}).items())
+    if not sizes:
+        return None
+    return next((path for size, path in sizes if size >= width), sizes[-1][1])
@@ -0,0 +1,267 @@
+import threading
+import time
+
+from django.conf import settings
+from graphene.relay import Connection
+from graphene_django.settings import graphene_settings
+from graphql import (BREAK, FieldNode, FragmentDefinitionNode, FragmentSpreadNode, GraphQLError, InlineFragmentNode,
+                     IntValueNode, OperationDefinitionNode, ValidationRule, VariableNode, Visitor, get_named_type,
+                     get_nullable_type, is_list_type, is_object_type, visit)
+
+
+# Query cost and depth limits ==========================================================================================
+# A document's cost is a static estimate of the rows it can return: every object costs 1, scalars are free, and a list
+# multiplies the cost of the objects in it, and everything under them, by how long it could be. For fields with a
+# first/last argument that is its value (or default), for other lists the estimate in LIST_SIZES. Documents over
+# MAX_COST or MAX_DEPTH (GRAPHQL_QUERY_LIMITS in config/settings.py) fail validation, so they are never executed, and
+# the cost of the rest is taken from the client's token bucket below. Operations whose first/last come from
+# variables are measured again with each request's variables (see request_cost).
+
+DEFAULT_LIMITS = {
+    "MAX_DEPTH": 8,
+    "MAX_COST": 5000,
+    "DEFAULT_LIST_SIZE": 100,
+    "RATE": 2000,
+    "BURST": 20000,
+}
+
+# Expected length of list fields without first/last, where DEFAULT_LIST_SIZE would be far off
+LIST_SIZES = {
+    "Query.allCourts": 20,
+    "Query.allBookings": 1000,
+    "Query.bookingsByCourt": 1000,
+    "Query.bookingsByUser": 1000,
+    "CourtType.bookingSet": 1000,
+    "UserType.bookingSet": 1000,
+    # Years of bookings, so anything but a trivial selection is over MAX_COST. Use the paged bookingHistory instead
+    "CourtType.archivedBookings": 10000,
+    "UserType.archivedBookings": 10000,
+}
+
+# Cost of fields that do more work than reading a row, paid once on top of their selection
+FIELD_COSTS = {
+    "Query.calendar": 100,
+    "Query.findSlots": 100,
+    # Up to a rollup row per court, day and opening hour of the window
+    "Query.courtUtilisation": 100,
+    # Reads every booking in the window, unlike courtUtilisation which reads the rollups
+    "Query.topBookers": 100,
+    "Mutation.createBooking": 10,
+    "Mutation.createBookings": 200,
+    "Mutation.createRecurringBooking": 200,
+    "Mutation.deleteBooking": 10,
+    "Mutation.requestBooking": 10,
+}
+
+
+def get_limits():
+    return {**DEFAULT_LIMITS, **getattr(settings, "GRAPHQL_QUERY_LIMITS", {})}
+
+
+def _is_connection(graphql_type):
+    graphene_type = getattr(graphql_type, "graphene_type", None)
+    return isinstance(graphene_type, type) and issubclass(graphene_type, Connection)
+
+
+def _size_argument(node, variables):
+    # The first/last given in the document, or None if there isn't one (or its variable's value isn't known yet)
+    for argument in node.arguments:
+        if argument.name.value not in ("first", "last"):
+            continue
+        if isinstance(argument.value, IntValueNode):
+            return int(argument.value.value)
+        if isinstance(argument.value, VariableNode) and variables is not None:
+            value = variables.get(argument.value.name.value)
+            if isinstance(value, int) and not isinstance(value, bool):
+                return value
+    return None
+
+
+def _list_size(parent_type, field, node, limits, variables=None):
+    if "first" in field.args or "last" in field.args:
+        max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+        size = _size_argument(node, variables)
+        if size is None:
+            # The argument's default, as in findSlots and topBookers, else as many as a connection gives
+            defaults = [field.args[name].default_value for name in ("first", "last") if name in field.args]
+            size = next((default for default in defaults if isinstance(default, int)), max_limit)
+        return max(min(size, max_limit), 0)
+    if not is_list_type(get_nullable_type(field.type)) or _is_connection(parent_type):
+        # A connection's edges were already counted by its first/last
+        return 1
+    return LIST_SIZES.get(f"{parent_type.name}.{node.name.value}", limits["DEFAULT_LIST_SIZE"])
+
+
+def _measure(schema, parent_type, selection_set, fragments, depth, limits, variables, visited=frozenset()):
+    # Returns the (cost, depth) of a selection set
+    cost, deepest = 0, depth
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            name = selection.name.value
+            field = parent_type.fields.get(name) if is_object_type(parent_type) else None
+            if name.startswith("__") or field is None:
+                # Introspection (GraphiQL's schema query is deep but cheap), or an unknown field that the standard
+                # rules report
+                continue
+            field_type = get_named_type(field.type)
+            item_cost = 1 if is_object_type(field_type) else 0
+            field_depth = depth + 1
+            if selection.selection_set is not None:
+                child_cost, field_depth = _measure(
+                    schema, field_type, selection.selection_set, fragments, depth + 1, limits, variables, visited)
+                item_cost += child_cost
+            cost += FIELD_COSTS.get(f"{parent_type.name}.{name}", 0) + \
+                item_cost * _list_size(parent_type, field, selection, limits, variables)
+            deepest = max(deepest, field_depth)
+            continue
+
+        if isinstance(selection, InlineFragmentNode):
+            fragment = selection
+        elif isinstance(selection, FragmentSpreadNode) and selection.name.value not in visited:
+            # Fragment cycles are reported by the standard rules
+            fragment = fragments.get(selection.name.value)
+        else:
+            continue
+        if fragment is None:
+            continue
+        fragment_type = schema.get_type(fragment.type_condition.name.value) if fragment.type_condition \
+            else parent_type
+        fragment_visited = visited | {selection.name.value} if isinstance(selection, FragmentSpreadNode) else visited
+        fragment_cost, fragment_depth = _measure(
+            schema, fragment_type, fragment.selection_set, fragments, depth, limits, variables, fragment_visited)
+        cost += fragment_cost
+        deepest = max(deepest, fragment_depth)
+    return cost, deepest
+
+
+def measure_operation(schema, operation, fragments, limits=None, variables=None):
+    # Returns the (cost, depth) of one OperationDefinitionNode, given the document's fragments by name and, once they
+    # are known, the request's variables
+    limits = limits or get_limits()
+    root_type = schema.get_root_type(operation.operation)
+    if root_type is None:
+        return 0, 0
+    return _measure(schema, root_type, operation.selection_set, fragments, 0, limits, variables)
+
+
+def _fragments(document):
+    return {d.name.value: d for d in document.definitions if isinstance(d, FragmentDefinitionNode)}
+
+
+class _VariableSizes(Visitor):
+    def __init__(self):
+        super().__init__()
+        self.found = False
+
+    def enter_argument(self, node, *_args):
+        if node.name.value in ("first", "last") and isinstance(node.value, VariableNode):
+            self.found = True
+            return BREAK
+
+
+def _has_variable_sizes(document):
+    visitor = _VariableSizes()
+    visit(document, visitor)
+    return visitor.found
+
+
+def operation_costs(schema, document):
+    # {operation name (None if anonymous): cost} for every operation in a validated document. The costs are None when
+    # list sizes come from variables, for request_cost to work out with each request's
+    fragments = _fragments(document)
+    limits = get_limits()
+    variable_sizes = _has_variable_sizes(document)
+    return {
+        d.name.value if d.name else None: None if variable_sizes else measure_operation(schema, d, fragments, limits)[0]
+        for d in document.definitions if isinstance(d, OperationDefinitionNode)
+    }
+
+
+def request_cost(schema, document, operation, costs, variables):
+    # The cost of running an operation from operation_costs' document with a request's variables. Raises GraphQLError
+    # if they take it over MAX_COST
+    cost = costs.get(operation.name.value if operation.name else None, 0)
+    if cost is not None:
+        return cost
+    limits = get_limits()
+    cost = measure_operation(
+        schema, operation, _fragments(document), limits, variables if isinstance(variables, dict) else {})[0]
+    if cost > limits["MAX_COST"]:
+        raise GraphQLError(f"Query is too expensive (cost {cost}, max allowed is {limits['MAX_COST']})", operation)
+    return cost
+
+
+class QueryLimitsRule(ValidationRule):
+    """
+    Validation rule rejecting operations whose estimated cost or depth is over the limits in GRAPHQL_QUERY_LIMITS.
+    """
+
+    def enter_operation_definition(self, node, *_args):
+        limits = get_limits()
+        cost, depth = measure_operation(self.context.schema, node, _fragments(self.context.document), limits)
+        if depth > limits["MAX_DEPTH"]:
+            self.report_error(GraphQLError(
+                f"Query is too deep (depth {depth}, max allowed is {limits['MAX_DEPTH']})", node))
+        if cost > limits["MAX_COST"]:
+            self.report_error(GraphQLError(
+                f"Query is too expensive (cost {cost}, max allowed is {limits['MAX_COST']})", node))
+
+
+# Per-client rate limiting =============================================================================================
+# Each client (its user once their auth token has been checked, or IP address when anonymous or the token is unknown)
+# has a bucket of BURST cost units, refilled at RATE units a second. Subscriptions are charged to the same bucket when
+# they start. A request takes its operation's cost from the bucket and is refused with 429 when there isn't enough, so
+# a client sending expensive queries in a loop is held to RATE without slowing anyone else down. Buckets are per
+# process, like the auth token cache in app/middleware.py.
+
+class TokenBucket(object):
+    # Buckets that have refilled completely are dropped once there are more than this many
+    max_clients = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def consume(self, key, cost):
+        # Returns 0 if the client could spend cost, otherwise the seconds until it could
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < cost:
+                self.buckets[key] = (tokens, now)
+                return (cost - tokens) / self.rate
+            self.buckets[key] = (tokens - cost, now)
+            if len(self.buckets) > self.max_clients:
+                self._prune(now)
+            return 0
+
+    def _prune(self, now):
+        full = now - self.burst / self.rate
+        for key, (tokens, updated) in list(self.buckets.items()):
+            if updated < full:
+                del self.buckets[key]
+
+
+_bucket = None
+
+
+def get_bucket():
+    global _bucket
+    if _bucket is None:
+        limits = get_limits()
+        _bucket = TokenBucket(limits["RATE"], limits["BURST"])
+    return _bucket
+
+
+def user_key(user):
+    return f"user:{user.pk}"
+
+
+def client_key(request):
+    # Made-up tokens all share their address's bucket, so they can't be used to get a fresh one each time
+    if request.user.is_authenticated:
+        return user_key(request.user)
+    return "ip:" + request.META.get("REMOTE_ADDR", "")
@@ -0,0 +1,105 @@
+from django.core.exceptions import FieldDoesNotExist
+from graphene.utils.dataloader import DataLoader
+from graphene.utils.str_converters import to_snake_case
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+
+from app import models
+
+
+# Per-request DataLoaders for related rows. The loads made while resolving one level of a query (e.g. the court of
+# every booking in a list) are collected and fetched together with one pk__in query once the resolvers of that level
+# have run, and each row is kept for the rest of the request. Rows that came in through select_related (see
+# optimise_queryset below, which covers every list resolver) are primed into the loader so they never hit the
+# database again.
+class ModelLoader(DataLoader):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    async def batch_load_fn(self, pks):
+        # None for rows that no longer exist
+        rows = await self.model.objects.ain_bulk(set(pks))
+        return [rows.get(pk) for pk in pks]
+
+    def prime(self, instance):
+        # Returns the request's copy of the row, which is the first one seen
+        super().prime(instance.pk, instance)
+        loaded = self._cache[instance.pk]
+        return loaded.result() if loaded.done() and not loaded.cancelled() and loaded.exception() is None \
+            else instance
+
+
+class Loaders(object):
+    def __init__(self):
+        self.court = ModelLoader(models.Court)
+        self.user = ModelLoader(models.User)
+
+
+def get_loaders(info):
+    # Stored on the request so every resolver in one GraphQL request shares the same loaders
+    request = info.context
+    if not hasattr(request, "_loaders"):
+        request._loaders = Loaders()
+    return request._loaders
+
+
+def _collect_fields(selection_set, info, fields):
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            fields.setdefault(selection.name.value, []).append(selection)
+        elif isinstance(selection, InlineFragmentNode):
+            _collect_fields(selection.selection_set, info, fields)
+        elif isinstance(selection, FragmentSpreadNode):
+            _collect_fields(info.fragments[selection.name.value].selection_set, info, fields)
+    return fields
+
+
+def _selected_fields(field_nodes, info):
+    fields = {}
+    for node in field_nodes:
+        if node.selection_set is not None:
+            _collect_fields(node.selection_set, info, fields)
+    return fields
+
+
+def _plan(model, field_nodes, info, prefix, related, columns):
+    # Fills in the select_related paths and the columns needed for the selection. Returns False if some selected
+    # field is not a plain model field, in which case the columns can't safely be restricted with only()
+    restrictable = True
+    columns.append(prefix + model._meta.pk.attname)
+    for name, nodes in _selected_fields(field_nodes, info).items():
+        if name.startswith("__"):
+            continue
+        try:
+            field = model._meta.get_field(to_snake_case(name))
+        except FieldDoesNotExist:
+            restrictable = False
+            continue
+        if field.is_relation and field.concrete and not field.many_to_many:
+            related.append(prefix + field.name)
+            columns.append(prefix + field.attname)
+            restrictable &= _plan(field.related_model, nodes, info, prefix + field.name + "__", related, columns)
+        elif field.is_relation:
+            # Reverse and many-to-many relations are resolved by their own query, which only needs the pk
+            continue
+        else:
+            columns.append(prefix + field.attname)
+    return restrictable
+
+
+def optimise_queryset(queryset, info, path=()):
+    """
+    Adds select_related() for the forward relations selected in the GraphQL query and, where every selected field
+    maps onto a column, restricts the columns loaded with only(). path descends into wrapper types, e.g.
+    ("edges", "node") for a connection.
+    """
+    field_nodes = info.field_nodes
+    for name in path:
+        field_nodes = _selected_fields(field_nodes, info).get(name, [])
+    related, columns = [], []
+    restrictable = _plan(queryset.model, field_nodes, info, "", related, columns)
+    if related:
+        queryset = queryset.select_related(*related)
+    if restrictable:
+        queryset = queryset.only(*columns)
+    return queryset
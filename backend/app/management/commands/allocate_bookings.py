@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from app import admission
+
+
+class Command(BaseCommand):
+    help = "Decides queued booking requests (see requestBooking), for when BOOKING_QUEUE's ALLOCATOR is \"command\""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Decide the requests that are ready and exit, instead of waiting for more")
+        parser.add_argument('--order', choices=[admission.ARRIVAL, admission.LOTTERY], default=None,
+                            help="Override BOOKING_QUEUE's ORDER")
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Seconds between checks for new requests (default BOOKING_QUEUE's POLL_INTERVAL)")
+
+    def handle(self, *args, once=False, order=None, interval=None, **options):
+        queue = admission.get_settings()
+        if order is not None:
+            queue["ORDER"] = order
+        if interval is not None:
+            queue["POLL_INTERVAL"] = interval
+        if queue["POLL_INTERVAL"] <= 0:
+            raise CommandError("The interval must be positive")
+
+        while True:
+            close_old_connections()
+            accepted, rejected = admission.drain(queue)
+            if accepted or rejected:
+                self.stdout.write(f"Accepted {accepted} and rejected {rejected} booking request(s)")
+            if once:
+                return
+            time.sleep(queue["POLL_INTERVAL"])
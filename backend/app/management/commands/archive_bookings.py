@@ -0,0 +1,39 @@
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app import archive, models
+
+
+class Command(BaseCommand):
+    help = "Moves old bookings from the live Booking table to BookingArchive"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Archive bookings more than this many days old (default BOOKING_ARCHIVE_DAYS)")
+        parser.add_argument('--before', type=date.fromisoformat, default=None,
+                            help="Archive bookings before this day instead (YYYY-MM-DD)")
+        parser.add_argument('--batch-size', type=int, default=archive.DEFAULT_BATCH_SIZE,
+                            help=f"Bookings moved per transaction (default {archive.DEFAULT_BATCH_SIZE})")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the bookings that would be archived")
+
+    def handle(self, *args, days=None, before=None, batch_size=archive.DEFAULT_BATCH_SIZE, dry_run=False, **options):
+        if before is None:
+            days = days if days is not None else getattr(settings, "BOOKING_ARCHIVE_DAYS", 365)
+            before = date.today() - timedelta(days=days)
+        if before > date.today():
+            raise CommandError("Only past bookings can be archived")
+
+        if dry_run:
+            count = models.Booking.objects.filter(
+                site__in=models.Site.objects.all(), date__lt=before).count()
+            self.stdout.write(f"{count} booking(s) before {before} would be archived")
+            return
+
+        total = 0
+        for moved in archive.archive_before(before, batch_size):
+            total += moved
+            if options['verbosity'] > 1:
+                self.stdout.write(f"Archived {total} booking(s)")
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} booking(s) before {before}"))
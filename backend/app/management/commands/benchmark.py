@@ -0,0 +1,413 @@
+import json
+import math
+import multiprocessing
+import random
+import re
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import AsyncClient, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from graphql import GraphQLSyntaxError, NonNullTypeNode, OperationDefinitionNode, parse
+from rest_framework.authtoken.models import Token
+
+from app import database, models, views
+from app.middleware import authenticate_token
+
+
+# GraphQL endpoint benchmark ===========================================================================================
+# Replays the documents in frontend/src/queries.ts, with made-up variables, through the Django test client, so the
+# whole request path is measured (middleware, auth, validation, execution and serialisation) without an HTTP server
+# or network in the way. A fraction of the requests are writes: a createBooking for a random free-looking slot in the
+# next week, then a deleteBooking for it if it went through, so the dataset stays the same size. Clashes are
+# expected and counted as "rejected".
+#
+# Each worker process sends its share of --rate requests a second (or as many as it can with --rate 0) and records
+# the latency and number of SQL queries of every request. The report has throughput and p50/p95/p99 latency per
+# document, and can be written out as JSON and compared against a later run with --compare.
+#
+# Every request goes to a random site with courts (in the X-Site header, see app/sites.py), or to the one given with
+# --site, so a run against a database with many sites (generate_data --sites) can be compared with one against a
+# single site of the same size to show what the other sites cost it.
+#
+# --no-document-cache parses and validates every request's document again, as if each were the first of its kind, so
+# runs with and without it show what the document cache (see app/documents.py) saves.
+#
+# With GRAPHQL_ASYNC=true the requests go through Django's ASGI handler to AsyncGraphQLView instead, so runs with and
+# without it at the same --processes compare requests a second under WSGI and ASGI.
+#
+# Run it against a copy of the database filled by the generate_data command, not a live one.
+
+QUERIES_FILE = settings.BASE_DIR.parent / "frontend" / "src" / "queries.ts"
+DOCUMENT_RE = re.compile(r"export const (\w+) = gql\s*`(.*?)`", re.DOTALL)
+
+# Relative frequency of each query document, after what the frontend asks for: every page load fetches the site,
+# courts and session, and the calendar a week of bookings each time it moves. Documents not listed get 1.
+# allBookings returns the whole table and nothing calls it any more
+WEIGHTS = {
+    "SITE_INFO": 1,
+    "ALL_COURTS": 1,
+    "SESSION_INFO": 1,
+    "BOOKINGS": 3,
+    "UPCOMING_BOOKINGS_BY_USER": 1,
+    "BOOKINGS_BY_USER": 0.2,
+    "ALL_BOOKINGS": 0,
+}
+CREATE = "CREATE_BOOKING"
+DELETE = "DELETE_BOOKING"
+
+# Values for query variables, given the random generator, the courts of the request's site, the request's user ID and
+# the first day of the week it looks at. Optional variables not listed here are left out
+VARIABLES = {
+    "courtId": lambda rng, courts, user_id, week: rng.choice(courts)["id"],
+    "userId": lambda rng, courts, user_id, week: user_id,
+    "from": lambda rng, courts, user_id, week: week.isoformat(),
+    "to": lambda rng, courts, user_id, week: (week + timedelta(days=6)).isoformat(),
+    "first": lambda rng, courts, user_id, week: 20,
+}
+
+# Later runs count as slower when their p95 is this much higher than the baseline's
+DEFAULT_TOLERANCE = 0.2
+
+
+def load_documents(path):
+    # {export name: (document text, [(variable name, required)])} for every document in a queries.ts file
+    try:
+        source = Path(path).read_text()
+    except OSError as e:
+        raise CommandError(f"Can't read GraphQL documents from {path}: {e}")
+    documents = {}
+    for name, text in DOCUMENT_RE.findall(source):
+        try:
+            document = parse(text)
+        except GraphQLSyntaxError as e:
+            raise CommandError(f"{name} in {path} isn't a valid GraphQL document: {e.message}")
+        operation = next(d for d in document.definitions if isinstance(d, OperationDefinitionNode))
+        documents[name] = (text, [
+            (v.variable.name.value, isinstance(v.type, NonNullTypeNode)) for v in operation.variable_definitions
+        ])
+    return documents
+
+
+class Workload(object):
+    """
+    What the workers send. Built once in the parent process, from the database, and copied to every worker.
+    """
+
+    def __init__(self, documents, weights, write_fraction, user_count=1000, site=None):
+        if CREATE not in documents or DELETE not in documents:
+            raise CommandError(f"The queries file has no {CREATE} or {DELETE} document")
+        self.documents = documents
+        self.write_fraction = write_fraction
+        self.reads = []
+        self.read_weights = []
+        for name, (text, variables) in documents.items():
+            weight = weights.get(name, WEIGHTS.get(name, 1))
+            if name in (CREATE, DELETE) or weight <= 0:
+                continue
+            missing = [variable for variable, required in variables if required and variable not in VARIABLES]
+            if missing:
+                raise CommandError(f"Don't know what to send for {', '.join(missing)} in {name}")
+            self.reads.append(name)
+            self.read_weights.append(weight)
+        if not self.reads and write_fraction < 1:
+            raise CommandError("No query documents to send")
+
+        # {site ID: [court]}
+        self.courts = {}
+        courts = models.Court.objects.order_by('id')
+        if site is not None:
+            courts = courts.filter(site=site)
+        for court in courts:
+            self.courts.setdefault(court.site_id, []).append({
+                "id": court.id,
+                "opening": court.opening_time.hour * 60 + court.opening_time.minute,
+                "closing": court.closing_time.hour * 60 + court.closing_time.minute,
+                "length": min(max(court.min_booking_length_minutes or 60, 60), court.max_booking_length_minutes or 60),
+                "days_ahead": min(court.max_booking_days_in_advance or 7, 7),
+            })
+        self.site_ids = list(self.courts)
+        self.tokens = list(Token.objects.order_by('user_id').values_list('key', 'user_id')[:user_count])
+        if not self.courts or not self.tokens:
+            raise CommandError("Needs at least one court and one user with an auth token, see generate_data")
+
+    def read(self, rng, user_id):
+        site_id = rng.choice(self.site_ids)
+        name = rng.choices(self.reads, self.read_weights)[0]
+        text, variables = self.documents[name]
+        week = date.today() + timedelta(days=rng.randint(-7, 7))
+        values = {
+            variable: VARIABLES[variable](rng, self.courts[site_id], user_id, week)
+            for variable, required in variables if variable in VARIABLES
+        }
+        return site_id, name, text, values
+
+    def create(self, rng):
+        site_id = rng.choice(self.site_ids)
+        court = rng.choice(self.courts[site_id])
+        day = date.today() + timedelta(days=rng.randint(1, max(court["days_ahead"], 1)))
+        start = rng.randrange(court["opening"], court["closing"] - court["length"] + 1, 30)
+        return site_id, CREATE, self.documents[CREATE][0], {
+            "courtID": court["id"],
+            "date": day.isoformat(),
+            "startTime": _time(start),
+            "endTime": _time(start + court["length"]),
+            "description": "Benchmark",
+        }
+
+
+def _time(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class CaptureAllQueries(object):
+    # CaptureQueriesContext for every database connection, since GraphQL queries read through the replica (see
+    # app/database.py)
+
+    def __enter__(self):
+        self.contexts = [CaptureQueriesContext(connections[alias]) for alias in connections]
+        for context in self.contexts:
+            context.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        for context in self.contexts:
+            context.__exit__(*exc_info)
+
+    def __len__(self):
+        return sum(len(context) for context in self.contexts)
+
+
+def run_worker(workload, duration, warmup, interval, seed, document_cache=True):
+    # Returns [(document, latency in ms, SQL queries, outcome)] for every request sent after the warm-up
+    rng = random.Random(seed)
+    persisted_queries = getattr(settings, "GRAPHQL_PERSISTED_QUERIES", {})
+    if not document_cache:
+        persisted_queries = {**persisted_queries, "CACHE_SIZE": 0}
+    # Made again by the first request, with the cache size above
+    views.CachingGraphQLView.document_store = None
+    # Under ASGI requests go through Django's ASGI handler, one at a time like the WSGI ones
+    client_post = async_to_sync(AsyncClient().post) if settings.GRAPHQL_ASYNC else Client().post
+    samples = []
+    # Fills this process's auth token cache, which otherwise makes the first request from each user one query dearer
+    # and the query counts depend on how long the run is
+    for token, user_id in workload.tokens:
+        authenticate_token(token)
+    start = time.monotonic()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+    next_send = start
+
+    def post(site_id, name, text, variables, token):
+        with CaptureAllQueries() as queries:
+            sent = time.perf_counter()
+            response = client_post("/graphql", json.dumps({"query": text, "variables": variables}),
+                                   content_type="application/json",
+                                   headers={"Authorization": "Token " + token, settings.SITE_HEADER: str(site_id)})
+            latency = (time.perf_counter() - sent) * 1000
+        result = None
+        if response.status_code == 200:
+            result = response.json()
+            outcome = "rejected" if result.get("errors") else "ok"
+        else:
+            outcome = f"http_{response.status_code}"
+        if time.monotonic() >= measure_from:
+            samples.append((name, latency, len(queries), outcome))
+        return result
+
+    # The test client's requests come from "testserver"
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+                           GRAPHQL_PERSISTED_QUERIES=persisted_queries):
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if interval:
+                if next_send > now:
+                    time.sleep(next_send - now)
+                next_send += interval
+
+            token, user_id = rng.choice(workload.tokens)
+            if rng.random() >= workload.write_fraction:
+                post(*workload.read(rng, user_id), token)
+                continue
+            site_id, *create = workload.create(rng)
+            result = post(site_id, *create, token)
+            booking = ((result or {}).get("data") or {}).get("createBooking")
+            if booking:
+                post(site_id, DELETE, workload.documents[DELETE][0], {"bookingID": booking["booking"]["id"]}, token)
+                # The delete counts towards the rate too
+                next_send += interval
+    return samples
+
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of a sorted list
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def summarise(samples, duration):
+    def stats(rows):
+        latencies = sorted(row[1] for row in rows)
+        queries = [row[2] for row in rows]
+        return {
+            "count": len(rows),
+            "throughput": round(len(rows) / duration, 2),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "max_ms": round(latencies[-1], 2),
+            "mean_queries": round(sum(queries) / len(queries), 2),
+            "max_queries": max(queries),
+            "outcomes": dict(Counter(row[3] for row in rows)),
+        }
+
+    by_document = {}
+    for row in samples:
+        by_document.setdefault(row[0], []).append(row)
+    return {
+        "total": stats(samples),
+        "operations": {name: stats(rows) for name, rows in sorted(by_document.items())},
+    }
+
+
+def compare(report, baseline, tolerance):
+    # Yields (document, message, regressed) for every document in both reports
+    for name, current in report["operations"].items():
+        before = baseline.get("operations", {}).get(name)
+        if before is None:
+            continue
+        slower = current["p95_ms"] > before["p95_ms"] * (1 + tolerance)
+        # Query counts don't depend on the machine, so any real increase is an N+1 or a lost cache. Writes vary a
+        # little with how many creates clash, hence the slack
+        more_queries = current["mean_queries"] > before["mean_queries"] + 1
+        message = "p95 {:.1f}ms -> {:.1f}ms ({:+.0%}), queries {:.1f} -> {:.1f}".format(
+            before["p95_ms"], current["p95_ms"], current["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0,
+            before["mean_queries"], current["mean_queries"])
+        yield name, message, slower or more_queries
+
+
+class Command(BaseCommand):
+    help = "Measures the GraphQL endpoint by replaying the frontend's queries and booking mutations at a target rate"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=float, default=30, help="Seconds to measure for (default 30)")
+        parser.add_argument('--warmup', type=float, default=3,
+                            help="Seconds to run before measuring, to fill the caches (default 3)")
+        parser.add_argument('--rate', type=float, default=0,
+                            help="Target requests a second across all processes (default 0, as fast as possible)")
+        parser.add_argument('--processes', type=int, default=1, help="Worker processes (default 1)")
+        parser.add_argument('--writes', type=float, default=0.1,
+                            help="Share of operations that create (and then delete) a booking (default 0.1)")
+        parser.add_argument('--weight', action='append', default=[], metavar="DOCUMENT=WEIGHT",
+                            help="Change how often a document is sent, e.g. ALL_BOOKINGS=0.1 (repeatable)")
+        parser.add_argument('--queries', default=QUERIES_FILE, help="File of gql documents to replay")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed")
+        parser.add_argument('--site', help="Send every request to this site (its ID or domain) instead of any site")
+        parser.add_argument('--no-document-cache', action='store_false', dest='document_cache',
+                            help="Parse and validate every request's document, rather than only the first of each")
+        parser.add_argument('--output', help="Write the report to this JSON file")
+        parser.add_argument('--compare', metavar="BASELINE", help="Compare against the JSON report of an earlier run, "
+                                                                  "and fail if any document got slower")
+        parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                            help=f"How much slower p95 may get before --compare fails (default {DEFAULT_TOLERANCE})")
+
+    def handle(self, *args, duration=30, warmup=3, rate=0, processes=1, writes=0.1, weight=(), queries=QUERIES_FILE,
+               seed=None, site=None, document_cache=True, output=None, compare=None, tolerance=DEFAULT_TOLERANCE,
+               **options):
+        if processes < 1 or duration <= 0 or not 0 <= writes <= 1:
+            raise CommandError("Needs at least one process, a positive duration and --writes between 0 and 1")
+        weights = {}
+        for item in weight:
+            name, _, value = item.partition("=")
+            try:
+                weights[name] = float(value)
+            except ValueError:
+                raise CommandError(f"Invalid weight {item}, expected DOCUMENT=WEIGHT")
+
+        baseline = None
+        if compare:
+            with open(compare) as f:
+                baseline = json.load(f)
+
+        if site is not None:
+            name = site
+            site = models.Site.objects.filter(**{"pk": name} if name.isdigit() else {"domain": name}).first()
+            if site is None:
+                raise CommandError(f"No site {name}")
+        workload = Workload(load_documents(queries), weights, writes, site=site)
+        interval = processes / rate if rate else 0
+        seed = seed if seed is not None else random.randrange(2 ** 32)
+        jobs = [(workload, duration, warmup, interval, seed + i, document_cache) for i in range(processes)]
+
+        self.stdout.write(f"Running {processes} process(es) for {warmup:g}s + {duration:g}s against "
+                          f"{models.Booking.objects.count()} bookings...")
+        if processes == 1:
+            samples = run_worker(*jobs[0])
+        else:
+            # Forked workers mustn't share the parent's database connections
+            connections.close_all()
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                samples = [row for rows in pool.starmap(run_worker, jobs) for row in rows]
+        if not samples:
+            raise CommandError("No requests completed")
+
+        report = {
+            "meta": {
+                "generated_at": datetime.now().isoformat(timespec="seconds"),
+                "duration_s": duration,
+                "warmup_s": warmup,
+                "processes": processes,
+                "target_rate": rate,
+                "write_fraction": writes,
+                "seed": seed,
+                "database": connection.vendor,
+                "read_replica": database.REPLICA in settings.DATABASES,
+                "conn_max_age": connection.settings_dict["CONN_MAX_AGE"],
+                "sqlite_pragmas": getattr(settings, "SQLITE_PRAGMAS", {}) if connection.vendor == "sqlite" else None,
+                "async_view": settings.GRAPHQL_ASYNC,
+                "document_cache": document_cache,
+                "sites": models.Site.objects.count(),
+                "site": site.pk if site is not None else None,
+                "bookings": models.Booking.objects.count(),
+                "site_bookings": models.Booking.objects.filter(site=site).count() if site is not None else None,
+            },
+            **summarise(samples, duration),
+        }
+        self.print_report(report)
+        if rate and report["total"]["throughput"] < rate * 0.95:
+            self.stdout.write(self.style.WARNING(
+                f"Only managed {report['total']['throughput']} of {rate:g} requests a second, so the server (or the "
+                f"driver) is saturated and the latencies are for a closed loop"))
+        if output:
+            with open(output, "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Wrote {output}")
+        if baseline is not None:
+            self.print_comparison(report, baseline, tolerance)
+
+    def print_report(self, report):
+        self.stdout.write("{:<28}{:>8}{:>9}{:>9}{:>9}{:>9}{:>9}  {}".format(
+            "document", "count", "req/s", "p50 ms", "p95 ms", "p99 ms", "queries", "outcomes"))
+        for name, stats in [*report["operations"].items(), ("total", report["total"])]:
+            self.stdout.write("{:<28}{:>8}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}  {}".format(
+                name, stats["count"], stats["throughput"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"],
+                stats["mean_queries"], " ".join(f"{k}={v}" for k, v in sorted(stats["outcomes"].items()))))
+
+    def print_comparison(self, report, baseline, tolerance):
+        regressions = 0
+        for name, message, regressed in compare(report, baseline, tolerance):
+            if regressed:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(f"{name}: {message}"))
+            else:
+                self.stdout.write(f"{name}: {message}")
+        if regressions:
+            raise CommandError(f"{regressions} document(s) regressed against the baseline")
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
@@ -0,0 +1,374 @@
+import json
+import multiprocessing
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection, connections
+from django.test import Client, override_settings
+from rest_framework.authtoken.models import Token
+
+from app import admission, models
+from app.management.commands.benchmark import CaptureAllQueries, _time, percentile
+from app.middleware import authenticate_token
+
+
+# Booking window rush benchmark ========================================================================================
+# Replays the moment a new day opens for booking, when --clients users all go for its evening slots at once. Each
+# client wants one hour on some court, with a first choice and --preferences fallbacks, and the same intents (made up
+# from --seed, or read from --intents) are sent two ways:
+#
+#   direct: createBooking for each choice in turn until one goes through, as the frontend does now
+#   queued: one requestBooking with every choice, then bookingRequest polls every --poll-interval seconds until it is
+#           decided, while the allocator (app/admission.py) runs in a process of its own
+#
+# The clients are shared between --processes worker processes, which all start at the same moment and send their
+# clients' requests through the Django test client, as the benchmark command does. The report has, for each mode, how
+# long until every client had an answer, the latency from the start to each client's answer, and the requests and SQL
+# queries it took, split into those that made a booking and those that were wasted (clashing createBookings and polls
+# of undecided requests).
+#
+# The bookings and requests it makes are deleted after each mode. Run it against a copy of the database filled by the
+# generate_data command, not a live one.
+
+DIRECT = "direct"
+QUEUED = "queued"
+
+CREATE_BOOKING = """
+mutation CreateBooking($courtId: ID!, $date: Date!, $startTime: Time!, $endTime: Time!) {
+    createBooking(courtId: $courtId, date: $date, startTime: $startTime, endTime: $endTime, description: "Rush") {
+        booking { id }
+    }
+}
+"""
+REQUEST_BOOKING = """
+mutation RequestBooking($courtId: ID!, $date: Date!, $startTime: Time!, $endTime: Time!,
+                        $preferences: [BookingPreferenceInput!]) {
+    requestBooking(courtId: $courtId, date: $date, startTime: $startTime, endTime: $endTime, description: "Rush",
+                   preferences: $preferences) {
+        bookingRequest { id status }
+    }
+}
+"""
+BOOKING_REQUEST = """
+query BookingRequest($id: ID!) {
+    bookingRequest(id: $id) { status booking { startTime court { id } } }
+}
+"""
+
+# Start hours people go for, with weights: mostly the evening
+START_HOURS = {7: 1, 8: 1, 9: 1, 10: 1, 11: 1, 12: 2, 13: 1, 14: 1, 15: 1, 16: 2, 17: 6, 18: 10, 19: 10, 20: 6}
+LENGTH = 60
+
+# Seconds the workers wait for each other (and the allocator) to be ready before the rush starts
+START_DELAY = 2
+
+
+def make_intents(courts, tokens, preferences, rng):
+    # [(token, [(court_id, start, end)])], one per client, in the order they arrive
+    slots = [
+        (court.id, hour * 60)
+        for court in courts for hour in START_HOURS
+        if court.opening_time.hour * 60 <= hour * 60 and (hour * 60 + LENGTH) <= court.closing_time.hour * 60
+    ]
+    weights = [START_HOURS[start // 60] for _, start in slots]
+    intents = []
+    for token in tokens:
+        choices = []
+        while len(choices) < min(preferences + 1, len(slots)):
+            court_id, start = rng.choices(slots, weights)[0]
+            if (court_id, _time(start), _time(start + LENGTH)) not in choices:
+                choices.append((court_id, _time(start), _time(start + LENGTH)))
+        intents.append((token, choices))
+    return intents
+
+
+class RushClient(object):
+    # Sends one worker's requests and records them as (client, kind, latency in ms, SQL queries, outcome)
+
+    def __init__(self):
+        self.client = Client()
+        self.requests = []
+
+    def post(self, client_index, kind, text, variables, token):
+        with CaptureAllQueries() as queries:
+            sent = time.perf_counter()
+            response = self.client.post("/graphql", json.dumps({"query": text, "variables": variables}),
+                                        content_type="application/json", HTTP_AUTHORIZATION="Token " + token)
+            latency = (time.perf_counter() - sent) * 1000
+        result = response.json() if response.status_code == 200 else {"errors": [response.status_code]}
+        self.requests.append([client_index, kind, latency, len(queries), "error" if result.get("errors") else "ok"])
+        return result
+
+
+def _wait_until(start_at):
+    delay = start_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def run_direct(intents, day, start_at):
+    # Returns ([(client, seconds to answer, booked, choice taken)], requests)
+    rush = RushClient()
+    for index, token, choices in intents:
+        authenticate_token(token)
+    answers = []
+    _wait_until(start_at)
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]):
+        for index, token, choices in intents:
+            booked = None
+            for rank, (court_id, start, end) in enumerate(choices):
+                result = rush.post(index, "createBooking", CREATE_BOOKING, {
+                    "courtId": court_id, "date": day, "startTime": start, "endTime": end}, token)
+                if (result.get("data") or {}).get("createBooking"):
+                    booked = rank
+                    break
+            answers.append((index, time.time() - start_at, booked is not None, booked))
+    return answers, rush.requests
+
+
+def run_queued(intents, day, start_at, poll_interval):
+    # Returns the same as run_direct
+    rush = RushClient()
+    for index, token, choices in intents:
+        authenticate_token(token)
+    answers = []
+    waiting = {}
+    _wait_until(start_at)
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]):
+        for index, token, choices in intents:
+            (court_id, start, end), fallbacks = choices[0], choices[1:]
+            result = rush.post(index, "requestBooking", REQUEST_BOOKING, {
+                "courtId": court_id, "date": day, "startTime": start, "endTime": end,
+                "preferences": [{"courtId": c, "startTime": s, "endTime": e} for c, s, e in fallbacks],
+            }, token)
+            request = ((result.get("data") or {}).get("requestBooking") or {}).get("bookingRequest")
+            if request is None:
+                answers.append((index, time.time() - start_at, False, None))
+            else:
+                waiting[index] = (request["id"], token, choices)
+
+        while waiting:
+            time.sleep(poll_interval)
+            for index, (request_id, token, choices) in list(waiting.items()):
+                result = rush.post(index, "bookingRequest", BOOKING_REQUEST, {"id": request_id}, token)
+                request = (result.get("data") or {}).get("bookingRequest")
+                if request is not None and request["status"] == models.BookingRequest.PENDING:
+                    rush.requests[-1][1] = "bookingRequest (pending)"
+                    continue
+                del waiting[index]
+                booking = (request or {}).get("booking")
+                rank = None
+                if booking is not None:
+                    taken = (booking["court"]["id"], booking["startTime"][:5])
+                    rank = [(str(court_id), start) for court_id, start, end in choices].index(taken)
+                answers.append((index, time.time() - start_at, booking is not None, rank))
+    return answers, rush.requests
+
+
+def run_allocator(queue, stop, start_at):
+    # Returns [(requests decided, seconds)] per pass that decided any
+    close_old_connections()
+    passes = []
+    _wait_until(start_at)
+    while not stop.is_set():
+        started = time.perf_counter()
+        accepted, rejected = admission.drain(queue)
+        if accepted or rejected:
+            passes.append((accepted + rejected, time.perf_counter() - started))
+        else:
+            stop.wait(queue["POLL_INTERVAL"])
+    return passes
+
+
+def _group(requests):
+    groups = {}
+    for row in requests:
+        groups.setdefault(row[1], []).append(row)
+    return groups
+
+
+def summarise(answers, requests, wall):
+    latencies = sorted(seconds * 1000 for _, seconds, _, _ in answers)
+    wasted = [row for row in requests if row[4] == "error" or row[1] == "bookingRequest (pending)"]
+    booked = sum(1 for _, _, ok, _ in answers if ok)
+    queries = sum(row[3] for row in requests)
+    return {
+        "clients": len(answers),
+        "booked": booked,
+        "without_booking": len(answers) - booked,
+        "first_choice": sum(1 for _, _, _, rank in answers if rank == 0),
+        "wall_s": round(wall, 3),
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "requests": len(requests),
+        "requests_by_kind": {
+            kind: {
+                "count": len(rows),
+                "mean_ms": round(sum(row[2] for row in rows) / len(rows), 2),
+                "mean_queries": round(sum(row[3] for row in rows) / len(rows), 2),
+            }
+            for kind, rows in _group(requests).items()
+        },
+        "wasted_requests": len(wasted),
+        "request_ms": round(sum(row[2] for row in requests), 1),
+        "wasted_ms": round(sum(row[2] for row in wasted), 1),
+        "queries": queries,
+        "wasted_queries": sum(row[3] for row in wasted),
+        "queries_per_booking": round(queries / booked, 2) if booked else None,
+    }
+
+
+class Command(BaseCommand):
+    help = "Replays the rush for a newly opened booking day, through createBooking and through the requestBooking queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200, help="Users booking at once (default 200)")
+        parser.add_argument('--courts', type=int, default=None, help="Only use the first this many courts")
+        parser.add_argument('--preferences', type=int, default=2,
+                            help="Fallback choices each client has after the first (default 2)")
+        parser.add_argument('--processes', type=int, default=4, help="Worker processes sending requests (default 4)")
+        parser.add_argument('--mode', choices=[DIRECT, QUEUED], action='append', default=None,
+                            help="Only run this mode (repeatable, default both)")
+        parser.add_argument('--order', choices=[admission.ARRIVAL, admission.LOTTERY], default=None,
+                            help="The queue's order (default BOOKING_QUEUE's ORDER)")
+        parser.add_argument('--lottery-window', type=float, default=None,
+                            help="Lottery round length in seconds (default BOOKING_QUEUE's LOTTERY_WINDOW)")
+        parser.add_argument('--poll-interval', type=float, default=0.2,
+                            help="Seconds between a client's bookingRequest polls (default 0.2)")
+        parser.add_argument('--allocator-interval', type=float, default=0.05,
+                            help="Seconds between the allocator's checks for requests (default 0.05)")
+        parser.add_argument('--date', dest='day', type=date.fromisoformat, default=None,
+                            help="Day being booked (default the last day the courts take bookings for)")
+        parser.add_argument('--clear', action='store_true',
+                            help="Delete the bookings already on that day and those courts first")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed for the intents")
+        parser.add_argument('--intents', help="Replay the intents in this JSON file, or save them there if it doesn't "
+                                              "exist yet")
+        parser.add_argument('--output', help="Write the report to this JSON file")
+
+    def handle(self, *args, clients=200, courts=None, preferences=2, processes=4, mode=None, order=None,
+               lottery_window=None, poll_interval=0.2, allocator_interval=0.05, day=None, clear=False, seed=None,
+               intents=None, output=None, **options):
+        if clients < 1 or processes < 1 or preferences < 0 or poll_interval <= 0 or allocator_interval <= 0:
+            raise CommandError("Needs at least one client and process, and positive intervals")
+        court_list = list(models.Court.objects.order_by('id')[:courts])
+        tokens = list(Token.objects.order_by('user_id').values_list('key', flat=True)[:clients])
+        if not court_list or len(tokens) < clients:
+            raise CommandError(f"Needs a court and {clients} users with auth tokens, see generate_data")
+        if day is None:
+            day = date.today() + timedelta(days=min(court.max_booking_days_in_advance or 0 for court in court_list))
+        court_ids = [court.id for court in court_list]
+
+        existing = models.Booking.objects.filter(court__in=court_ids, date=day)
+        if existing.exists():
+            if not clear:
+                raise CommandError(f"There are already bookings on {day}, rerun with --clear to delete them first")
+            existing.delete()
+
+        rush = self.load_intents(intents, court_list, tokens, preferences, seed)
+        queue = admission.get_settings()
+        queue.update(ALLOCATOR=admission.COMMAND, POLL_INTERVAL=allocator_interval)
+        if order is not None:
+            queue["ORDER"] = order
+        if lottery_window is not None:
+            queue["LOTTERY_WINDOW"] = lottery_window
+
+        report = {
+            "meta": {
+                "generated_at": datetime.now().isoformat(timespec="seconds"),
+                "date": day.isoformat(),
+                "courts": len(court_list),
+                "clients": len(rush),
+                "preferences": preferences,
+                "processes": processes,
+                "order": queue["ORDER"],
+                "lottery_window_s": queue["LOTTERY_WINDOW"],
+                "poll_interval_s": poll_interval,
+                "database": connection.vendor,
+            },
+        }
+        for name in mode or [DIRECT, QUEUED]:
+            self.stdout.write(f"{name}: {len(rush)} clients for {day} across {processes} process(es)...")
+            try:
+                report[name] = self.run_mode(name, rush, day.isoformat(), processes, queue, poll_interval)
+            finally:
+                # Deleted one by one, so the signals put the availability bitmaps and usage rollups back
+                models.BookingRequest.objects.filter(court__in=court_ids, date=day).delete()
+                models.Booking.objects.filter(court__in=court_ids, date=day).delete()
+
+        self.print_report(report)
+        if output:
+            with open(output, "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Wrote {output}")
+
+    def load_intents(self, path, courts, tokens, preferences, seed):
+        # [(client index, token, choices)]
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            intents = [(token, [tuple(choice) for choice in choices]) for token, choices in saved]
+        except (TypeError, FileNotFoundError):
+            intents = make_intents(courts, tokens, preferences, random.Random(seed))
+            if path:
+                with open(path, "w") as f:
+                    json.dump(intents, f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Can't read intents from {path}: {e}")
+        return [(index, token, choices) for index, (token, choices) in enumerate(intents)]
+
+    def run_mode(self, name, rush, day, processes, queue, poll_interval):
+        # Clients are dealt out in turn, so every worker has some of the earliest arrivals
+        shares = [rush[i::processes] for i in range(processes)]
+        start_at = time.time() + START_DELAY
+        if name == DIRECT:
+            jobs = [(share, day, start_at) for share in shares]
+            target = run_direct
+        else:
+            jobs = [(share, day, start_at, poll_interval) for share in shares]
+            target = run_queued
+
+        # Forked workers mustn't share the parent's database connections
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        with override_settings(BOOKING_QUEUE=queue), context.Manager() as manager, \
+                context.Pool(processes + 1) as pool:
+            allocator = None
+            if name == QUEUED:
+                stop = manager.Event()
+                allocator = pool.apply_async(run_allocator, (queue, stop, start_at))
+            results = pool.starmap(target, jobs)
+            wall = time.time() - start_at
+            passes = []
+            if allocator is not None:
+                stop.set()
+                passes = allocator.get()
+
+        answers = [answer for worker_answers, _ in results for answer in worker_answers]
+        requests = [request for _, worker_requests in results for request in worker_requests]
+        summary = summarise(answers, requests, wall)
+        if name == QUEUED:
+            summary["allocator_passes"] = len(passes)
+            summary["allocator_ms"] = round(sum(seconds for _, seconds in passes) * 1000, 1)
+        return summary
+
+    def print_report(self, report):
+        modes = [name for name in (DIRECT, QUEUED) if name in report]
+        rows = [
+            ("clients booked", "booked"), ("first choice", "first_choice"), ("without a booking", "without_booking"),
+            ("all answered (s)", "wall_s"), ("answer p50 (ms)", "p50_ms"), ("answer p95 (ms)", "p95_ms"),
+            ("answer p99 (ms)", "p99_ms"), ("requests", "requests"), ("wasted requests", "wasted_requests"),
+            ("request time (ms)", "request_ms"), ("wasted time (ms)", "wasted_ms"), ("SQL queries", "queries"),
+            ("wasted queries", "wasted_queries"), ("queries per booking", "queries_per_booking"),
+            ("allocator time (ms)", "allocator_ms"), ("allocator passes", "allocator_passes"),
+        ]
+        self.stdout.write("{:<24}".format("") + "".join(f"{name:>14}" for name in modes))
+        for label, key in rows:
+            values = [report[name].get(key) for name in modes]
+            if all(value is None for value in values):
+                continue
+            self.stdout.write(f"{label:<24}" + "".join(f"{'-' if v is None else v:>14}" for v in values))
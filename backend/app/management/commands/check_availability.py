@@ -0,0 +1,36 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+
+from app import availability, models
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the court availability bitmaps from Booking rows and reports any that differ from the stored ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--court', type=int, action='append', help="Only check this court ID (repeatable)")
+        parser.add_argument('--from', dest='from_date', type=date.fromisoformat, default=None,
+                            help="First day to check (YYYY-MM-DD, default today)")
+        parser.add_argument('--to', dest='to_date', type=date.fromisoformat, default=None,
+                            help="Last day to check (YYYY-MM-DD, default a year after --from)")
+        parser.add_argument('--fix', action='store_true', help="Rewrite the bitmaps that differ")
+
+    def handle(self, *args, court=None, from_date=None, to_date=None, fix=False, **options):
+        from_date = from_date or date.today()
+        to_date = to_date or from_date + timedelta(days=365)
+        courts = models.Court.objects.all()
+        if court:
+            courts = courts.filter(id__in=court)
+
+        diffs = availability.check(courts, from_date, to_date, fix=fix)
+        for court, day, stored, actual in diffs:
+            stored = "missing or stale" if stored is None else format(stored, 'b')
+            self.stdout.write(f"{court.name} {day}: stored {stored}, bookings give {format(actual, 'b')}")
+
+        if not diffs:
+            self.stdout.write(self.style.SUCCESS("Availability index matches bookings"))
+        elif fix:
+            self.stdout.write(self.style.WARNING(f"Rebuilt {len(diffs)} day(s)"))
+        else:
+            self.stdout.write(self.style.ERROR(f"{len(diffs)} day(s) differ, rerun with --fix to rebuild them"))
@@ -0,0 +1,182 @@
+import random
+from datetime import date, time, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from app import analytics, availability, cache, models
+
+
+# Synthetic dataset for load testing ===================================================================================
+# Courts, users (some of them captains, all with an auth token for the benchmark command) and years of bookings,
+# shaped roughly like a real club: busy evenings and weekends, mostly hour-long games, and captains booking longer
+# training sessions. Everything is inserted with bulk_create, so no signals run and the availability bitmaps and usage
+# rollups are written directly, under the day locks, as CreateBookings does.
+#
+# The courts go on the first site (made if there is none), or with --sites on that many new sites, each with --courts
+# courts and its own bookings by the same users, for measuring one site among many (see benchmark --site).
+
+USERNAME_PREFIX = "synthetic-"
+COURT_PREFIX = "Synthetic court "
+SITE_PREFIX = "Synthetic site "
+SITE_DOMAIN = "synthetic-{}.example.com"
+
+FIRST_NAMES = ["Alex", "Sam", "Charlie", "Jo", "Priya", "Tom", "Aisha", "Ben", "Chen", "Eve", "Femi", "Hannah",
+               "Ibrahim", "Kate", "Luca", "Maria", "Noah", "Olga", "Ravi", "Sofia", "Yusuf", "Zoe"]
+LAST_NAMES = ["Smith", "Jones", "Patel", "Williams", "Brown", "Khan", "Taylor", "Wilson", "Evans", "Chen", "Murphy",
+              "Okafor", "Novak", "Rossi", "Garcia", "Walker", "Hughes", "Ahmed"]
+DESCRIPTIONS = ["Training", "Team practice", "League match", "Coaching", "Friendly", "Ladder match"]
+
+# Booking lengths in minutes, with weights: members mostly play for an hour, captains run longer sessions
+MEMBER_LENGTHS = ((60, 6), (90, 2), (120, 1))
+CAPTAIN_LENGTHS = ((90, 2), (120, 3), (180, 1))
+AVERAGE_LENGTH = 80
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = "Fills the database with synthetic courts, users and bookings for load testing (see the benchmark command)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--courts', type=int, default=6, help="Number of courts (per site, default 6)")
+        parser.add_argument('--sites', type=int, default=0,
+                            help="Make this many sites with --courts courts each, instead of using the first site")
+        parser.add_argument('--users', type=int, default=500, help="Number of users (default 500)")
+        parser.add_argument('--captains', type=int, default=20, help="How many of the users are captains (default 20)")
+        parser.add_argument('--years', type=float, default=2, help="Years of past bookings (default 2)")
+        parser.add_argument('--days-ahead', type=int, default=14,
+                            help="Days of future bookings, up to the courts' booking window (default 14)")
+        parser.add_argument('--occupancy', type=float, default=0.6,
+                            help="Rough share of court time that is booked, 0 to 1 (default 0.6)")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed, for a reproducible dataset")
+        parser.add_argument('--clear', action='store_true',
+                            help="Delete previously generated courts and users (and so their bookings) first")
+
+    def handle(self, *args, courts=6, sites=0, users=500, captains=20, years=2, days_ahead=14, occupancy=0.6,
+               seed=None, clear=False, **options):
+        if captains > users:
+            raise CommandError("There can't be more captains than users")
+        if not 0 <= occupancy <= 1:
+            raise CommandError("Occupancy must be between 0 and 1")
+        rng = random.Random(seed)
+
+        if clear:
+            deleted, _ = models.Site.objects.filter(name__startswith=SITE_PREFIX).delete()
+            deleted += models.Court.objects.filter(name__startswith=COURT_PREFIX).delete()[0]
+            deleted_users, _ = User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+            self.stdout.write(f"Deleted {deleted + deleted_users} previously generated row(s)")
+        elif User.objects.filter(username__startswith=USERNAME_PREFIX).exists():
+            raise CommandError("Generated data already exists, rerun with --clear to replace it")
+
+        members = self.create_users(users, captains, rng)
+        captain_ids = {user.id for user in members[:captains]}
+        if sites:
+            site_list = self.create_sites(sites)
+        else:
+            site_list = [models.Site.objects.order_by('id').first() or self.create_sites(1)[0]]
+        court_list = [court for site in site_list for court in self.create_courts(site, courts)]
+
+        today = date.today()
+        from_date = today - timedelta(days=round(years * 365))
+        total = 0
+        for court in court_list:
+            to_date = today + timedelta(days=min(days_ahead, court.max_booking_days_in_advance or days_ahead))
+            total += self.create_bookings(court, members, captain_ids, from_date, to_date, occupancy, rng)
+            self.stdout.write(f"{court.site.name}, {court.name}: bookings up to {to_date}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(court_list)} court(s) on {len(site_list)} site(s), {len(members)} user(s) ({captains} "
+            f"captains) and {total} booking(s)"))
+
+    def create_users(self, count, captains, rng):
+        # Every generated user shares one unusable password, since hashing a real one per user would take minutes
+        password = make_password(None)
+        User.objects.bulk_create([
+            User(
+                username=f"{USERNAME_PREFIX}{i}",
+                first_name=rng.choice(FIRST_NAMES),
+                last_name=rng.choice(LAST_NAMES),
+                email=f"{USERNAME_PREFIX}{i}@example.com",
+                password=password,
+            )
+            for i in range(count)
+        ], batch_size=BATCH_SIZE)
+        # bulk_create only returns primary keys on some databases
+        users = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('id'))
+        Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in users],
+                                  batch_size=BATCH_SIZE)
+        group, _ = Group.objects.get_or_create(name="captain")
+        group.user_set.add(*users[:captains])
+        return users
+
+    def create_sites(self, count):
+        start = models.Site.objects.filter(name__startswith=SITE_PREFIX).count()
+        models.Site.objects.bulk_create([
+            models.Site(name=f"{SITE_PREFIX}{start + i + 1}", description="Generated for load testing",
+                        domain=SITE_DOMAIN.format(start + i + 1))
+            for i in range(count)
+        ])
+        sites = list(models.Site.objects.filter(name__startswith=SITE_PREFIX).order_by('id')[start:])
+        # bulk_create skips the signal that would drop the cached sites
+        cache.invalidate_site()
+        return sites
+
+    def create_courts(self, site, count):
+        courts = site.courts.filter(name__startswith=COURT_PREFIX)
+        start = courts.count()
+        for i in range(count):
+            models.Court.objects.create(
+                site=site, name=f"{COURT_PREFIX}{start + i + 1}", opening_time=time(7, 0), closing_time=time(22, 0))
+        return list(courts.select_related('site').order_by('id')[start:])
+
+    def create_bookings(self, court, users, captain_ids, from_date, to_date, occupancy, rng):
+        bookings = []
+        day = from_date
+        while day <= to_date:
+            bookings.extend(self.day_bookings(court, users, captain_ids, day, occupancy, rng))
+            day += timedelta(days=1)
+
+        with transaction.atomic():
+            models.CourtDayLock.acquire_many(court.id, {booking.date for booking in bookings})
+            models.Booking.objects.bulk_create(bookings, batch_size=BATCH_SIZE)
+            availability.mark_booked_many(court, bookings)
+            analytics.add_bookings(bookings)
+        return len(bookings)
+
+    def day_bookings(self, court, users, captain_ids, day, occupancy, rng):
+        # Walks the day in half hours, starting a booking at each free one with the probability that books about
+        # occupancy of the day given the average booking length, more in the evening and at weekends and less
+        # otherwise
+        opening = court.opening_time.hour * 60 + court.opening_time.minute
+        closing = court.closing_time.hour * 60 + court.closing_time.minute
+        weekend = day.weekday() >= 5
+        minute = opening
+        while minute < closing:
+            target = min(0.95, occupancy * (1.3 if weekend or minute >= 17 * 60 else 0.8))
+            if rng.random() >= 30 * target / (AVERAGE_LENGTH * (1 - target) + 30 * target):
+                minute += 30
+                continue
+            user = rng.choice(users)
+            lengths = CAPTAIN_LENGTHS if user.id in captain_ids else MEMBER_LENGTHS
+            length = rng.choices([length for length, _ in lengths], [weight for _, weight in lengths])[0]
+            length = max(length, court.min_booking_length_minutes or 0)
+            if minute + length > closing:
+                break
+            yield models.Booking(
+                court=court,
+                site_id=court.site_id,
+                user=user,
+                date=day,
+                start_time=_time(minute),
+                end_time=_time(minute + length),
+                description=rng.choice(DESCRIPTIONS) if user.id in captain_ids or rng.random() < 0.1 else "",
+            )
+            minute += length
+
+
+def _time(minutes):
+    return time(minutes // 60, minutes % 60)
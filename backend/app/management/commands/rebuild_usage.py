@@ -0,0 +1,27 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from app import analytics, models
+
+
+class Command(BaseCommand):
+    help = "Recounts the DailyCourtUsage rollups from the live and archived bookings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--court', type=int, action='append', help="Only rebuild this court ID (repeatable)")
+        parser.add_argument('--from', dest='from_date', type=date.fromisoformat, default=date.min,
+                            help="First day to rebuild (YYYY-MM-DD, default the first booking)")
+        parser.add_argument('--to', dest='to_date', type=date.fromisoformat, default=date.max,
+                            help="Last day to rebuild (YYYY-MM-DD, default the last booking)")
+
+    def handle(self, *args, court=None, from_date=date.min, to_date=date.max, **options):
+        courts = models.Court.objects.all()
+        if court:
+            courts = courts.filter(id__in=court)
+        total = 0
+        for court in courts:
+            rows = analytics.rebuild(court, from_date, to_date)
+            total += rows
+            self.stdout.write(f"{court.name}: {rows} row(s)")
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {total} usage row(s)"))
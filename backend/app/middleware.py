@@ -1,6 +1,93 @@
+import asyncio
+import time
+from inspect import isawaitable
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Prefetch
 from rest_framework.authtoken.models import Token
 
 
+# Process-wide cache of token key -> (expiry, user, group names), so repeat requests with the same token cost no
+# queries. Entries are dropped by the signal handlers in app/signals.py when the token is deleted or the user or
+# their groups change. Other worker processes only see a change once their own entry expires, which is what
+# AUTH_TOKEN_CACHE_TTL bounds. Set it to 0 to disable the cache.
+#
+# Tokens and groups are always read from "default", even while a GraphQL query's reads go to the replica (see
+# app/database.py), so a new token or group works from the very next request.
+_token_cache = {}
+
+
+def _token_cache_ttl():
+    return getattr(settings, "AUTH_TOKEN_CACHE_TTL", 0)
+
+
+def authenticate_token(key):
+    entry = _token_cache.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1], entry[2]
+
+    # One query for the token and its user, one for the user's groups
+    token = Token.objects.using(DEFAULT_DB_ALIAS).select_related('user').prefetch_related(
+        Prefetch('user__groups', queryset=Group.objects.using(DEFAULT_DB_ALIAS))).get(key=key)
+    user = token.user
+    groups = [g.name for g in user.groups.all()]
+
+    ttl = _token_cache_ttl()
+    if ttl:
+        _token_cache[key] = (time.monotonic() + ttl, user, groups)
+    return user, groups
+
+
+def authenticate_request(request):
+    # Authenticates the request's auth token up front, as DRFAuthorizationMiddleware would from its first resolver,
+    # so the view knows who is asking before running anything (see client_key in app/limits.py). Unknown tokens leave
+    # the request anonymous, for the middleware to report
+    auth_header = request.META.get("HTTP_AUTHORIZATION", "")
+    if request.user.is_authenticated or not auth_header.startswith("Token "):
+        return
+    try:
+        request.user, request.user_groups = authenticate_token(auth_header[len("Token "):])
+    except Token.DoesNotExist:
+        pass
+
+
+def invalidate_token(key):
+    _token_cache.pop(key, None)
+
+
+def invalidate_user(user_id=None):
+    # Drops every cached token for a user, or the whole cache if no user is given
+    for key, entry in list(_token_cache.items()):
+        if user_id is None or entry[1].pk == user_id:
+            _token_cache.pop(key, None)
+
+
+def get_group_names(request):
+    # Group names for the request's user, looked up at most once per request
+    if not hasattr(request, "user_groups"):
+        user = request.user
+        request.user_groups = [g.name for g in user.groups.using(DEFAULT_DB_ALIAS)] if user.is_authenticated else []
+    return request.user_groups
+
+
+async def aget_group_names(request):
+    if not hasattr(request, "user_groups"):
+        await sync_to_async(get_group_names)(request)
+    return request.user_groups
+
+
+def _on_event_loop():
+    # True while resolving under async execution, where the ORM may only be used through sync_to_async
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
 # This graphene middleware adds the request's auth token into info.context, if it exists
 class DRFAuthorizationMiddleware(object):
     def __init__(self):
@@ -14,6 +101,14 @@ class DRFAuthorizationMiddleware(object):
         auth_header = info.context.META.get("HTTP_AUTHORIZATION")
         if auth_header:
             token = auth_header.split('Token ')[1]
-            user = Token.objects.get(key=token).user
-            info.context.user = user
+            if _on_event_loop():
+                return self.resolve_async(token, next, root, info, **args)
+            info.context.user, info.context.user_groups = authenticate_token(token)
         return next(root, info, **args)
+
+    async def resolve_async(self, token, next, root, info, **args):
+        info.context.user, info.context.user_groups = await sync_to_async(authenticate_token)(token)
+        result = next(root, info, **args)
+        if isawaitable(result):
+            result = await result
+        return result
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.5 on 2026-10-17 20:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='booking',
+            options={'ordering': ['date', 'start_time'], 'verbose_name': 'booking', 'verbose_name_plural': 'Bookings'},
+        ),
+        migrations.AddField(
+            model_name='court',
+            name='max_booking_days_in_advance',
+            field=models.IntegerField(blank=True, default=14, null=True, verbose_name='Maximum days in advance for non-captains'),
+        ),
+        migrations.AddField(
+            model_name='court',
+            name='max_booking_length_minutes',
+            field=models.IntegerField(blank=True, default=180, null=True, verbose_name='Maximum booking length (minutes) for non-captains'),
+        ),
+        migrations.AddField(
+            model_name='court',
+            name='min_booking_length_minutes',
+            field=models.IntegerField(default=60, verbose_name='Minimum booking length (minutes)'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['court', 'date', 'start_time', 'end_time'], name='booking_court_date_time_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-17 20:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_booking_court_date_time_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourtDayLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('court', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.court')),
+            ],
+            options={
+                'verbose_name': 'court day lock',
+                'verbose_name_plural': 'Court day locks',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='courtdaylock',
+            constraint=models.UniqueConstraint(fields=('court', 'date'), name='unique_court_day_lock'),
+        ),
+    ]
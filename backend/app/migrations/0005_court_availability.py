@@ -0,0 +1,33 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_booking_date_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourtAvailability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('opening_time', models.TimeField()),
+                ('slot_minutes', models.PositiveIntegerField()),
+                ('bitmap', models.BinaryField(default=b'')),
+                ('court', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.court')),
+            ],
+            options={
+                'verbose_name': 'court availability',
+                'verbose_name_plural': 'Court availability',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='courtavailability',
+            constraint=models.UniqueConstraint(fields=('court', 'date'), name='unique_court_availability'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.5 on 2026-10-17 22:20
+
+from django.db import migrations
+
+from app.availability import mask, slot_minutes
+
+
+def backfill(apps, schema_editor):
+    # Bookings made before the availability index existed have no bitmap, which would read as free
+    Court = apps.get_model('app', 'Court')
+    Booking = apps.get_model('app', 'Booking')
+    CourtAvailability = apps.get_model('app', 'CourtAvailability')
+
+    for court in Court.objects.all():
+        days = {}
+        for date, start_time, end_time in Booking.objects.filter(court=court).order_by().values_list(
+                'date', 'start_time', 'end_time').iterator():
+            days[date] = days.get(date, 0) | mask(court, start_time, end_time)
+        CourtAvailability.objects.filter(court=court).delete()
+        CourtAvailability.objects.bulk_create([
+            CourtAvailability(
+                court=court, date=date, opening_time=court.opening_time, slot_minutes=slot_minutes(court),
+                bitmap=bits.to_bytes((bits.bit_length() + 7) // 8, 'little'),
+            )
+            for date, bits in days.items()
+        ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_court_availability'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
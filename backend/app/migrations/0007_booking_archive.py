@@ -0,0 +1,37 @@
+# Generated by Django 4.2.5 on 2026-10-17 20:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0006_backfill_court_availability'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('booking_id', models.PositiveBigIntegerField(unique=True, verbose_name='Original booking ID')),
+                ('start_time', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('date', models.DateField()),
+                ('created_at', models.DateTimeField()),
+                ('description', models.TextField(blank=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('court', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_bookings', to='app.court')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_bookings', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'archived booking',
+                'verbose_name_plural': 'Archived bookings',
+                'ordering': ['date', 'start_time'],
+                'indexes': [models.Index(fields=['date'], name='archive_date_idx'), models.Index(fields=['court', 'date'], name='archive_court_date_idx'), models.Index(fields=['user', 'date'], name='archive_user_date_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_booking_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyCourtUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('hour', models.PositiveSmallIntegerField()),
+                ('booked_minutes', models.PositiveIntegerField(default=0)),
+                ('bookings', models.PositiveIntegerField(default=0, verbose_name='Bookings starting in this hour')),
+                ('court', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.court')),
+            ],
+            options={
+                'verbose_name': 'daily court usage',
+                'verbose_name_plural': 'Daily court usage',
+                'indexes': [models.Index(fields=['date'], name='usage_date_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailycourtusage',
+            constraint=models.UniqueConstraint(fields=('court', 'date', 'hour'), name='unique_daily_court_usage'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:12
+
+from django.db import migrations
+
+from app.analytics import hour_minutes
+
+
+def backfill(apps, schema_editor):
+    # Counts every existing booking, live and archived, into the usage rollups
+    Court = apps.get_model('app', 'Court')
+    Booking = apps.get_model('app', 'Booking')
+    BookingArchive = apps.get_model('app', 'BookingArchive')
+    DailyCourtUsage = apps.get_model('app', 'DailyCourtUsage')
+
+    for court in Court.objects.all():
+        totals = {}
+        for model in (Booking, BookingArchive):
+            for date, start_time, end_time in model.objects.filter(court=court).order_by().values_list(
+                    'date', 'start_time', 'end_time').iterator():
+                for hour, minutes in hour_minutes(start_time, end_time).items():
+                    totals.setdefault((date, hour), [0, 0])[0] += minutes
+                totals.setdefault((date, start_time.hour), [0, 0])[1] += 1
+        DailyCourtUsage.objects.filter(court=court).delete()
+        DailyCourtUsage.objects.bulk_create([
+            DailyCourtUsage(court=court, date=date, hour=hour, booked_minutes=minutes, bookings=count)
+            for (date, hour), (minutes, count) in totals.items()
+        ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_daily_court_usage'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-17 20:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_backfill_daily_court_usage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['date', 'start_time'], name='booking_date_time_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='booking',
+            name='booking_date_idx',
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.5 on 2026-10-17 20:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0010_booking_date_time_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('start_time', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('description', models.TextField(blank=True)),
+                ('preferences', models.JSONField(blank=True, default=list)),
+                ('bypass_limits', models.BooleanField(default=False)),
+                ('lottery_key', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('ACCEPTED', 'Accepted'), ('REJECTED', 'Rejected')], default='PENDING', max_length=8)),
+                ('reason', models.TextField(blank=True, verbose_name='Reason for rejection')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('decided_at', models.DateTimeField(blank=True, null=True)),
+                ('booking', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='app.booking')),
+                ('court', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='booking_requests', to='app.court')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='booking_requests', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'booking request',
+                'verbose_name_plural': 'Booking requests',
+                'indexes': [models.Index(fields=['status', 'created_at'], name='request_status_created_idx'), models.Index(fields=['user', 'status'], name='request_user_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_booking_request'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='logo_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
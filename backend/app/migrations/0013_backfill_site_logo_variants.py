@@ -0,0 +1,29 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:13
+
+from django.db import migrations
+
+from app.images import make_variants
+
+
+def backfill(apps, schema_editor):
+    # Makes the variants of every existing logo whose file is there to read
+    Site = apps.get_model('app', 'Site')
+    for site in Site.objects.exclude(logo=''):
+        try:
+            with site.logo.open('rb') as logo:
+                data = logo.read()
+        except FileNotFoundError:
+            continue
+        site.logo_variants = make_variants(data, site.logo.name)
+        site.save(update_fields=['logo_variants'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_site_logo_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_backfill_site_logo_variants'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='booking',
+            name='booking_court_date_time_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='booking',
+            name='booking_user_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='booking',
+            name='booking_date_time_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='bookingarchive',
+            name='archive_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='bookingarchive',
+            name='archive_court_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='bookingarchive',
+            name='archive_user_date_idx',
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='site',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.site'),
+        ),
+        migrations.AddField(
+            model_name='bookingarchive',
+            name='site',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.site'),
+        ),
+        migrations.AddField(
+            model_name='court',
+            name='site',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='courts', to='app.site'),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='domain',
+            field=models.CharField(blank=True, max_length=253, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['site', 'court', 'date', 'start_time', 'end_time'], name='booking_site_court_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['site', 'date', 'start_time'], name='booking_site_date_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['site', 'user', 'date', 'start_time'], name='booking_site_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookingarchive',
+            index=models.Index(fields=['site', 'date'], name='archive_site_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookingarchive',
+            index=models.Index(fields=['site', 'court', 'date'], name='archive_site_court_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookingarchive',
+            index=models.Index(fields=['site', 'user', 'date', 'start_time'], name='archive_site_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='court',
+            index=models.Index(fields=['site', 'name'], name='court_site_name_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:14
+
+from django.db import migrations
+
+
+def backfill(apps, schema_editor):
+    # Everything so far belongs to the one site there was (making it if there is none yet)
+    Site = apps.get_model('app', 'Site')
+    Court = apps.get_model('app', 'Court')
+    Booking = apps.get_model('app', 'Booking')
+    BookingArchive = apps.get_model('app', 'BookingArchive')
+
+    if not Court.objects.exists():
+        return
+    site = Site.objects.order_by('id').first()
+    if site is None:
+        site = Site.objects.create(name="Court booking", description="")
+    Court.objects.update(site=site)
+    Booking.objects.update(site=site)
+    BookingArchive.objects.update(site=site)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_site_scoping'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
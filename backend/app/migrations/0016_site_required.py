@@ -0,0 +1,29 @@
+# Generated by Django 4.2.5 on 2026-10-17 21:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_backfill_site_scoping'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='booking',
+            name='site',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.site'),
+        ),
+        migrations.AlterField(
+            model_name='bookingarchive',
+            name='site',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.site'),
+        ),
+        migrations.AlterField(
+            model_name='court',
+            name='site',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='courts', to='app.site'),
+        ),
+    ]
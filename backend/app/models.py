@@ -1,13 +1,38 @@
+from contextvars import ContextVar
+
 from django.contrib.auth.models import User, AnonymousUser
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from datetime import timedelta
 
 
 # Create your models here.
+
+# The Site the current request is for, set by app.sites.SiteMiddleware (and for subscriptions by app/websockets.py).
+# Outside a request (management commands, the booking allocator) it is None
+current_site = ContextVar("current_site", default=None)
+
+
+class SiteScopedManager(models.Manager):
+    """
+    Only sees the current site's rows, so every query made while serving a request is scoped to its site without
+    having to say so. Related objects (booking.court) are still fetched with the plain base manager.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        site = current_site.get()
+        return queryset if site is None else queryset.filter(site_id=site.pk)
+
+
 class Site(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
     logo = models.ImageField(upload_to='site/logo')
+    # Resized copies of the logo, made when it changes (see app/images.py)
+    logo_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # Requests for this host name (or with it, or the site's ID, in the X-Site header) are for this site. Any other
+    # host gets the first site
+    domain = models.CharField(max_length=253, unique=True, null=True, blank=True)
 
     class Meta:
         verbose_name = "site"
@@ -18,6 +43,7 @@ class Site(models.Model):
 
 
 class Court(models.Model):
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name="courts")
     name = models.CharField(max_length=100)
     opening_time = models.TimeField()
     closing_time = models.TimeField()
@@ -28,6 +54,11 @@ class Court(models.Model):
     class Meta:
         verbose_name = "court"
         verbose_name_plural = "Courts"
+        indexes = [
+            models.Index(fields=["site", "name"], name="court_site_name_idx"),
+        ]
+
+    objects = SiteScopedManager()
 
     def __str__(self):
         return self.name
@@ -42,11 +73,206 @@ class Booking(models.Model):
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     court = models.ForeignKey(Court, on_delete=models.CASCADE)
+    # Always the court's site, copied here so a site's bookings can be read without going through its courts
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, editable=False, related_name="+")
 
     class Meta:
         verbose_name = "booking"
         verbose_name_plural = "Bookings"
         ordering = ["date", "start_time"]
+        indexes = [
+            # Every index leads with the site, which the default manager always filters on, so one site's reads stay
+            # within its own rows however many other sites there are. Queries made outside a request have to filter
+            # on the site themselves to use them.
+            # Covers the clash check in CreateBooking, which is a range query within one court and day
+            models.Index(fields=["site", "court", "date", "start_time", "end_time"],
+                         name="booking_site_court_time_idx"),
+            # Date-windowed calendar and per-user listings. Also gives the date, start_time ordering (and the admin's
+            # reverse of it) without a sort
+            models.Index(fields=["site", "date", "start_time"], name="booking_site_date_time_idx"),
+            models.Index(fields=["site", "user", "date", "start_time"], name="booking_site_user_date_idx"),
+        ]
+
+    objects = SiteScopedManager()
 
     def __str__(self):
         return f'{self.court.name}: {self.date.strftime("%d %b")} {self.start_time.strftime("%H:%M")} - {self.end_time.strftime("%H:%M")} ({self.user.email})'
+
+
+class CourtDayLock(models.Model):
+    """
+    One row per court and day, used to serialise writers to that court's bookings.
+
+    acquire() must run inside transaction.atomic() and before any other query in the transaction. Its
+    UPDATE takes a row lock on PostgreSQL and the database write lock on SQLite, so a second writer
+    waits until the first commits instead of both passing the clash check.
+    """
+    court = models.ForeignKey(Court, on_delete=models.CASCADE)
+    date = models.DateField()
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "court day lock"
+        verbose_name_plural = "Court day locks"
+        constraints = [
+            models.UniqueConstraint(fields=["court", "date"], name="unique_court_day_lock"),
+        ]
+
+    def __str__(self):
+        return f'{self.court_id}: {self.date}'
+
+    @classmethod
+    def acquire(cls, court_id, date):
+        if cls.objects.filter(court_id=court_id, date=date).update(version=models.F('version') + 1):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(court_id=court_id, date=date)
+        except IntegrityError:
+            # Another writer created the row first, so wait on its lock instead
+            cls.objects.filter(court_id=court_id, date=date).update(version=models.F('version') + 1)
+
+    @classmethod
+    def acquire_many(cls, court_id, dates):
+        # acquire() for several days of one court in a handful of queries, with the same first-statement rule
+        dates = set(dates)
+        cls.objects.filter(court_id=court_id, date__in=dates).update(version=models.F('version') + 1)
+        missing = dates - set(cls.objects.filter(court_id=court_id, date__in=dates).values_list('date', flat=True))
+        if missing:
+            cls.objects.bulk_create([cls(court_id=court_id, date=date) for date in missing], ignore_conflicts=True)
+            cls.objects.filter(court_id=court_id, date__in=missing).update(version=models.F('version') + 1)
+
+
+class CourtAvailability(models.Model):
+    """
+    Bitmap of the booked slots for one court on one day, kept in step with Booking by app/availability.py.
+
+    Bit i is set when some booking overlaps the i-th slot of slot_minutes starting at opening_time. Days with no
+    row have no bookings. A row whose opening_time or slot_minutes no longer match the court is stale and is
+    rebuilt when next read.
+    """
+    court = models.ForeignKey(Court, on_delete=models.CASCADE)
+    date = models.DateField()
+    opening_time = models.TimeField()
+    slot_minutes = models.PositiveIntegerField()
+    bitmap = models.BinaryField(default=b'')
+
+    class Meta:
+        verbose_name = "court availability"
+        verbose_name_plural = "Court availability"
+        constraints = [
+            models.UniqueConstraint(fields=["court", "date"], name="unique_court_availability"),
+        ]
+
+    def __str__(self):
+        return f'{self.court_id}: {self.date}'
+
+    @property
+    def bits(self):
+        return int.from_bytes(self.bitmap, 'little')
+
+    @bits.setter
+    def bits(self, value):
+        self.bitmap = value.to_bytes((value.bit_length() + 7) // 8, 'little')
+
+
+class BookingArchive(models.Model):
+    """
+    A past booking moved out of Booking by the archive_bookings command (see app/archive.py), so the live table only
+    holds recent and future bookings.
+    """
+    booking_id = models.PositiveBigIntegerField(unique=True, verbose_name="Original booking ID")
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    date = models.DateField()
+    created_at = models.DateTimeField()
+    description = models.TextField(blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="archived_bookings")
+    court = models.ForeignKey(Court, on_delete=models.CASCADE, related_name="archived_bookings")
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, editable=False, related_name="+")
+
+    class Meta:
+        verbose_name = "archived booking"
+        verbose_name_plural = "Archived bookings"
+        ordering = ["date", "start_time"]
+        indexes = [
+            # Usage reports over a date range, for the current site overall or per court or user
+            models.Index(fields=["site", "date"], name="archive_site_date_idx"),
+            models.Index(fields=["site", "court", "date"], name="archive_site_court_date_idx"),
+            models.Index(fields=["site", "user", "date", "start_time"], name="archive_site_user_date_idx"),
+        ]
+
+    objects = SiteScopedManager()
+
+    def __str__(self):
+        return f'{self.court_id}: {self.date} {self.start_time.strftime("%H:%M")} - {self.end_time.strftime("%H:%M")}'
+
+
+class DailyCourtUsage(models.Model):
+    """
+    Booked minutes on one court in one hour of one day, kept in step with Booking (and BookingArchive) by
+    app/analytics.py, so usage reports sum a few rows per day instead of reading every booking.
+    """
+    court = models.ForeignKey(Court, on_delete=models.CASCADE)
+    date = models.DateField()
+    hour = models.PositiveSmallIntegerField()
+    booked_minutes = models.PositiveIntegerField(default=0)
+    bookings = models.PositiveIntegerField(default=0, verbose_name="Bookings starting in this hour")
+
+    class Meta:
+        verbose_name = "daily court usage"
+        verbose_name_plural = "Daily court usage"
+        constraints = [
+            models.UniqueConstraint(fields=["court", "date", "hour"], name="unique_daily_court_usage"),
+        ]
+        indexes = [
+            models.Index(fields=["date"], name="usage_date_idx"),
+        ]
+
+    def __str__(self):
+        return f'{self.court_id}: {self.date} {self.hour:02d}:00'
+
+
+class BookingRequest(models.Model):
+    """
+    A booking asked for with requestBooking, queued until the allocator (see app/admission.py) books the first of its
+    choices that is still free or turns it down.
+    """
+    PENDING = "PENDING"
+    ACCEPTED = "ACCEPTED"
+    REJECTED = "REJECTED"
+    STATUSES = [(PENDING, "Pending"), (ACCEPTED, "Accepted"), (REJECTED, "Rejected")]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="booking_requests")
+    court = models.ForeignKey(Court, on_delete=models.CASCADE, related_name="booking_requests")
+    date = models.DateField()
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    description = models.TextField(blank=True)
+    # Fallbacks on the same day, tried in order when the first choice is taken: [[court_id, start_time, end_time]]
+    preferences = models.JSONField(default=list, blank=True)
+    # Captains and admins skip the court limits, as with createBooking. Decided when the request is made
+    bypass_limits = models.BooleanField(default=False)
+    # Random draw, which orders the requests of one round when the queue is a lottery
+    lottery_key = models.PositiveIntegerField()
+    status = models.CharField(max_length=8, choices=STATUSES, default=PENDING)
+    reason = models.TextField(blank=True, verbose_name="Reason for rejection")
+    booking = models.OneToOneField(Booking, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    created_at = models.DateTimeField(auto_now_add=True)
+    decided_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "booking request"
+        verbose_name_plural = "Booking requests"
+        indexes = [
+            # The allocator reads the pending requests in arrival order
+            models.Index(fields=["status", "created_at"], name="request_status_created_idx"),
+            # Caps how many requests each user can have pending
+            models.Index(fields=["user", "status"], name="request_user_status_idx"),
+        ]
+
+    def __str__(self):
+        return f'{self.court_id}: {self.date} {self.start_time.strftime("%H:%M")} - ' \
+               f'{self.end_time.strftime("%H:%M")} ({self.status})'
@@ -1,7 +1,58 @@
+import secrets
 from datetime import datetime, timedelta
+from asgiref.sync import sync_to_async
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 import graphene
-from app import models, types
+from app import analytics, availability, cache, ical, models, pubsub, types
+from app.middleware import aget_group_names, get_group_names
+
+
+# Checks shared by every way of creating bookings. Each raises ValueError describing the first rule broken
+
+def check_booking_times(court, date, start_time, end_time):
+
+    # Check the start and end time are within the opening hours of the court
+    if start_time < court.opening_time:
+        raise ValueError("Booking starts before the court opens")
+
+    if end_time > court.closing_time:
+        raise ValueError("Booking ends after the court closes")
+
+    # Check the booking is not in the past
+    if date < datetime.now().date():
+        raise ValueError("Cannot make a booking before today")
+
+
+def is_captain_or_admin(info):
+    user_groups = [g.lower() for g in get_group_names(info.context)]
+    return "captain" in user_groups or "admin" in user_groups
+
+
+def check_booking_limits(court, date, start_time, end_time):
+    # Court limits for non-captains. Captains and admins may bypass these, see is_captain_or_admin
+
+    FMT = '%H:%M:%S'
+    duration_minutes = (datetime.strptime(str(end_time), FMT) -
+                        datetime.strptime(str(start_time), FMT)).seconds // 60
+
+    if court.min_booking_length_minutes is not None:
+        if duration_minutes < court.min_booking_length_minutes:
+            raise ValueError(
+                f"Booking is too short: (Duration = {str(duration_minutes)} min "
+                f"vs min court booking of {str(court.min_booking_length_minutes)} min")
+
+    if court.max_booking_length_minutes is not None:
+        if duration_minutes > court.max_booking_length_minutes:
+            raise ValueError(
+                f"Booking is too long: (Duration = {str(duration_minutes)} min "
+                f"vs max court booking of {str(court.max_booking_length_minutes)} min")
+
+    if court.max_booking_days_in_advance is not None:
+        if date - datetime.now().date() > timedelta(days=court.max_booking_days_in_advance):
+            raise ValueError(
+                f"Booking is too far in advance ({(date - datetime.now().date()).days} days"
+                f", max allowed is {court.max_booking_days_in_advance} days)")
 
 
 class CreateBooking(graphene.Mutation):
@@ -14,7 +65,13 @@ class CreateBooking(graphene.Mutation):
         court_id = graphene.ID(required=True)
         description = graphene.String(required=False)
 
-    def mutate(self, info, date, start_time, end_time, court_id, description=''):
+    # The day lock, clash check and insert must share one transaction, which Django's async ORM can't hold open across
+    # awaits, so mutations that take locks run their sync implementation in the ORM's thread
+    async def mutate(self, info, date, start_time, end_time, court_id, description=''):
+        return await sync_to_async(CreateBooking.create)(info, date, start_time, end_time, court_id, description)
+
+    @staticmethod
+    def create(info, date, start_time, end_time, court_id, description):
 
         # All non-identity dependent validation
         def validate():
@@ -29,73 +86,266 @@ class CreateBooking(graphene.Mutation):
             except ObjectDoesNotExist:
                 raise ValueError("Invalid Court ID")
 
-            # Check the start and end time are within the opening hours of the court
-            if start_time < court.opening_time:
-                raise ValueError("Booking starts before the court opens")
-
-            if end_time > court.closing_time:
-                raise ValueError("Booking ends after the court closes")
-
-            # Check the booking is not in the past
-            if date < datetime.now().date():
-                raise ValueError("Cannot make a booking before today")
+            check_booking_times(court, date, start_time, end_time)
 
             # Check for overlaps with other bookings on that day and court
-            potential_conflicts = models.Booking.objects.filter(court_id=court_id, date=date)
-            for potential_conflict in potential_conflicts:
-                # Condition for A to overlap with B is (a.start < b.end) && (a.end > b.start)
-                if (start_time < potential_conflict.end_time) and (end_time > potential_conflict.start_time):
-                    raise ValueError("Booking clashes with existing booking: " + str(potential_conflict))
+            # The availability bitmap rules out a clash without touching Booking. Only when a slot is (partly)
+            # taken is the conflicting row looked up, for the error message and in case bookings don't fill slots
+            # Condition for A to overlap with B is (a.start < b.end) && (a.end > b.start), which is
+            # answered by the (court, date, start_time, end_time) index without loading the day's bookings
+            if not availability.is_free(court, date, start_time, end_time):
+                conflict = models.Booking.objects.filter(
+                    court_id=court.id, date=date, start_time__lt=end_time, end_time__gt=start_time
+                ).select_related('court', 'user').first()
+                if conflict is not None:
+                    raise ValueError("Booking clashes with existing booking: " + str(conflict))
+
+            return court
 
         # Validation dependent on user identity
-        def check_authorisation():
+        def check_authorisation(court):
 
             user = info.context.user
             if not user.is_authenticated:
                 raise PermissionError("You must be logged in to create bookings")
 
-            user_groups = [g.name.lower() for g in user.groups.all()]
             # Captains and admins may bypass the max booking and advance booking restrictions
-            if "captain" not in user_groups and "admin" not in user_groups:
+            if not is_captain_or_admin(info):
+                check_booking_limits(court, date, start_time, end_time)
+
+        # Bookings for the same court and day are serialised, so the clash check and the insert
+        # cannot interleave with another request's
+        with transaction.atomic():
+            models.CourtDayLock.acquire(court_id, date)
+            court = validate()
+            check_authorisation(court)
+
+            booking = models.Booking(
+                date=date,
+                start_time=start_time,
+                end_time=end_time,
+                user_id=info.context.user.id,
+                court=court,
+                description=description
+            )
+
+            booking.save()
+        return CreateBooking(booking=booking)
 
-                FMT = '%H:%M:%S'
-                duration_minutes = (datetime.strptime(str(end_time), FMT) -
-                                    datetime.strptime(str(start_time), FMT)).seconds // 60
 
-                court = models.Court.objects.get(id=court_id)
+# Bulk creation ========================================================================================================
 
-                if court.min_booking_length_minutes is not None:
-                    if duration_minutes < court.min_booking_length_minutes:
-                        raise ValueError(
-                            f"Booking is too short: (Duration = {str(duration_minutes)} min "
-                            f"vs min court booking of {str(court.min_booking_length_minutes)} min")
-
-                if court.max_booking_length_minutes is not None:
-                    if duration_minutes > court.max_booking_length_minutes:
-                        raise ValueError(
-                            f"Booking is too long: (Duration = {str(duration_minutes)} min "
-                            f"vs max court booking of {str(court.max_booking_length_minutes)} min")
-
-                if court.max_booking_days_in_advance is not None:
-                    if date - datetime.now().date() > timedelta(days=court.max_booking_days_in_advance):
-                        raise ValueError(
-                            f"Booking is too far in advance ({(date - datetime.now().date()).days} days"
-                            f", max allowed is {court.max_booking_days_in_advance} days)")
-
-        validate()
-        check_authorisation()
-
-        booking = models.Booking(
-            date=date,
-            start_time=start_time,
-            end_time=end_time,
-            user_id=info.context.user.id,
-            court_id=court_id,
-            description=description
-        )
-
-        booking.save()
-        return CreateBooking(booking=booking)
+MAX_BULK_BOOKINGS = 200
+
+
+def create_bookings(info, requests):
+    """
+    Creates bookings for the current user from (court_id, date, start_time, end_time, description) tuples, applying
+    the same rules as CreateBooking. Every request that breaks a rule or clashes is left out and reported instead.
+    Existing bookings are checked in one query and the rest are inserted with one bulk_create, all in one transaction.
+    Returns (bookings, conflicts).
+    """
+    user = info.context.user
+    if not user.is_authenticated:
+        raise PermissionError("You must be logged in to create bookings")
+    if len(requests) > MAX_BULK_BOOKINGS:
+        raise ValueError(f"Too many bookings in one request (max {MAX_BULK_BOOKINGS})")
+
+    courts = {str(pk): court for pk, court in models.Court.objects.in_bulk({r[0] for r in requests}).items()}
+    bypass_limits = is_captain_or_admin(info)
+    conflicts, candidates = [], []
+
+    def conflict(court_id, date, start_time, end_time, reason):
+        conflicts.append(types.BookingConflictType(
+            court_id=court_id, date=date, start_time=start_time, end_time=end_time, reason=reason))
+
+    for court_id, date, start_time, end_time, description in requests:
+        court = courts.get(str(court_id))
+        try:
+            if start_time >= end_time:
+                raise ValueError("Start time must be before end time")
+            if court is None:
+                raise ValueError("Invalid Court ID")
+            check_booking_times(court, date, start_time, end_time)
+            if not bypass_limits:
+                check_booking_limits(court, date, start_time, end_time)
+        except ValueError as e:
+            conflict(court_id, date, start_time, end_time, str(e))
+            continue
+        candidates.append(models.Booking(
+            date=date, start_time=start_time, end_time=end_time, user_id=user.id, court=court, site_id=court.site_id,
+            description=description))
+
+    if not candidates:
+        return [], conflicts
+
+    by_court = {}
+    for booking in candidates:
+        by_court.setdefault(booking.court, []).append(booking)
+
+    with transaction.atomic():
+        for court in sorted(by_court, key=lambda c: c.id):
+            models.CourtDayLock.acquire_many(court.id, {b.date for b in by_court[court]})
+
+        # One query for every existing booking that could clash with any candidate
+        booked = {}
+        for existing in models.Booking.objects.filter(
+                court__in=list(by_court),
+                date__in={b.date for b in candidates},
+                start_time__lt=max(b.end_time for b in candidates),
+                end_time__gt=min(b.start_time for b in candidates),
+        ).select_related('court', 'user'):
+            booked.setdefault((existing.court_id, existing.date), []).append(existing)
+
+        accepted = []
+        for booking in candidates:
+            day = booked.setdefault((booking.court.id, booking.date), [])
+            clash = next((b for b in day if booking.start_time < b.end_time and booking.end_time > b.start_time), None)
+            if clash is not None:
+                reason = "Booking clashes with another booking in this request" if clash.pk is None \
+                    else "Booking clashes with existing booking: " + str(clash)
+                conflict(booking.court.id, booking.date, booking.start_time, booking.end_time, reason)
+                continue
+            day.append(booking)
+            accepted.append(booking)
+
+        bookings = models.Booking.objects.bulk_create(accepted)
+        for court in by_court:
+            availability.mark_booked_many(court, [b for b in bookings if b.court is court])
+        analytics.add_bookings(bookings)
+        pubsub.bookings_created([b.pk for b in bookings])
+        ical.bookings_changed([b.user_id for b in bookings], [b.court_id for b in bookings])
+
+    conflicts.sort(key=lambda c: (c.date, c.start_time))
+    return bookings, conflicts
+
+
+class BookingInput(graphene.InputObjectType):
+    court_id = graphene.ID(required=True)
+    date = graphene.Date(required=True)
+    start_time = graphene.Time(required=True)
+    end_time = graphene.Time(required=True)
+    description = graphene.String(required=False)
+
+
+class CreateBookings(graphene.Mutation):
+    bookings = graphene.List(types.BookingType)
+    conflicts = graphene.List(types.BookingConflictType)
+
+    class Arguments:
+        bookings = graphene.List(graphene.NonNull(BookingInput), required=True)
+
+    async def mutate(self, info, bookings):
+        created, conflicts = await sync_to_async(create_bookings)(info, [
+            (b.court_id, b.date, b.start_time, b.end_time, b.description or '') for b in bookings
+        ])
+        return CreateBookings(bookings=created, conflicts=conflicts)
+
+
+class CreateRecurringBooking(graphene.Mutation):
+    bookings = graphene.List(types.BookingType)
+    conflicts = graphene.List(types.BookingConflictType)
+
+    class Arguments:
+        court_id = graphene.ID(required=True)
+        start_time = graphene.Time(required=True)
+        end_time = graphene.Time(required=True)
+        weekday = graphene.Int(required=True, description="ISO day of the week, 1 = Monday to 7 = Sunday")
+        from_date = graphene.Date(required=True)
+        until_date = graphene.Date(required=True)
+        description = graphene.String(required=False)
+
+    async def mutate(self, info, court_id, start_time, end_time, weekday, from_date, until_date, description=''):
+        if not 1 <= weekday <= 7:
+            raise ValueError("Weekday must be between 1 (Monday) and 7 (Sunday)")
+        if from_date > until_date:
+            raise ValueError("Start of the date range must not be after the end")
+
+        date = from_date + timedelta(days=(weekday - from_date.isoweekday()) % 7)
+        requests = []
+        while date <= until_date:
+            requests.append((court_id, date, start_time, end_time, description))
+            date += timedelta(weeks=1)
+
+        created, conflicts = await sync_to_async(create_bookings)(info, requests)
+        return CreateRecurringBooking(bookings=created, conflicts=conflicts)
+
+
+# Queued booking requests ==============================================================================================
+# Decided later by the allocator in app/admission.py, for when a new day opens and everyone wants the same slots
+
+MAX_PREFERENCES = 5
+MAX_PENDING_REQUESTS = 5
+
+
+class BookingPreferenceInput(graphene.InputObjectType):
+    court_id = graphene.ID(required=False, description="Defaults to the request's court")
+    start_time = graphene.Time(required=True)
+    end_time = graphene.Time(required=True)
+
+
+def request_booking(info, court_id, date, start_time, end_time, description, preferences):
+    """
+    Queues a booking request with fallback choices on the same day, after applying every CreateBooking rule except
+    the clash check to each choice. Nothing else is read, so the request costs a few queries however busy the day is.
+    """
+    user = info.context.user
+    if not user.is_authenticated:
+        raise PermissionError("You must be logged in to request bookings")
+    if len(preferences) > MAX_PREFERENCES:
+        raise ValueError(f"Too many preferences (max {MAX_PREFERENCES})")
+
+    courts = {str(court.id): court for court in cache.get_courts()}
+    bypass_limits = is_captain_or_admin(info)
+    choices = [(court_id, start_time, end_time)] + [
+        (p.court_id or court_id, p.start_time, p.end_time) for p in preferences
+    ]
+    for i, (choice_court_id, choice_start, choice_end) in enumerate(choices):
+        try:
+            if choice_start >= choice_end:
+                raise ValueError("Start time must be before end time")
+            court = courts.get(str(choice_court_id))
+            if court is None:
+                raise ValueError("Invalid Court ID")
+            check_booking_times(court, date, choice_start, choice_end)
+            if not bypass_limits:
+                check_booking_limits(court, date, choice_start, choice_end)
+        except ValueError as e:
+            raise ValueError(f"Preference {i}: {e}" if i else str(e))
+
+    pending = models.BookingRequest.objects.filter(user=user, status=models.BookingRequest.PENDING)
+    if pending.count() >= MAX_PENDING_REQUESTS:
+        raise ValueError(f"You already have {MAX_PENDING_REQUESTS} booking requests waiting")
+
+    return models.BookingRequest.objects.create(
+        user_id=user.id,
+        court_id=court_id,
+        date=date,
+        start_time=start_time,
+        end_time=end_time,
+        description=description,
+        preferences=[[int(c), s.isoformat(), e.isoformat()] for c, s, e in choices[1:]],
+        bypass_limits=bypass_limits,
+        lottery_key=secrets.randbelow(2 ** 31),
+    )
+
+
+class RequestBooking(graphene.Mutation):
+    booking_request = graphene.Field(types.BookingRequestType)
+
+    class Arguments:
+        court_id = graphene.ID(required=True)
+        date = graphene.Date(required=True)
+        start_time = graphene.Time(required=True)
+        end_time = graphene.Time(required=True)
+        description = graphene.String(required=False)
+        preferences = graphene.List(graphene.NonNull(BookingPreferenceInput),
+                                    description="Fallbacks on the same day, in order, if the first choice is taken")
+
+    async def mutate(self, info, court_id, date, start_time, end_time, description='', preferences=None):
+        request = await sync_to_async(request_booking)(
+            info, court_id, date, start_time, end_time, description or '', preferences or [])
+        return RequestBooking(booking_request=request)
 
 
 class DeleteBooking(graphene.Mutation):
@@ -104,25 +354,28 @@ class DeleteBooking(graphene.Mutation):
     class Arguments:
         booking_id = graphene.ID()
 
-    def mutate(self, info, booking_id):
-        target = models.Booking.objects.get(id=booking_id)
+    async def mutate(self, info, booking_id):
+        target = await models.Booking.objects.aget(id=booking_id)
 
-        def check_authorisation():
+        async def check_authorisation():
 
             user = info.context.user
             if not user.is_authenticated:
                 raise PermissionError("You must be logged in to delete a booking")
 
-            user_groups = [g.name.lower() for g in user.groups.all()]
+            user_groups = [g.lower() for g in await aget_group_names(info.context)]
 
-            if target.user.id != user.id and "admin" not in user_groups:
+            if target.user_id != user.id and "admin" not in user_groups:
                 raise PermissionError("Non-admins may only delete their own bookings")
 
-        check_authorisation()
-        target.delete()
+        await check_authorisation()
+        await target.adelete()
         return DeleteBooking(ok=True)
 
 
 class Mutation(graphene.ObjectType):
     create_booking = CreateBooking.Field()
+    create_bookings = CreateBookings.Field()
+    create_recurring_booking = CreateRecurringBooking.Field()
+    request_booking = RequestBooking.Field()
     delete_booking = DeleteBooking.Field()
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from app import models
+
+
+# Booking change events for GraphQL subscriptions ======================================================================
+# Mutations (sync code, in Django's worker threads) and the booking request allocator publish once their transaction
+# commits. Subscribers are async generators on the ASGI event loop. BOOKING_EVENT_BROKER picks the broker class, so
+# the in-process one below can be swapped for one backed by a local message broker when running several server
+# processes (or the allocate_bookings command).
+
+class BookingChange(object):
+    CREATED = "CREATED"
+    DELETED = "DELETED"
+
+    def __init__(self, action, booking_id, site_id, court_id, date, booking=None):
+        self.action = action
+        self.booking_id = booking_id
+        self.site_id = site_id
+        self.court_id = court_id
+        self.date = date
+        self.booking = booking
+
+
+class BookingRequestDecided(object):
+    def __init__(self, request):
+        self.request_id = request.pk
+        self.request = request
+
+
+class InProcessBroker(object):
+    # Events a subscriber can fall behind by before it starts missing them (it can refetch to catch up)
+    max_backlog = 1000
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    async def listen(self):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.max_backlog)
+        subscriber = (loop, queue)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            with self.lock:
+                self.subscribers.discard(subscriber)
+
+    def publish(self, change):
+        # Safe to call from any thread
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(self._deliver, queue, change)
+
+    @staticmethod
+    def _deliver(queue, change):
+        if not queue.full():
+            queue.put_nowait(change)
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = import_string(getattr(settings, "BOOKING_EVENT_BROKER", "app.pubsub.InProcessBroker"))()
+    return _broker
+
+
+def bookings_created(booking_ids):
+    # Loaded with their court and user after the commit, so subscribers can serialise them without touching the
+    # database from the event loop
+    def publish():
+        broker = get_broker()
+        for booking in models.Booking.objects.filter(pk__in=booking_ids).select_related('court', 'user'):
+            broker.publish(BookingChange(
+                BookingChange.CREATED, booking.pk, booking.site_id, booking.court_id, booking.date, booking))
+    transaction.on_commit(publish)
+
+
+def booking_deleted(booking_id, site_id, court_id, date):
+    change = BookingChange(BookingChange.DELETED, booking_id, site_id, court_id, date)
+    transaction.on_commit(lambda: get_broker().publish(change))
+
+
+def requests_decided(request_ids):
+    # Loaded with the new bookings, like bookings_created
+    def publish():
+        broker = get_broker()
+        for request in models.BookingRequest.objects.filter(pk__in=request_ids).select_related(
+                'court', 'booking__court', 'booking__user'):
+            broker.publish(BookingRequestDecided(request))
+    transaction.on_commit(publish)
@@ -1,6 +1,21 @@
-from app import types, models
+from app import analytics, availability, cache, calendar_grid, ical, slots, types, models
+from app.loaders import optimise_queryset
+from app.middleware import aget_group_names
+from app.mutations import is_captain_or_admin
 
+from asgiref.sync import sync_to_async
 import graphene
+from graphene_django.fields import DjangoConnectionField
+from graphene_django.settings import graphene_settings
+
+
+def _check_page_size(kwargs):
+    # resolve_connection only fills in first when neither first nor last is given, so larger pages are refused here
+    # the way DjangoConnectionField refuses them
+    max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+    for name in ("first", "last"):
+        if kwargs.get(name) is not None and not 0 <= kwargs[name] <= max_limit:
+            raise ValueError(f"{name} must be between 0 and {max_limit}")
 
 
 class Query(graphene.ObjectType):
@@ -9,37 +24,194 @@ class Query(graphene.ObjectType):
     all_bookings = graphene.List(types.BookingType)
     bookings_by_court = graphene.List(types.BookingType, court_id=graphene.ID())
     bookings_by_user = graphene.List(types.BookingType, user_id=graphene.ID())
+    bookings = graphene.List(
+        types.BookingType,
+        court_id=graphene.ID(),
+        from_date=graphene.Date(required=True, name="from"),
+        to_date=graphene.Date(required=True, name="to"),
+    )
+    bookings_by_user_connection = graphene.relay.ConnectionField(
+        types.BookingConnection,
+        user_id=graphene.ID(required=True),
+        from_date=graphene.Date(name="from"),
+        to_date=graphene.Date(name="to"),
+    )
+    booking_history = graphene.relay.ConnectionField(
+        types.BookingArchiveConnection,
+        court_id=graphene.ID(),
+        user_id=graphene.ID(),
+        from_date=graphene.Date(name="from"),
+        to_date=graphene.Date(name="to"),
+    )
+    availability = graphene.List(
+        types.AvailabilityType,
+        court_id=graphene.ID(required=True),
+        from_date=graphene.Date(required=True, name="from"),
+        to_date=graphene.Date(required=True, name="to"),
+    )
+    calendar = graphene.Field(
+        types.CalendarType,
+        court_id=graphene.ID(),
+        from_date=graphene.Date(required=True, name="from"),
+        to_date=graphene.Date(required=True, name="to"),
+    )
+    find_slots = graphene.List(
+        types.SlotType,
+        duration=graphene.Int(required=True, description="Minutes"),
+        from_date=graphene.Date(required=True, name="from"),
+        to_date=graphene.Date(required=True, name="to"),
+        court_ids=graphene.List(graphene.NonNull(graphene.ID)),
+        earliest_start=graphene.Time(),
+        latest_end=graphene.Time(),
+        first=graphene.Int(default_value=10),
+        order=types.SlotOrder(default_value=slots.EARLIEST),
+    )
+    court_utilisation = graphene.List(
+        types.CourtUsageType,
+        from_date=graphene.Date(required=True, name="from"),
+        to_date=graphene.Date(required=True, name="to"),
+        granularity=types.UsageGranularity(default_value=analytics.DAY),
+        court_id=graphene.ID(),
+    )
+    top_bookers = graphene.List(
+        types.BookerType,
+        from_date=graphene.Date(required=True, name="from"),
+        to_date=graphene.Date(required=True, name="to"),
+        court_id=graphene.ID(),
+        first=graphene.Int(default_value=10),
+    )
+    booking_request = graphene.Field(types.BookingRequestType, id=graphene.ID(required=True))
     session_info = graphene.Field(types.SessionInfoType)
 
-    def resolve_site(self, info):
-        return (
-            models.Site.objects.first()
-        )
+    # Every resolver is a coroutine, so the fields of one query (e.g. site, allCourts and sessionInfo on page load)
+    # resolve concurrently under AsyncGraphQLView. Querysets are evaluated here with async iteration, since graphql-core
+    # would otherwise iterate them synchronously on the event loop
 
-    def resolve_all_courts(self, info):
+    async def resolve_site(self, info):
         return (
-            models.Court.objects.all()
+            await cache.aget_site()
         )
 
-    def resolve_all_bookings(self, info):
+    async def resolve_all_courts(self, info):
         return (
-            models.Booking.objects.all()
+            await cache.aget_courts()
         )
 
-    def resolve_bookings_by_court(self, info, court_id):
-        return (
-            models.Booking.objects.filter(court__pk=court_id)
+    async def resolve_all_bookings(self, info):
+        return [
+            booking async for booking in optimise_queryset(models.Booking.objects.all(), info)
+        ]
+
+    async def resolve_bookings_by_court(self, info, court_id):
+        return [
+            booking async for booking in optimise_queryset(models.Booking.objects.filter(court__pk=court_id), info)
+        ]
+
+    async def resolve_bookings_by_user(self, info, user_id):
+        return [
+            booking async for booking in optimise_queryset(models.Booking.objects.filter(user__pk=user_id), info)
+        ]
+
+    # The calendar only ever shows a window of days, so unlike allBookings this never reads old bookings
+    async def resolve_bookings(self, info, from_date, to_date, court_id=None):
+        if from_date > to_date:
+            raise ValueError("Start of the date window must not be after the end")
+        bookings = models.Booking.objects.filter(date__gte=from_date, date__lte=to_date)
+        if court_id is not None:
+            bookings = bookings.filter(court__pk=court_id)
+        return [booking async for booking in optimise_queryset(bookings, info)]
+
+    async def resolve_bookings_by_user_connection(self, info, user_id, from_date=None, to_date=None, **kwargs):
+        bookings = models.Booking.objects.filter(user__pk=user_id)
+        if from_date is not None:
+            bookings = bookings.filter(date__gte=from_date)
+        if to_date is not None:
+            bookings = bookings.filter(date__lte=to_date)
+        _check_page_size(kwargs)
+        # Count and slice in the database rather than paging through the whole list in Python. graphene-django
+        # does both synchronously, so it runs in a thread
+        return await sync_to_async(DjangoConnectionField.resolve_connection)(
+            types.BookingConnection, kwargs, optimise_queryset(bookings, info, path=("edges", "node")),
+            max_limit=graphene_settings.RELAY_CONNECTION_MAX_LIMIT,
         )
 
-    def resolve_bookings_by_user(self, info, user_id):
-        return (
-            models.Booking.objects.filter(user__pk=user_id)
+    # Bookings moved out of the live table by the archive_bookings command, a page at a time
+    async def resolve_booking_history(self, info, court_id=None, user_id=None, from_date=None, to_date=None, **kwargs):
+        bookings = models.BookingArchive.objects.all()
+        if court_id is not None:
+            bookings = bookings.filter(court__pk=court_id)
+        if user_id is not None:
+            bookings = bookings.filter(user__pk=user_id)
+        if from_date is not None:
+            bookings = bookings.filter(date__gte=from_date)
+        if to_date is not None:
+            bookings = bookings.filter(date__lte=to_date)
+        _check_page_size(kwargs)
+        return await sync_to_async(DjangoConnectionField.resolve_connection)(
+            types.BookingArchiveConnection, kwargs, optimise_queryset(bookings, info, path=("edges", "node")),
+            max_limit=graphene_settings.RELAY_CONNECTION_MAX_LIMIT,
         )
 
-    def resolve_session_info(self, info):
+    async def resolve_availability(self, info, court_id, from_date, to_date):
+        if from_date > to_date:
+            raise ValueError("Start of the date window must not be after the end")
+        court = await models.Court.objects.aget(id=court_id)
+        slots = availability.slot_count(court)
+        days = await sync_to_async(availability.get_range)(court, from_date, to_date)
+        return [
+            types.AvailabilityType(
+                court_id=court.id,
+                date=date,
+                opening_time=court.opening_time,
+                slot_minutes=availability.slot_minutes(court),
+                booked=format(bits, "b").zfill(slots)[::-1][:slots],
+            )
+            for date, bits in days.items()
+        ]
+
+    async def resolve_calendar(self, info, from_date, to_date, court_id=None):
+        grid = await sync_to_async(calendar_grid.build)(from_date, to_date, court_id)
+        return types.CalendarType(from_date=from_date, to_date=to_date, **grid)
+
+    # Free slots the current user could book, applying the court limits unless they are a captain or admin
+    async def resolve_find_slots(self, info, duration, from_date, to_date, court_ids=None, earliest_start=None,
+                                 latest_end=None, first=10, order=slots.EARLIEST):
+        if not 1 <= first <= 100:
+            raise ValueError("first must be between 1 and 100")
+        bypass_limits = info.context.user.is_authenticated and await sync_to_async(is_captain_or_admin)(info)
+        return await sync_to_async(slots.find_slots)(
+            duration, from_date, to_date, court_ids, earliest_start, latest_end, first, order, bypass_limits)
+
+    # Served from the DailyCourtUsage rollups, see app/analytics.py
+    async def resolve_court_utilisation(self, info, from_date, to_date, granularity=analytics.DAY, court_id=None):
+        return await sync_to_async(analytics.utilisation)(from_date, to_date, granularity, court_id)
+
+    async def resolve_top_bookers(self, info, from_date, to_date, court_id=None, first=10):
+        if not 1 <= first <= 100:
+            raise ValueError("first must be between 1 and 100")
+        # Their users are loaded together by BookerType.resolve_user's loader
+        return await sync_to_async(analytics.top_bookers)(from_date, to_date, first, court_id)
+
+    # Polled by clients waiting on a requestBooking, so it's a single query (bookingRequestDecided pushes the outcome
+    # instead)
+    async def resolve_booking_request(self, info, id):
+        user = info.context.user
+        if not user.is_authenticated:
+            raise PermissionError("You must be logged in to see booking requests")
+        request = await models.BookingRequest.objects.select_related('booking').filter(pk=id).afirst()
+        # Other users' requests look the same as missing ones, except to admins
+        if request is not None and request.user_id != user.id:
+            if "admin" not in [g.lower() for g in await aget_group_names(info.context)]:
+                request = None
+        if request is None:
+            raise ValueError("Invalid booking request ID")
+        return request
+
+    async def resolve_session_info(self, info):
         user = info.context.user
         s = types.SessionInfoType()
         s.is_authenticated = user.is_authenticated
         s.user = user if user.is_authenticated else None
-        s.groups = [g.name for g in user.groups.all()] if user.is_authenticated else []
+        s.groups = await aget_group_names(info.context)
+        s.calendar_token = ical.user_token(user.pk) if user.is_authenticated else None
         return s
@@ -1,4 +1,4 @@
 import graphene
-from app import queries, mutations
+from app import queries, mutations, subscriptions
 
-schema = graphene.Schema(query=queries.Query, mutation=mutations.Mutation)
\ No newline at end of file
+schema = graphene.Schema(query=queries.Query, mutation=mutations.Mutation, subscription=subscriptions.Subscription)
\ No newline at end of file
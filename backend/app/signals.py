@@ -0,0 +1,136 @@
+from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from app import admission, analytics, availability, cache, database, ical, images, middleware, models, pubsub, tracing
+
+
+# Auth token cache invalidation ========================================================================================
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    middleware.invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, **kwargs):
+    middleware.invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def group_changed(sender, instance, **kwargs):
+    # A renamed or deleted group can affect any user
+    middleware.invalidate_user()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        # user.groups.add(...) and friends
+        middleware.invalidate_user(instance.pk)
+    elif pk_set:
+        # group.user_set.add(...) and friends
+        for user_id in pk_set:
+            middleware.invalidate_user(user_id)
+    else:
+        # group.user_set.clear() doesn't say which users were affected
+        middleware.invalidate_user()
+
+
+# Availability bitmap, usage rollup and calendar feed maintenance ======================================================
+
+@receiver(pre_save, sender=models.Booking)
+def booking_moving(sender, instance, **kwargs):
+    # A booking is always on its court's site
+    instance.site_id = instance.court.site_id
+    # Remember where (and whose) an edited booking used to be, so that day and feed can be rebuilt too
+    if instance.pk is not None:
+        previous = models.Booking.objects.filter(pk=instance.pk).values_list('court_id', 'date', 'user_id').first()
+        if previous is not None:
+            instance._previous_day, instance._previous_user_id = previous[:2], previous[2]
+
+
+@receiver(post_save, sender=models.Booking)
+def booking_saved(sender, instance, created, **kwargs):
+    if created:
+        availability.mark_booked(instance.court, instance.date, instance.start_time, instance.end_time)
+        analytics.add_bookings([instance])
+        pubsub.bookings_created([instance.pk])
+        ical.bookings_changed([instance.user_id], [instance.court_id])
+        return
+    availability.refresh(instance.court, instance.date)
+    analytics.refresh(instance.court_id, instance.date)
+    previous_day = getattr(instance, '_previous_day', None)
+    ical.bookings_changed([instance.user_id, getattr(instance, '_previous_user_id', instance.user_id)],
+                          [instance.court_id] + ([previous_day[0]] if previous_day is not None else []))
+    if previous_day is not None and previous_day != (instance.court_id, instance.date):
+        availability.refresh(models.Court.objects.get(pk=previous_day[0]), previous_day[1])
+        analytics.refresh(*previous_day)
+
+
+@receiver(post_delete, sender=models.Booking)
+def booking_deleted(sender, instance, origin=None, **kwargs):
+    pubsub.booking_deleted(instance.pk, instance.site_id, instance.court_id, instance.date)
+    ical.bookings_changed([instance.user_id], [instance.court_id])
+    # Nothing to maintain when the whole court (or its site) is being deleted
+    if isinstance(origin, (models.Court, models.Site)) or getattr(origin, 'model', None) in (models.Court, models.Site):
+        return
+    availability.refresh(models.Court.objects.get(pk=instance.court_id), instance.date)
+    analytics.refresh(instance.court_id, instance.date)
+
+
+# Booking request queue ================================================================================================
+
+@receiver(post_save, sender=models.BookingRequest)
+def booking_requested(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(admission.request_queued)
+
+
+# Cached Site and Court data ===========================================================================================
+
+@receiver(pre_save, sender=models.Site)
+def site_saving(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'logo' in update_fields:
+        images.update_logo_variants(instance)
+
+
+@receiver(post_save, sender=models.Site)
+@receiver(post_delete, sender=models.Site)
+def site_changed(sender, instance, **kwargs):
+    cache.invalidate_site()
+
+
+@receiver(pre_save, sender=models.Court)
+def court_saving(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._previous_site_id = models.Court._base_manager.filter(pk=instance.pk).values_list(
+            'site_id', flat=True).first()
+
+
+@receiver(post_save, sender=models.Court)
+@receiver(post_delete, sender=models.Court)
+def court_changed(sender, instance, **kwargs):
+    previous_site_id = getattr(instance, '_previous_site_id', None)
+    cache.invalidate_courts(instance.site_id, previous_site_id)
+    # A court moved to another site takes its bookings with it
+    if previous_site_id is not None and previous_site_id != instance.site_id:
+        models.Booking._base_manager.filter(court=instance).update(site_id=instance.site_id)
+        models.BookingArchive._base_manager.filter(court=instance).update(site_id=instance.site_id)
+
+
+# New database connections ============================================================================================
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    database.configure_connection(connection)
+    # SQL timing for traced GraphQL requests. A connection object that reconnects (after close_old_connections() or
+    # CONN_MAX_AGE) already has it
+    if tracing.record_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(tracing.record_sql)
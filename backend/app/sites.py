@@ -0,0 +1,69 @@
+import re
+
+from django.conf import settings
+from django.http.request import split_domain_port
+
+from app import cache, models
+
+
+# Sites ================================================================================================================
+# One deployment serves any number of Sites (colleges), each with its own courts and bookings. SiteMiddleware works
+# out which site a request is for once, from the SITE_HEADER header (a site's domain or ID, for API clients and local
+# development) or else the Host, falling back to the first site, and makes it the current site for the rest of the
+# request. Court, Booking and BookingArchive's default managers (models.SiteScopedManager) then only see that site's
+# rows, so every query, mutation, export and calendar feed is scoped without the site being passed around, and
+# cached courts are kept per site (see app/cache.py).
+#
+# Serving a site on its own domain also takes adding the domain to SITE_HOSTS (config/settings.py), since Django
+# refuses hosts missing from ALLOWED_HOSTS.
+#
+# Users and groups are shared: one account can book at any site, and a captain or admin is one everywhere.
+#
+# Management commands and the booking allocator run outside a request, with no current site, and so see every site.
+# Subscriptions are for the site of their WebSocket, worked out the same way from its handshake (see resolve_scope),
+# and only hear about that site's bookings. A queryset only picks up the current site when it is made, so one made
+# inside a request (e.g. for a streamed response) stays scoped after the request's view has returned.
+
+# Domain names and site IDs. Anything else in the header is ignored rather than used as a cache key
+re_site_name = re.compile(r"[a-z0-9.-]{1,253}")
+
+
+def _site_header():
+    return getattr(settings, "SITE_HEADER", "X-Site")
+
+
+def _site_name(header, host):
+    # From the values of the SITE_HEADER and Host headers
+    name = header.strip().lower()
+    if not name:
+        name, _ = split_domain_port(host)
+    return name if re_site_name.fullmatch(name) else None
+
+
+def _find(name):
+    site = cache.find_site(name) if name else None
+    return site if site is not None else cache.get_default_site()
+
+
+def resolve(request):
+    # The request's Site, or None if there are no sites at all
+    return _find(_site_name(request.headers.get(_site_header(), ""), request.get_host()))
+
+
+def resolve_scope(scope):
+    # The Site of an ASGI connection (a subscription's WebSocket), from the headers of its handshake
+    headers = {name.decode("latin1").lower(): value.decode("latin1") for name, value in scope.get("headers", ())}
+    return _find(_site_name(headers.get(_site_header().lower(), ""), headers.get("host", "")))
+
+
+class SiteMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.site = resolve(request)
+        token = models.current_site.set(request.site)
+        try:
+            return self.get_response(request)
+        finally:
+            models.current_site.reset(token)
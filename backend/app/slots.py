@@ -0,0 +1,156 @@
+import heapq
+from datetime import datetime, time, timedelta
+
+from django.db.models import CharField
+from django.db.models.functions import Cast
+
+from app import cache, models
+
+
+# Free slot search =====================================================================================================
+# For each court and day, the free intervals are the gaps a sweep over that day's bookings (sorted by start time)
+# leaves inside the court's opening hours, narrowed to [earliest_start, latest_end]. Every gap long enough for the
+# requested duration gives one candidate slot, starting at the beginning of the gap. Bookings are loaded a week at a
+# time with values_list(), so even a whole term across all courts is one pass over plain tuples.
+
+EARLIEST = "EARLIEST"
+# Smallest leftover gap first, so the slot fills a hole rather than splitting a long free stretch
+BEST_FIT = "BEST_FIT"
+
+# Longest window one search may cover
+MAX_DAYS = 190
+# Days of bookings loaded at a time
+SEARCH_DAYS = 7
+
+
+class Slot(object):
+    def __init__(self, court, date, start, end, free_minutes):
+        self.court = court
+        self.court_id = court.id
+        self.date = date
+        self.start_time = _time(start)
+        self.end_time = _time(end)
+        self.free_minutes = free_minutes
+
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def _text_minutes(t):
+    # "HH:MM:SS"
+    return int(t[:2]) * 60 + int(t[3:5])
+
+
+def _time(minutes):
+    return time(minutes // 60, minutes % 60)
+
+
+def _allowed(court, duration, bypass_limits):
+    if bypass_limits:
+        return True
+    if court.min_booking_length_minutes is not None and duration < court.min_booking_length_minutes:
+        return False
+    if court.max_booking_length_minutes is not None and duration > court.max_booking_length_minutes:
+        return False
+    return True
+
+
+def _last_bookable_day(court, today, bypass_limits):
+    if bypass_limits or court.max_booking_days_in_advance is None:
+        return None
+    return today + timedelta(days=court.max_booking_days_in_advance)
+
+
+def free_intervals(window_start, window_end, bookings):
+    # Yields (start, end) for each gap between bookings in [window_start, window_end). bookings are (start, end)
+    # pairs in minutes sorted by start, and may overlap
+    cursor = window_start
+    for start, end in bookings:
+        if start >= window_end:
+            break
+        if start > cursor:
+            yield cursor, start
+        cursor = max(cursor, end)
+    if cursor < window_end:
+        yield cursor, window_end
+
+
+def find_slots(duration, from_date, to_date, court_ids=None, earliest_start=None, latest_end=None, first=10,
+               order=EARLIEST, bypass_limits=False, now=None):
+    """
+    Returns up to first Slots of duration minutes between from_date and to_date (inclusive), across the given courts
+    (all of them by default). Court booking limits apply unless bypass_limits, as in CreateBooking, and nothing in the
+    past is offered.
+    """
+    if duration <= 0:
+        raise ValueError("Duration must be positive")
+    if from_date > to_date:
+        raise ValueError("Start of the date window must not be after the end")
+    if to_date - from_date >= timedelta(days=MAX_DAYS):
+        raise ValueError(f"Date window is too long (max {MAX_DAYS} days)")
+
+    now = now or datetime.now()
+    today = now.date()
+    from_date = max(from_date, today)
+
+    wanted = {str(pk) for pk in court_ids} if court_ids else None
+    courts = [
+        court for court in cache.get_courts()
+        if (wanted is None or str(court.id) in wanted) and _allowed(court, duration, bypass_limits)
+    ]
+    if not courts or from_date > to_date:
+        return []
+
+    if order == BEST_FIT:
+        key = lambda slot: (slot.free_minutes, slot.date, slot.start_time, slot.court_id)
+    else:
+        key = lambda slot: (slot.date, slot.start_time, slot.court_id)
+
+    # Searches a week at a time, stopping once no later slot could make the top first: for EARLIEST as soon as there
+    # are enough slots, for BEST_FIT once there are enough that fit exactly. A search that finds its slots in the first
+    # week (most of them) never loads the rest of the term
+    best = []
+    window_start = from_date
+    while window_start <= to_date:
+        window_end = min(window_start + timedelta(days=SEARCH_DAYS - 1), to_date)
+        found = _search(courts, duration, window_start, window_end, earliest_start, latest_end, today, now,
+                        bypass_limits)
+        best = heapq.nsmallest(first, best + found, key=key)
+        if len(best) == first and (order != BEST_FIT or best[-1].free_minutes == duration):
+            break
+        window_start = window_end + timedelta(days=1)
+    return best
+
+
+def _search(courts, duration, from_date, to_date, earliest_start, latest_end, today, now, bypass_limits):
+    # Every candidate Slot between from_date and to_date
+    # Dates and times come back as their ISO text, since parsing them into date and time objects would cost more than
+    # the whole sweep
+    bookings = {}
+    for court_id, date, start_time, end_time in models.Booking.objects.filter(
+            court__in=courts, date__gte=from_date, date__lte=to_date,
+    ).order_by('court_id', 'date', 'start_time').values_list(
+            'court_id', Cast('date', CharField()), Cast('start_time', CharField()), Cast('end_time', CharField())):
+        bookings.setdefault((court_id, date), []).append((_text_minutes(start_time), _text_minutes(end_time)))
+
+    found = []
+    for court in courts:
+        opening, closing = _minutes(court.opening_time), _minutes(court.closing_time)
+        if earliest_start is not None:
+            opening = max(opening, _minutes(earliest_start))
+        if latest_end is not None:
+            closing = min(closing, _minutes(latest_end))
+        last_day = _last_bookable_day(court, today, bypass_limits)
+
+        date = from_date
+        while date <= to_date and (last_day is None or date <= last_day):
+            start = opening
+            if date == today:
+                # From the next half hour, which is what the calendar snaps bookings to
+                start = max(start, -(-(now.hour * 60 + now.minute) // 30) * 30)
+            for gap_start, gap_end in free_intervals(start, closing, bookings.get((court.id, date.isoformat()), ())):
+                if gap_end - gap_start >= duration:
+                    found.append(Slot(court, date, gap_start, gap_start + duration, gap_end - gap_start))
+            date += timedelta(days=1)
+    return found
@@ -0,0 +1,81 @@
+import asyncio
+
+import graphene
+
+from app import models, types
+from app.middleware import aget_group_names
+from app.pubsub import BookingChange, BookingRequestDecided, get_broker
+
+
+class Subscription(graphene.ObjectType):
+    booking_changed = graphene.Field(types.BookingChangeType, court_id=graphene.ID(), date=graphene.Date())
+    booking_request_decided = graphene.Field(
+        types.BookingRequestType, request_id=graphene.ID(required=True),
+        description="The outcome of a requestBooking, sent once (straight away if it has already been decided)")
+
+    async def subscribe_booking_changed(root, info, court_id=None, date=None):
+        # The WebSocket's site, see app/websockets.py
+        site = models.current_site.get()
+        changes = get_broker().listen()
+        try:
+            async for change in changes:
+                if not isinstance(change, BookingChange):
+                    continue
+                if site is not None and change.site_id != site.pk:
+                    continue
+                if court_id is not None and str(change.court_id) != str(court_id):
+                    continue
+                if date is not None and change.date != date:
+                    continue
+                yield types.BookingChangeType(
+                    action=change.action,
+                    booking_id=change.booking_id,
+                    court_id=change.court_id,
+                    date=change.date,
+                    booking=change.booking,
+                )
+        finally:
+            # Unsubscribes from the broker straight away rather than whenever the generator is collected
+            await changes.aclose()
+
+    # A plain coroutine rather than a generator, so an unknown ID is reported as an error straight away
+    async def subscribe_booking_request_decided(root, info, request_id):
+        user = info.context.user
+        if not user.is_authenticated:
+            raise PermissionError("You must be logged in to see booking requests")
+        request = await _get_request(request_id)
+        # Other users' requests look the same as missing ones, except to admins, as in the bookingRequest query
+        if request is not None and request.user_id != user.id:
+            if "admin" not in [g.lower() for g in await aget_group_names(info.context)]:
+                request = None
+        if request is None:
+            raise ValueError("Invalid booking request ID")
+        return _request_decided(request)
+
+
+def _get_request(request_id):
+    return models.BookingRequest.objects.select_related(
+        'court', 'booking__court', 'booking__user').filter(pk=request_id).afirst()
+
+
+async def _request_decided(request):
+    if request.status != models.BookingRequest.PENDING:
+        yield request
+        return
+    changes = get_broker().listen()
+    # Starts listening before looking at the request again, so a decision made since it was read isn't missed
+    first = asyncio.ensure_future(changes.__anext__())
+    await asyncio.sleep(0)
+    try:
+        request = await _get_request(request.pk)
+        if request.status != models.BookingRequest.PENDING:
+            yield request
+            return
+        change = await first
+        while not (isinstance(change, BookingRequestDecided) and change.request_id == request.pk):
+            change = await changes.__anext__()
+        yield change.request
+    finally:
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await changes.aclose()
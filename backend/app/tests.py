@@ -1,3 +1,1381 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import tempfile
+import threading
+import time as time_module
+from types import SimpleNamespace
+from unittest import mock
+from datetime import date, time, timedelta
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from graphql import parse
+from PIL import Image
+from rest_framework.authtoken.models import Token
+
+from app import (
+    admin, archive, cache as cache_module, database, documents, ical, limits, middleware, models, tracing, views,
+)
+from app.loaders import get_loaders
+from app.pubsub import BookingChange, InProcessBroker
+from app.schema import schema
+from app.websockets import GraphQLWebSocketApp
+
+
+CREATE_BOOKING = """
+mutation($courtId: ID!, $date: Date!, $startTime: Time!, $endTime: Time!) {
+  createBooking(courtId: $courtId, date: $date, startTime: $startTime, endTime: $endTime) { booking { id } }
+}
+"""
+
+
+# The replica is a second connection to the test database (see app/database.py), which can't see rows written inside
+# a TestCase's transaction, so reads stay on "default" here
+@override_settings(DATABASE_ROUTERS=[])
+class GraphQLTestCase(TestCase):
+    """
+    A site with one court, open 07:00 to 22:00, and a user with an auth token.
+    """
+
+    def setUp(self):
+        # Cached sites and courts would otherwise outlive the rolled-back rows they came from
+        cache.clear()
+        views.CachingGraphQLView.document_store = None
+        # As are rate limit buckets, which are keyed by user IDs the next test reuses
+        limits._bucket = None
+        self.site = models.Site.objects.create(name="Test site", description="")
+        self.court = models.Court.objects.create(
+            site=self.site, name="Court 1", opening_time=time(7), closing_time=time(22), min_booking_length_minutes=15)
+        self.user = User.objects.create(username="player", email="player@example.com")
+        self.token = Token.objects.create(user=self.user).key
+
+    def make_captain(self, user):
+        user.groups.add(Group.objects.get_or_create(name="captain")[0])
+
+    def graphql(self, query, variables=None, token=None):
+        body = json.dumps({"query": query, "variables": variables or {}})
+        response = self.client.post("/graphql", body, content_type="application/json",
+                                    HTTP_AUTHORIZATION="Token " + (token or self.token))
+        return response.json()
+
+    async def wait_for(self, condition):
+        for _ in range(500):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("Timed out")
+
+    @property
+    def connection_params(self):
+        # The connection_init payload authenticating a WebSocket as the user
+        return {"authorization": "Token " + self.token}
+
+    def create_booking(self, day, start, end):
+        return self.graphql(CREATE_BOOKING, {
+            "courtId": self.court.id, "date": day.isoformat(), "startTime": start, "endTime": end})
+
+    def fill_day(self, day, count, minutes=15):
+        # count back-to-back bookings from opening time
+        start = 7 * 60
+        for i in range(count):
+            begin, end = start + i * minutes, start + (i + 1) * minutes
+            models.Booking.objects.create(
+                court=self.court, user=self.user, date=day,
+                start_time=time(begin // 60, begin % 60), end_time=time(end // 60, end % 60))
+
+
+# Clash check ==========================================================================================================
+
+class ClashCheckTests(GraphQLTestCase):
+
+    def test_create_cost_does_not_grow_with_the_day(self):
+        # A create's queries are the same with one booking on the day or fifty, so its latency stays flat
+        quiet, busy = date.today() + timedelta(days=1), date.today() + timedelta(days=2)
+        self.fill_day(quiet, 1)
+        self.fill_day(busy, 50)
+        self.make_captain(self.user)
+        # The first request also fills the token, site and court caches
+        self.create_booking(date.today() + timedelta(days=3), "21:00", "21:30")
+        counts = []
+        for day in (quiet, busy):
+            with CaptureQueriesContext(connection) as queries:
+                result = self.create_booking(day, "21:00", "21:30")
+            self.assertNotIn("errors", result)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_clash_is_one_indexed_range_query(self):
+        day = date.today() + timedelta(days=1)
+        self.fill_day(day, 50)
+        with CaptureQueriesContext(connection) as queries:
+            result = self.create_booking(day, "08:00", "09:00")
+        self.assertIn("clashes with existing booking", result["errors"][0]["message"])
+
+        lookups = [q["sql"] for q in queries.captured_queries
+                   if q["sql"].startswith("SELECT") and 'FROM "app_booking"' in q["sql"]]
+        self.assertEqual(len(lookups), 1)
+        self.assertIn("LIMIT 1", lookups[0])
+        with connection.cursor() as cursor:
+            plan = " ".join(row[-1] for row in cursor.execute("EXPLAIN QUERY PLAN " + lookups[0]).fetchall())
+        self.assertIn("booking_site_court_time_idx", plan)
+
+
+# Bulk and recurring bookings ==========================================================================================
+
+CREATE_BOOKINGS = """
+mutation($bookings: [BookingInput!]!) {
+  createBookings(bookings: $bookings) { bookings { date startTime } conflicts { date startTime reason } }
+}
+"""
+CREATE_RECURRING_BOOKING = """
+mutation($courtId: ID!, $weekday: Int!, $from: Date!, $until: Date!) {
+  createRecurringBooking(courtId: $courtId, startTime: "18:00", endTime: "19:00", weekday: $weekday,
+                         fromDate: $from, untilDate: $until) {
+    bookings { date } conflicts { date reason }
+  }
+}
+"""
+
+
+class BulkBookingTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.day = date.today() + timedelta(days=1)
+
+    def booking(self, start, end, day=None):
+        return {"courtId": self.court.id, "date": (day or self.day).isoformat(), "startTime": start, "endTime": end}
+
+    def create(self, *bookings):
+        return self.graphql(CREATE_BOOKINGS, {"bookings": list(bookings)})
+
+    def test_conflicts_are_reported_and_the_rest_created(self):
+        self.create_booking(self.day, "09:00", "10:00")
+        result = self.create(self.booking("09:30", "10:30"), self.booking("11:00", "12:00"),
+                             self.booking("06:00", "07:30"), self.booking("12:00", "12:10"))
+        created = result["data"]["createBookings"]
+        self.assertEqual([b["startTime"] for b in created["bookings"]], ["11:00:00"])
+        reasons = {c["startTime"]: c["reason"] for c in created["conflicts"]}
+        self.assertTrue(reasons["09:30:00"].startswith("Booking clashes with existing booking: "))
+        self.assertEqual(reasons["06:00:00"], "Booking starts before the court opens")
+        self.assertTrue(reasons["12:00:00"].startswith("Booking is too short"))
+        self.assertEqual(models.Booking.objects.count(), 2)
+
+    def test_clashes_within_the_request(self):
+        created = self.create(self.booking("09:00", "10:00"), self.booking("09:45", "10:15"),
+                              self.booking("10:00", "11:00"))["data"]["createBookings"]
+        self.assertEqual([b["startTime"] for b in created["bookings"]], ["09:00:00", "10:00:00"])
+        self.assertEqual(created["conflicts"], [{"date": self.day.isoformat(), "startTime": "09:45:00",
+                                                 "reason": "Booking clashes with another booking in this request"}])
+
+    def test_size_limit(self):
+        bookings = [self.booking("09:00", "10:00", self.day + timedelta(days=i)) for i in range(201)]
+        result = self.create(*bookings)
+        self.assertEqual(result["errors"][0]["message"], "Too many bookings in one request (max 200)")
+        self.assertFalse(models.Booking.objects.exists())
+
+    def test_captains_bypass_limits(self):
+        self.make_captain(self.user)
+        created = self.create(self.booking("12:00", "12:10"))["data"]["createBookings"]
+        self.assertEqual((len(created["bookings"]), created["conflicts"]), (1, []))
+
+    def test_recurring(self):
+        # Every Monday for three weeks: the second is already taken and the third is over 14 days away
+        monday = self.day + timedelta(days=(1 - self.day.isoweekday()) % 7)
+        models.Booking.objects.create(court=self.court, user=self.user, date=monday + timedelta(weeks=1),
+                                      start_time=time(18, 30), end_time=time(19, 30))
+        variables = {"courtId": self.court.id, "weekday": 1, "from": self.day.isoformat(),
+                     "until": (monday + timedelta(weeks=2)).isoformat()}
+        created = self.graphql(CREATE_RECURRING_BOOKING, variables)["data"]["createRecurringBooking"]
+        self.assertEqual([b["date"] for b in created["bookings"]], [monday.isoformat()])
+        reasons = [c["reason"] for c in created["conflicts"]]
+        self.assertTrue(reasons[0].startswith("Booking clashes with existing booking: "))
+        self.assertTrue(reasons[1].startswith("Booking is too far in advance"))
+        # Which captains may book anyway
+        self.make_captain(self.user)
+        created = self.graphql(CREATE_RECURRING_BOOKING, variables)["data"]["createRecurringBooking"]
+        self.assertEqual([b["date"] for b in created["bookings"]], [(monday + timedelta(weeks=2)).isoformat()])
+        self.assertEqual(len(created["conflicts"]), 2)
+
+    def test_recurring_arguments(self):
+        variables = {"courtId": self.court.id, "weekday": 8, "from": self.day.isoformat(),
+                     "until": self.day.isoformat()}
+        self.assertEqual(self.graphql(CREATE_RECURRING_BOOKING, variables)["errors"][0]["message"],
+                         "Weekday must be between 1 (Monday) and 7 (Sunday)")
+        variables.update(weekday=1, until=(self.day - timedelta(days=1)).isoformat())
+        self.assertEqual(self.graphql(CREATE_RECURRING_BOOKING, variables)["errors"][0]["message"],
+                         "Start of the date range must not be after the end")
+
+
+# Concurrent booking creation ==========================================================================================
+
+class ConcurrentCreateTests(TransactionTestCase):
+    """
+    Fires createBooking for one slot from several threads at once. Only one may win, however the clash checks and
+    inserts interleave. benchmark_rush measures throughput under the same contention.
+    """
+    THREADS = 8
+
+    def setUp(self):
+        cache.clear()
+        site = models.Site.objects.create(name="Test site", description="")
+        self.court = models.Court.objects.create(
+            site=site, name="Court 1", opening_time=time(7), closing_time=time(22))
+        self.tokens = [
+            Token.objects.create(user=User.objects.create(username=f"player{i}", email=f"player{i}@example.com")).key
+            for i in range(self.THREADS)
+        ]
+
+    def test_one_booking_per_slot(self):
+        day = (date.today() + timedelta(days=1)).isoformat()
+        variables = {"courtId": self.court.id, "date": day, "startTime": "18:00", "endTime": "19:00"}
+        start = threading.Barrier(self.THREADS)
+        results = [None] * self.THREADS
+
+        def create(i):
+            try:
+                start.wait()
+                response = Client().post(
+                    "/graphql", json.dumps({"query": CREATE_BOOKING, "variables": variables}),
+                    content_type="application/json", HTTP_AUTHORIZATION="Token " + self.tokens[i])
+                results[i] = response.json()
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=create, args=(i,)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        winners = [r for r in results if r and not r.get("errors")]
+        losers = [r["errors"][0]["message"] for r in results if r and r.get("errors")]
+        self.assertEqual(len(winners), 1)
+        self.assertEqual(len(losers), self.THREADS - 1)
+        for message in losers:
+            self.assertIn("clashes with existing booking", message)
+        self.assertEqual(models.Booking.objects.count(), 1)
+
+
+# Related rows in booking lists ========================================================================================
+
+ALL_BOOKINGS = "{ allBookings { id court { id name } user { id email } } }"
+BOOKINGS_BY_USER = """
+query($userId: ID!) {
+  bookingsByUser(userId: $userId) { id date court { name } user { firstName lastName } }
+}
+"""
+
+
+class BookingListQueryTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        courts = [self.court] + [
+            models.Court.objects.create(site=self.site, name=f"Court {i}", opening_time=time(7), closing_time=time(22))
+            for i in range(2, 5)
+        ]
+        users = [self.user] + [User.objects.create(username=f"player{i}", email=f"player{i}@example.com")
+                               for i in range(2, 6)]
+        day = date.today() + timedelta(days=1)
+        models.Booking.objects.bulk_create([
+            models.Booking(court=courts[i % len(courts)], site=self.site, user=users[i % len(users)],
+                           date=day + timedelta(days=i // 15), start_time=time(7 + i % 15), end_time=time(8 + i % 15))
+            for i in range(60)
+        ])
+        # The first request also looks up the token and fills the site and court caches
+        self.graphql("{ site { name } allCourts { id } }")
+
+    # Each list is one query with its courts and users joined in, whatever the number of bookings
+
+    def test_all_bookings(self):
+        with self.assertNumQueries(1):
+            result = self.graphql(ALL_BOOKINGS)
+        bookings = result["data"]["allBookings"]
+        self.assertEqual(len(bookings), 60)
+        self.assertEqual(len({b["court"]["name"] for b in bookings}), 4)
+        self.assertEqual(len({b["user"]["email"] for b in bookings}), 5)
+
+    def test_bookings_by_user(self):
+        with self.assertNumQueries(1):
+            result = self.graphql(BOOKINGS_BY_USER, {"userId": self.user.id})
+        bookings = result["data"]["bookingsByUser"]
+        self.assertEqual(len(bookings), 12)
+        self.assertEqual({b["user"]["lastName"] for b in bookings}, {""})
+
+
+class LoaderTests(GraphQLTestCase):
+
+    def test_loads_are_batched(self):
+        courts = [self.court] + [models.Court.objects.create(
+            site=self.site, name=f"Court {i}", opening_time=time(7), closing_time=time(22)) for i in range(2, 6)]
+        loaders = get_loaders(SimpleNamespace(context=SimpleNamespace()))
+
+        async def load_all():
+            pks = [court.id for court in courts] * 2 + [0]
+            *loaded, missing = await asyncio.gather(*(loaders.court.load(pk) for pk in pks))
+            return loaded, missing
+
+        with self.assertNumQueries(1):
+            loaded, missing = async_to_sync(load_all)()
+        self.assertEqual([court.name for court in loaded], [court.name for court in courts] * 2)
+        self.assertIs(loaded[0], loaded[len(courts)])
+        self.assertIsNone(missing)
+
+        # Loaded rows are kept for the rest of the request, and rows from elsewhere are never loaded
+        async def load_again():
+            user = loaders.user.prime(self.user)
+            return (loaders.court.prime(self.court), await loaders.court.load(self.court.id),
+                    user, await loaders.user.load(self.user.id))
+
+        with self.assertNumQueries(0):
+            primed_court, court, primed_user, user = async_to_sync(load_again)()
+        self.assertIs(primed_court, loaded[0])
+        self.assertIs(court, loaded[0])
+        self.assertIs(user, primed_user)
+
+
+# Booking windows and pages ============================================================================================
+
+BOOKINGS = """
+query($courtId: ID, $from: Date!, $to: Date!) { bookings(courtId: $courtId, from: $from, to: $to) { id date } }
+"""
+BOOKINGS_PAGE = """
+query($userId: ID!, $first: Int, $after: String) {
+  bookingsByUserConnection(userId: $userId, first: $first, after: $after) {
+    edges { cursor node { id } }
+    pageInfo { hasNextPage endCursor }
+  }
+}
+"""
+
+
+class BookingWindowTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.start = date.today() + timedelta(days=1)
+        self.other_court = models.Court.objects.create(
+            site=self.site, name="Court 2", opening_time=time(7), closing_time=time(22))
+        # One booking a day on each court, the day before the window to the day after it
+        for day in range(5):
+            for court in (self.court, self.other_court):
+                models.Booking.objects.create(court=court, user=self.user, date=self.start + timedelta(days=day),
+                                              start_time=time(9), end_time=time(10))
+
+    def bookings(self, first_day, last_day, **variables):
+        return self.graphql(BOOKINGS, {"from": (self.start + timedelta(days=first_day)).isoformat(),
+                                       "to": (self.start + timedelta(days=last_day)).isoformat(), **variables})
+
+    def test_window_includes_both_ends(self):
+        bookings = self.bookings(1, 3)["data"]["bookings"]
+        self.assertEqual(sorted({b["date"] for b in bookings}),
+                         [(self.start + timedelta(days=day)).isoformat() for day in (1, 2, 3)])
+        self.assertEqual(len(bookings), 6)
+        self.assertEqual(len(self.bookings(2, 2, courtId=self.other_court.id)["data"]["bookings"]), 1)
+
+    def test_reversed_or_missing_window(self):
+        result = self.bookings(3, 1)
+        self.assertEqual(result["errors"][0]["message"], "Start of the date window must not be after the end")
+        result = self.graphql("{ bookings(from: \"2024-01-01\") { id } }")
+        self.assertIn("argument 'to' of type 'Date!' is required", result["errors"][0]["message"])
+
+
+class BookingPageTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        day = date.today() + timedelta(days=1)
+        models.Booking.objects.bulk_create([
+            models.Booking(court=self.court, site=self.site, user=self.user, date=day + timedelta(days=i // 15),
+                           start_time=time(7 + i % 15), end_time=time(8 + i % 15))
+            for i in range(120)
+        ])
+
+    def page(self, **variables):
+        return self.graphql(BOOKINGS_PAGE, {"userId": self.user.id, **variables})
+
+    def test_pages(self):
+        first = self.page(first=50)["data"]["bookingsByUserConnection"]
+        self.assertEqual(len(first["edges"]), 50)
+        self.assertTrue(first["pageInfo"]["hasNextPage"])
+        last = self.page(first=100, after=first["pageInfo"]["endCursor"])["data"]["bookingsByUserConnection"]
+        self.assertEqual(len(last["edges"]), 70)
+        self.assertFalse(last["pageInfo"]["hasNextPage"])
+        self.assertEqual(len({e["node"]["id"] for e in first["edges"] + last["edges"]}), 120)
+        # Past the end
+        empty = self.page(first=10, after=last["pageInfo"]["endCursor"])["data"]["bookingsByUserConnection"]
+        self.assertEqual(empty["edges"], [])
+
+    def test_page_size_limit(self):
+        # Without first, a page is RELAY_CONNECTION_MAX_LIMIT long
+        page = self.page()["data"]["bookingsByUserConnection"]
+        self.assertEqual(len(page["edges"]), 100)
+        self.assertTrue(page["pageInfo"]["hasNextPage"])
+        result = self.page(first=101)
+        self.assertEqual(result["errors"][0]["message"], "first must be between 0 and 100")
+        self.assertIsNone(result["data"]["bookingsByUserConnection"])
+
+
+# Availability bitmaps =================================================================================================
+
+AVAILABILITY = """
+query($courtId: ID!, $from: Date!, $to: Date!) {
+  availability(courtId: $courtId, from: $from, to: $to) { openingTime slotMinutes booked }
+}
+"""
+DELETE_BOOKING = "mutation($bookingId: ID) { deleteBooking(bookingId: $bookingId) { ok } }"
+
+
+class AvailabilityTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.day = date.today() + timedelta(days=1)
+
+    def booked(self):
+        day = self.day.isoformat()
+        return self.graphql(AVAILABILITY, {"courtId": self.court.id, "from": day, "to": day})["data"]["availability"][0]
+
+    def stored(self):
+        return models.CourtAvailability.objects.get(court=self.court, date=self.day)
+
+    def test_create_and_delete(self):
+        result = self.create_booking(self.day, "09:00", "10:00")
+        # Four 15 minute slots, two hours after opening
+        self.assertEqual(self.stored().bits, 0b1111 << 8)
+        self.assertEqual(self.booked()["booked"], "0" * 8 + "1111" + "0" * 48)
+        booking_id = result["data"]["createBooking"]["booking"]["id"]
+        self.assertTrue(self.graphql(DELETE_BOOKING, {"bookingId": booking_id})["data"]["deleteBooking"]["ok"])
+        self.assertEqual(self.stored().bits, 0)
+        self.assertEqual(self.booked()["booked"], "0" * 60)
+
+    def test_stale_row_after_opening_time_changes(self):
+        self.create_booking(self.day, "09:00", "10:00")
+        self.court.opening_time = time(8)
+        self.court.save()
+        # Read from the Booking rows while the stored row still counts from 07:00
+        self.assertEqual(self.stored().opening_time, time(7))
+        self.assertEqual(self.booked(), {"openingTime": "08:00:00", "slotMinutes": 15,
+                                         "booked": "0" * 4 + "1111" + "0" * 48})
+        # And rewritten by the next booking that day
+        self.create_booking(self.day, "12:00", "12:15")
+        row = self.stored()
+        self.assertEqual((row.opening_time, row.bits), (time(8), 0b1111 << 4 | 1 << 16))
+
+
+# Document cache and persisted queries =================================================================================
+
+class DocumentCacheTests(GraphQLTestCase):
+    QUERY = "{ site { name } allCourts { id name } }"
+
+    def post(self, body):
+        return self.client.post("/graphql", json.dumps(body), content_type="application/json",
+                                HTTP_AUTHORIZATION="Token " + self.token)
+
+    def test_repeat_queries_skip_parse_and_validation(self):
+        with mock.patch("app.documents.parse", wraps=documents.parse) as parse, \
+                mock.patch("app.documents.validate", wraps=documents.validate) as validate:
+            for _ in range(5):
+                self.assertEqual(self.graphql(self.QUERY)["data"]["site"]["name"], "Test site")
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(validate.call_count, 1)
+
+    def test_persisted_query_hash(self):
+        extensions = {"persistedQuery": {"version": 1, "sha256Hash": documents.query_hash(self.QUERY)}}
+        result = self.post({"extensions": extensions}).json()
+        self.assertEqual(result["errors"][0]["message"], "PersistedQueryNotFound")
+        self.post({"query": self.QUERY, "extensions": extensions})
+        result = self.post({"extensions": extensions}).json()
+        self.assertEqual(result["data"]["allCourts"], [{"id": str(self.court.id), "name": "Court 1"}])
+
+    def test_malformed_persisted_query(self):
+        for persisted_query in ("abc", ["abc"], {"sha256Hash": ["abc"]}):
+            response = self.post({"query": self.QUERY, "extensions": {"persistedQuery": persisted_query}})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("persistedQuery", response.json()["errors"][0]["message"])
+
+
+urlpatterns = [
+    path("graphql", csrf_exempt(views.AsyncGraphQLView.as_view())),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class ConditionalGetTests(GraphQLTestCase):
+    QUERY = "{ site { name } allCourts { name } }"
+
+    def get(self, etag=None):
+        headers = {"HTTP_AUTHORIZATION": "Token " + self.token}
+        if etag is not None:
+            headers["HTTP_IF_NONE_MATCH"] = etag
+        return self.client.get("/graphql", {"query": self.QUERY}, HTTP_ACCEPT="application/json", **headers)
+
+    def test_unchanged_response_is_not_modified(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("private", response["Cache-Control"])
+        self.assertIn("Authorization", response["Vary"])
+        etag = response["ETag"]
+        response = self.get(etag)
+        self.assertEqual((response.status_code, response.content), (304, b""))
+        # POSTs are left alone
+        self.assertFalse(self.client.post("/graphql", {"query": self.QUERY}, content_type="application/json",
+                                          HTTP_AUTHORIZATION="Token " + self.token).has_header("ETag"))
+
+    def test_site_and_court_changes(self):
+        etag = self.get()["ETag"]
+        self.site.name = "Renamed site"
+        self.site.save()
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["site"]["name"], "Renamed site")
+        etag = response["ETag"]
+        models.Court.objects.create(site=self.site, name="Court 2", opening_time=time(7), closing_time=time(22))
+        response = self.get(etag)
+        self.assertEqual([c["name"] for c in response.json()["data"]["allCourts"]], ["Court 1", "Court 2"])
+        etag = response["ETag"]
+        self.court.delete()
+        response = self.get(etag)
+        self.assertEqual([c["name"] for c in response.json()["data"]["allCourts"]], ["Court 2"])
+        self.assertEqual(self.get(response["ETag"]).status_code, 304)
+        self.site.delete()
+        self.assertIsNone(self.get().json()["data"]["site"])
+
+
+class DocumentCacheBenchmarkTests(GraphQLTestCase):
+    # The benchmark counts the queries on every connection
+    databases = {DEFAULT_DB_ALIAS, database.REPLICA}
+
+    def run_benchmark(self, *args):
+        with tempfile.NamedTemporaryFile(suffix=".json") as output, \
+                mock.patch("app.documents.parse", wraps=documents.parse) as parse:
+            call_command("benchmark", "--duration", "0.5", "--warmup", "0", "--writes", "0", "--seed", "1",
+                         "--output", output.name, *args, stdout=io.StringIO())
+            report = json.load(output)
+        return report, parse.call_count
+
+    def test_no_document_cache(self):
+        # Every request's document is parsed again, so the two runs' latencies show what the cache saves
+        report, parsed = self.run_benchmark("--no-document-cache")
+        self.assertFalse(report["meta"]["document_cache"])
+        self.assertEqual(parsed, report["total"]["count"])
+        report, parsed = self.run_benchmark()
+        self.assertTrue(report["meta"]["document_cache"])
+        self.assertLessEqual(parsed, len(report["operations"]))
+        self.assertGreater(report["total"]["count"], len(report["operations"]))
+
+
+class AsyncAtomicMutationTests(GraphQLTestCase):
+
+    async def test_mutation_is_charged_once(self):
+        # Atomic mutations go through the sync view in a thread
+        bucket = mock.Mock()
+        bucket.consume.return_value = 0
+        with mock.patch.object(views.graphene_settings, "ATOMIC_MUTATIONS", True), \
+                mock.patch("app.views.get_bucket", return_value=bucket):
+            response = await AsyncClient().post(
+                "/graphql", json.dumps({"query": CREATE_BOOKING, "variables": {
+                    "courtId": self.court.id, "date": (date.today() + timedelta(days=1)).isoformat(),
+                    "startTime": "18:00", "endTime": "19:00"}}),
+                content_type="application/json", headers={"Authorization": "Token " + self.token})
+        self.assertNotIn("errors", response.json())
+        self.assertEqual(bucket.consume.call_count, 1)
+        self.assertEqual(await models.Booking.objects.acount(), 1)
+
+
+# Subscriptions ========================================================================================================
+
+class WebSocketClient(object):
+    """
+    Talks graphql-transport-ws to GraphQLWebSocketApp through its ASGI interface, without a server.
+    """
+
+    def __init__(self, app, headers=None):
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        scope = {
+            "type": "websocket",
+            "path": "/graphql",
+            "subprotocols": [GraphQLWebSocketApp.subprotocol],
+            "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        }
+        self.incoming.put_nowait({"type": "websocket.connect"})
+        self.task = asyncio.ensure_future(app(scope, self.incoming.get, self.outgoing.put))
+
+    async def send(self, payload):
+        await self.incoming.put({"type": "websocket.receive", "text": json.dumps(payload)})
+
+    async def receive(self):
+        # The next message as sent, with its JSON text decoded
+        message = await asyncio.wait_for(self.outgoing.get(), timeout=5)
+        return json.loads(message["text"]) if "text" in message else message
+
+    async def connect(self, payload=None):
+        # websocket.accept first
+        await self.receive()
+        await self.send({"type": "connection_init", **({"payload": payload} if payload is not None else {})})
+        return await self.receive()
+
+    async def disconnect(self):
+        await self.incoming.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self.task, timeout=5)
+
+
+BOOKING_CHANGED = "subscription { bookingChanged { action bookingId courtId date } }"
+
+
+class SubscriptionLoadTests(GraphQLTestCase):
+    SUBSCRIBERS = 200
+
+    async def test_many_subscribers(self):
+        broker = InProcessBroker()
+        app = GraphQLWebSocketApp(schema)
+        day = date.today() + timedelta(days=1)
+        with mock.patch("app.pubsub._broker", broker):
+            clients = [WebSocketClient(app) for _ in range(self.SUBSCRIBERS)]
+            for i, client in enumerate(clients):
+                self.assertEqual((await client.connect(self.connection_params))["type"], "connection_ack")
+                await client.send({"id": str(i), "type": "subscribe", "payload": {"query": BOOKING_CHANGED}})
+            await self.wait_for(lambda: len(broker.subscribers) == self.SUBSCRIBERS)
+
+            broker.publish(BookingChange(BookingChange.CREATED, 1, self.site.id, self.court.id, day))
+            broker.publish(BookingChange(BookingChange.DELETED, 1, self.site.id, self.court.id, day))
+            for i, client in enumerate(clients):
+                for action in (BookingChange.CREATED, BookingChange.DELETED):
+                    message = await client.receive()
+                    self.assertEqual(message["id"], str(i))
+                    self.assertEqual(message["payload"]["data"]["bookingChanged"], {
+                        "action": action, "bookingId": "1", "courtId": str(self.court.id), "date": day.isoformat()})
+
+            for client in clients:
+                await client.disconnect()
+            # Every subscription lets go of the broker when its socket closes
+            self.assertEqual(len(broker.subscribers), 0)
+
+
+class SubscriptionOperationTests(GraphQLTestCase):
+
+    async def subscribe(self, client, operation_id):
+        await client.send({"id": operation_id, "type": "subscribe", "payload": {"query": BOOKING_CHANGED}})
+
+    async def test_operation_limit(self):
+        broker = InProcessBroker()
+        app = GraphQLWebSocketApp(schema)
+        app.max_operations = 2
+        with mock.patch("app.pubsub._broker", broker):
+            client = WebSocketClient(app)
+            await client.connect(self.connection_params)
+            for operation_id in "abc":
+                await self.subscribe(client, operation_id)
+            message = await client.receive()
+            self.assertEqual((message["id"], message["type"]), ("c", "error"))
+            self.assertEqual(message["payload"][0]["message"], "Too many operations on this connection (max 2)")
+            # Finishing one makes room for another
+            await client.send({"id": "a", "type": "complete"})
+            await self.subscribe(client, "c")
+            await self.wait_for(lambda: len(broker.subscribers) == 2)
+            await client.disconnect()
+
+    async def test_reused_id(self):
+        broker = InProcessBroker()
+        day = date.today() + timedelta(days=1)
+        with mock.patch("app.pubsub._broker", broker):
+            client = WebSocketClient(GraphQLWebSocketApp(schema))
+            await client.connect(self.connection_params)
+            await self.subscribe(client, "1")
+            await self.wait_for(lambda: len(broker.subscribers) == 1)
+            first = set(broker.subscribers)
+            # The new operation is registered before the old one has finished unwinding
+            await client.send({"id": "1", "type": "complete"})
+            await self.subscribe(client, "1")
+            await self.wait_for(lambda: len(broker.subscribers) == 1 and broker.subscribers != first)
+            broker.publish(BookingChange(BookingChange.CREATED, 1, self.site.id, self.court.id, day))
+            self.assertEqual((await client.receive())["id"], "1")
+            # And can still be completed
+            await client.send({"id": "1", "type": "complete"})
+            await self.wait_for(lambda: len(broker.subscribers) == 0)
+            await client.disconnect()
+
+
+# Rate limiting ========================================================================================================
+
+class RateLimitTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Three requests' worth, refilled too slowly to matter
+        self.bucket = limits.TokenBucket(rate=0.001, burst=3)
+        patcher = mock.patch("app.limits._bucket", self.bucket)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, token):
+        return self.client.post("/graphql", {"query": "{ site { name } }"}, content_type="application/json",
+                                HTTP_AUTHORIZATION="Token " + token)
+
+    def test_made_up_tokens_share_the_address_bucket(self):
+        self.assertEqual([self.post(f"made-up-{i}").status_code for i in range(4)][-1], 429)
+        self.assertEqual(set(self.bucket.buckets), {"ip:127.0.0.1"})
+        # A real token has its own bucket
+        self.assertEqual(self.post(self.token).status_code, 200)
+        self.assertIn(f"user:{self.user.pk}", self.bucket.buckets)
+
+    async def test_subscriptions_are_charged(self):
+        client = WebSocketClient(GraphQLWebSocketApp(schema))
+        self.assertEqual((await client.connect(self.connection_params))["type"], "connection_ack")
+        for i in range(4):
+            await client.send({"id": str(i), "type": "subscribe", "payload": {"query": BOOKING_CHANGED}})
+        message = await client.receive()
+        self.assertEqual((message["id"], message["type"]), ("3", "error"))
+        self.assertEqual(message["payload"][0]["message"], "Too many requests, please slow down")
+        await client.disconnect()
+
+
+# Auth token cache =====================================================================================================
+
+SESSION_INFO = "{ sessionInfo { isAuthenticated groups } }"
+
+
+class TokenCacheTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        middleware._token_cache.clear()
+        self.captains = Group.objects.create(name="captain")
+
+    def session(self):
+        return self.graphql(SESSION_INFO)["data"]["sessionInfo"]
+
+    def test_cached_token_needs_no_queries(self):
+        self.assertEqual(self.session(), {"isAuthenticated": True, "groups": []})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.session(), {"isAuthenticated": True, "groups": []})
+
+    def test_deleted_token(self):
+        self.session()
+        Token.objects.filter(key=self.token).delete()
+        self.assertNotIn(self.token, middleware._token_cache)
+        self.assertEqual(self.graphql(SESSION_INFO)["data"]["sessionInfo"], None)
+
+    def test_group_membership_changes(self):
+        self.session()
+        self.user.groups.add(self.captains)
+        self.assertEqual(self.session()["groups"], ["captain"])
+        self.captains.user_set.remove(self.user)
+        self.assertEqual(self.session()["groups"], [])
+        self.captains.user_set.add(self.user)
+        self.assertEqual(self.session()["groups"], ["captain"])
+        self.captains.user_set.clear()
+        self.assertEqual(self.session()["groups"], [])
+
+    def test_renamed_group(self):
+        self.user.groups.add(self.captains)
+        self.session()
+        self.captains.name = "vice-captain"
+        self.captains.save()
+        self.assertEqual(self.session()["groups"], ["vice-captain"])
+
+
+# Async view ===========================================================================================================
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncViewTests(GraphQLTestCase):
+    DELAY = 0.3
+
+    def slowly(self, resolve):
+        async def slow_resolve():
+            await asyncio.sleep(self.DELAY)
+            return await resolve()
+        return slow_resolve
+
+    async def test_sibling_fields_resolve_concurrently(self):
+        # With site and allCourts each waiting DELAY seconds, the request takes about DELAY rather than twice it
+        with mock.patch("app.cache.aget_site", self.slowly(cache_module.aget_site)), \
+                mock.patch("app.cache.aget_courts", self.slowly(cache_module.aget_courts)):
+            started = time_module.monotonic()
+            response = await AsyncClient().post(
+                "/graphql", json.dumps({"query": "{ site { name } allCourts { name } }"}),
+                content_type="application/json", headers={"Authorization": "Token " + self.token})
+            elapsed = time_module.monotonic() - started
+        self.assertEqual(response.json()["data"], {"site": {"name": "Test site"}, "allCourts": [{"name": "Court 1"}]})
+        self.assertGreaterEqual(elapsed, self.DELAY)
+        self.assertLess(elapsed, self.DELAY * 1.8)
+
+
+# Calendar grid ========================================================================================================
+
+CALENDAR = "query($from: Date!, $to: Date!) { calendar(from: $from, to: $to) { courts days } }"
+
+
+class CalendarGridTests(GraphQLTestCase):
+
+    def test_court_missing_from_the_cache(self):
+        day = date.today() + timedelta(days=1)
+        self.graphql(CALENDAR, {"from": day.isoformat(), "to": day.isoformat()})
+        # As if another process had added it: bulk_create sends no signals, so this process's cache keeps the old list
+        court = models.Court.objects.bulk_create([models.Court(
+            site=self.site, name="Court 2", opening_time=time(7), closing_time=time(22))])[0]
+        models.Booking.objects.create(court=court, user=self.user, date=day, start_time=time(9), end_time=time(10))
+        result = self.graphql(CALENDAR, {"from": day.isoformat(), "to": day.isoformat()})
+        calendar = result["data"]["calendar"]
+        self.assertEqual(calendar["courts"], [[self.court.id, "Court 1"], [court.id, "Court 2"]])
+        self.assertEqual(calendar["days"][day.isoformat()][0][:3], [1, 9 * 60, 10 * 60])
+
+
+# Slot finder ==========================================================================================================
+
+FIND_SLOTS = """
+query($from: Date!, $to: Date!, $first: Int) {
+  findSlots(duration: 60, from: $from, to: $to, first: $first) { court { name } date startTime }
+}
+"""
+TOP_BOOKERS = "query($from: Date!, $to: Date!) { topBookers(from: $from, to: $to) { user { email } bookedMinutes } }"
+
+
+class SlotFinderTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.make_captain(self.user)
+        self.start = date.today() + timedelta(days=1)
+
+    def find_slots(self, days, first=None):
+        variables = {"from": self.start.isoformat(), "to": (self.start + timedelta(days=days - 1)).isoformat()}
+        if first is not None:
+            variables["first"] = first
+        return self.graphql(FIND_SLOTS, variables)
+
+    def test_default_first_is_cheap(self):
+        # Costed at the argument's default of 10 slots rather than as a 100-item list
+        result = self.find_slots(14)
+        self.assertNotIn("errors", result)
+        self.assertEqual(len(result["data"]["findSlots"]), 10)
+        result = self.graphql(TOP_BOOKERS, {"from": self.start.isoformat(), "to": self.start.isoformat()})
+        self.assertNotIn("errors", result)
+
+    @override_settings(GRAPHQL_QUERY_LIMITS={"MAX_COST": 200})
+    def test_first_from_variables_is_costed_per_request(self):
+        # 100 for the search, plus a slot and its court for each of first: 140 for 20, 300 for 100. One court has one
+        # slot a day, at the start of its free day
+        result = self.find_slots(30, first=20)
+        self.assertNotIn("errors", result)
+        self.assertEqual(len(result["data"]["findSlots"]), 20)
+        result = self.find_slots(30, first=100)
+        self.assertIn("Query is too expensive (cost 300", result["errors"][0]["message"])
+
+    def test_term_is_searched_a_week_at_a_time(self):
+        # A term booked solid except for its last day: one bookings query per week of it, and the slot is on that day
+        days = 91
+        models.Booking.objects.bulk_create([
+            models.Booking(court=self.court, site=self.site, user=self.user, date=self.start + timedelta(days=day),
+                           start_time=time(7 + hour), end_time=time(8 + hour))
+            for day in range(days - 1) for hour in range(15)
+        ])
+        self.find_slots(1)
+        with CaptureQueriesContext(connection) as queries:
+            result = self.find_slots(days, first=1)
+        self.assertEqual(result["data"]["findSlots"], [{
+            "court": {"name": "Court 1"}, "date": (self.start + timedelta(days=days - 1)).isoformat(),
+            "startTime": "07:00:00"}])
+        lookups = [q for q in queries.captured_queries if 'FROM "app_booking"' in q["sql"]]
+        self.assertEqual(len(lookups), days // 7)
+
+
+# Usage reports ========================================================================================================
+
+class UtilisationTests(GraphQLTestCase):
+    QUERY = """
+    query($from: Date!, $to: Date!, $granularity: UsageGranularity) {
+      courtUtilisation(from: $from, to: $to, granularity: $granularity) { bookedMinutes openMinutes }
+    }
+    """
+
+    def test_long_windows_are_refused_up_front(self):
+        for granularity in ("HOUR", "DAY", "MONTH"):
+            started = time_module.monotonic()
+            result = self.client.post("/graphql", {"query": self.QUERY, "variables": {
+                "from": "0001-01-01", "to": "9999-12-31", "granularity": granularity}},
+                content_type="application/json").json()
+            self.assertLess(time_module.monotonic() - started, 1)
+            self.assertIn("Date window is too long", result["errors"][0]["message"])
+
+    def test_hourly_report(self):
+        day = date.today() + timedelta(days=1)
+        self.create_booking(day, "09:00", "10:30")
+        result = self.graphql(self.QUERY, {"from": day.isoformat(), "to": day.isoformat(), "granularity": "HOUR"})
+        rows = result["data"]["courtUtilisation"]
+        self.assertEqual(len(rows), 15)
+        self.assertEqual(sum(row["bookedMinutes"] for row in rows), 90)
+        self.assertEqual({row["openMinutes"] for row in rows}, {60})
+
+    def test_cost(self):
+        # The report's own cost, plus its rows
+        document = parse("{ courtUtilisation(from: \"2024-01-01\", to: \"2024-01-31\") { bookedMinutes } }")
+        self.assertEqual(limits.operation_costs(schema.graphql_schema, document), {None: 200})
+
+
+class TopBookersTests(GraphQLTestCase):
+
+    def test_users_are_loaded_together(self):
+        day = date.today() + timedelta(days=1)
+        users = [self.user] + [User.objects.create(username=f"player{i}", email=f"player{i}@example.com")
+                               for i in range(2, 11)]
+        models.Booking.objects.bulk_create([
+            models.Booking(court=self.court, site=self.site, user=user, date=day,
+                           start_time=time(7 + i), end_time=time(8 + i))
+            for i, user in enumerate(users)
+        ])
+        self.graphql("{ site { name } }")
+        # The live and archived bookings, then every booker's user at once
+        with self.assertNumQueries(3):
+            result = self.graphql(TOP_BOOKERS, {"from": day.isoformat(), "to": day.isoformat()})
+        bookers = result["data"]["topBookers"]
+        self.assertEqual({b["user"]["email"] for b in bookers}, {user.email for user in users})
+        self.assertEqual({b["bookedMinutes"] for b in bookers}, {60})
+
+
+# Booking export =======================================================================================================
+
+class ExportTests(GraphQLTestCase):
+
+    def export(self):
+        return self.client.get("/export/bookings.csv", HTTP_AUTHORIZATION="Token " + self.token)
+
+    def test_captains_and_admins_only(self):
+        self.assertEqual(self.export().status_code, 403)
+        # Group names are matched in any case, as for the GraphQL mutations
+        self.user.groups.add(Group.objects.create(name="Captain"))
+        response = self.export()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"].split(";")[0], "text/csv")
+
+    def test_group_filter(self):
+        self.make_captain(self.user)
+        # Both match "captain", which mustn't list the user's bookings twice
+        self.user.groups.add(Group.objects.create(name="CAPTAIN"))
+        other = User.objects.create(username="other", email="other@example.com")
+        day = date.today() + timedelta(days=1)
+        for user, hour in ((self.user, 9), (other, 10)):
+            models.Booking.objects.create(
+                court=self.court, user=user, date=day, start_time=time(hour), end_time=time(hour + 1))
+        response = self.client.get("/export/bookings.csv", {"group": "Captain"},
+                                   HTTP_AUTHORIZATION="Token " + self.token)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn("player@example.com", lines[1])
+
+
+# Booking requests =====================================================================================================
+
+class ArchiveTests(GraphQLTestCase):
+
+    def test_requested_bookings_are_archived(self):
+        day = date.today() - timedelta(days=1)
+        booking = models.Booking.objects.create(
+            court=self.court, user=self.user, date=day, start_time=time(9), end_time=time(10))
+        request = models.BookingRequest.objects.create(
+            user=self.user, court=self.court, date=day, start_time=time(9), end_time=time(10), lottery_key=1,
+            status=models.BookingRequest.ACCEPTED, booking=booking)
+        self.assertEqual(sum(archive.archive_before(date.today())), 1)
+        self.assertFalse(models.Booking.objects.exists())
+        self.assertEqual(models.BookingArchive.objects.get().booking_id, booking.id)
+        request.refresh_from_db()
+        self.assertIsNone(request.booking_id)
+        self.assertEqual(request.status, models.BookingRequest.ACCEPTED)
+        # As the rows are left at the end of a committed batch
+        connection.check_constraints()
+
+    def make_past_bookings(self, days):
+        # A booking at 09:00 on each of the given number of days before today, the oldest first
+        today = date.today()
+        models.Booking.objects.bulk_create([
+            models.Booking(court=self.court, site=self.site, user=self.user, date=today - timedelta(days=day),
+                           start_time=time(9), end_time=time(10))
+            for day in range(days, 0, -1)
+        ])
+
+    def test_batches_and_cutoff(self):
+        self.make_past_bookings(7)
+        cutoff = date.today() - timedelta(days=2)
+        models.CourtAvailability.objects.create(court=self.court, date=cutoff - timedelta(days=1), opening_time=time(7),
+                                                slot_minutes=15, bits=1)
+        self.assertEqual(list(archive.archive_before(cutoff, batch_size=2)), [2, 2, 1])
+        # Bookings on the cutoff day and after are left
+        self.assertEqual(models.Booking.objects.filter(date__gte=cutoff).count(), 2)
+        self.assertFalse(models.Booking.objects.filter(date__lt=cutoff).exists())
+        self.assertEqual(models.BookingArchive.objects.count(), 5)
+        self.assertFalse(models.CourtAvailability.objects.filter(date__lt=cutoff).exists())
+        with self.assertRaisesMessage(ValueError, "Only past bookings can be archived"):
+            list(archive.archive_before(date.today() + timedelta(days=1)))
+
+    def test_command(self):
+        self.make_past_bookings(7)
+        out = io.StringIO()
+        call_command("archive_bookings", days=3, dry_run=True, stdout=out)
+        self.assertIn("4 booking(s)", out.getvalue())
+        self.assertEqual(models.Booking.objects.count(), 7)
+        call_command("archive_bookings", days=3, batch_size=3, stdout=out)
+        self.assertIn("Archived 4 booking(s)", out.getvalue())
+        self.assertEqual(models.BookingArchive.objects.count(), 4)
+        with self.assertRaisesMessage(CommandError, "Only past bookings can be archived"):
+            call_command("archive_bookings", before=date.today() + timedelta(days=1), stdout=out)
+
+
+BOOKING_HISTORY = """
+query($courtId: ID, $userId: ID, $from: Date, $to: Date, $first: Int, $after: String) {
+  bookingHistory(courtId: $courtId, userId: $userId, from: $from, to: $to, first: $first, after: $after) {
+    edges { node { date court { name } user { username } } }
+    pageInfo { hasNextPage endCursor }
+  }
+}
+"""
+
+
+class BookingHistoryTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other_user = User.objects.create(username="other")
+        self.other_court = models.Court.objects.create(
+            site=self.site, name="Court 2", opening_time=time(7), closing_time=time(22))
+        self.first_day = date.today() - timedelta(days=10)
+        models.BookingArchive.objects.bulk_create([
+            models.BookingArchive(booking_id=i, court=court, site=self.site, user=user,
+                                  date=self.first_day + timedelta(days=i), start_time=time(9), end_time=time(10),
+                                  created_at=timezone.now())
+            for i, (court, user) in enumerate([(self.court, self.user), (self.other_court, self.user),
+                                               (self.court, self.other_user), (self.court, self.user)])
+        ])
+
+    def history(self, **variables):
+        return self.graphql(BOOKING_HISTORY, variables)["data"]["bookingHistory"]
+
+    def days(self, **variables):
+        return [(date.fromisoformat(e["node"]["date"]) - self.first_day).days
+                for e in self.history(**variables)["edges"]]
+
+    def test_filters(self):
+        self.assertEqual(self.days(), [0, 1, 2, 3])
+        self.assertEqual(self.days(courtId=self.court.id), [0, 2, 3])
+        self.assertEqual(self.days(userId=self.user.id), [0, 1, 3])
+        self.assertEqual(self.days(courtId=self.court.id, userId=self.user.id), [0, 3])
+        self.assertEqual(self.days(**{"from": (self.first_day + timedelta(days=1)).isoformat(),
+                                      "to": (self.first_day + timedelta(days=2)).isoformat()}), [1, 2])
+        node = self.history(first=1)["edges"][0]["node"]
+        self.assertEqual(node["court"], {"name": "Court 1"})
+        self.assertEqual(node["user"], {"username": "player"})
+
+    def test_pages(self):
+        page = self.history(first=3)
+        self.assertTrue(page["pageInfo"]["hasNextPage"])
+        self.assertEqual(self.days(first=3, after=page["pageInfo"]["endCursor"]), [3])
+        result = self.graphql(BOOKING_HISTORY, {"first": 101})
+        self.assertEqual(result["errors"][0]["message"], "first must be between 0 and 100")
+
+
+BOOKING_REQUEST_DECIDED = "subscription($id: ID!) { bookingRequestDecided(requestId: $id) { id status } }"
+
+
+class BookingRequestSubscriptionTests(GraphQLTestCase):
+
+    def make_request(self, user):
+        return models.BookingRequest.objects.create(
+            user=user, court=self.court, date=date.today() + timedelta(days=1), start_time=time(9), end_time=time(10),
+            lottery_key=1, status=models.BookingRequest.REJECTED)
+
+    async def subscribe(self, request):
+        client = WebSocketClient(GraphQLWebSocketApp(schema))
+        self.assertEqual((await client.connect(self.connection_params))["type"], "connection_ack")
+        await client.send({"id": "1", "type": "subscribe",
+                           "payload": {"query": BOOKING_REQUEST_DECIDED, "variables": {"id": request.id}}})
+        message = await client.receive()
+        await client.disconnect()
+        return message
+
+    async def test_connection_needs_a_token(self):
+        for payload in (None, {}, {"authorization": "Token nope"}, {"authorization": self.token}):
+            client = WebSocketClient(GraphQLWebSocketApp(schema))
+            self.assertEqual(await client.connect(payload), {"type": "websocket.close", "code": 4403,
+                                                             "reason": "Forbidden"})
+
+    async def test_own_request(self):
+        request = await sync_to_async(self.make_request)(self.user)
+        message = await self.subscribe(request)
+        self.assertEqual(message["payload"]["data"]["bookingRequestDecided"], {
+            "id": str(request.id), "status": "REJECTED"})
+
+    async def test_other_users_request(self):
+        other = await User.objects.acreate(username="other", email="other@example.com")
+        request = await sync_to_async(self.make_request)(other)
+        message = await self.subscribe(request)
+        self.assertEqual(message["type"], "error")
+        self.assertEqual(message["payload"][0]["message"], "Invalid booking request ID")
+        # Admins see everyone's
+        await sync_to_async(self.user.groups.add)(await sync_to_async(Group.objects.create)(name="Admin"))
+        message = await self.subscribe(request)
+        self.assertEqual(message["payload"]["data"]["bookingRequestDecided"]["status"], "REJECTED")
+
+
+# Calendar feeds =======================================================================================================
+
+class CalendarFeedTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.day = date.today() + timedelta(days=1)
+        self.user_feed = f"/calendar/user/{ical.user_token(self.user.pk)}.ics"
+        self.court_feed = f"/calendar/court/{self.court.id}.ics"
+
+    def get(self, url, etag=None):
+        response = self.client.get(url, **({"HTTP_IF_NONE_MATCH": etag} if etag is not None else {}))
+        # Feeds that aren't cached yet are streamed
+        response.body = b"".join(response.streaming_content) if response.streaming else response.content
+        return response
+
+    def book(self, start):
+        # The new versions are only set once the booking commits
+        with self.captureOnCommitCallbacks(execute=True):
+            return models.Booking.objects.create(court=self.court, user=self.user, date=self.day,
+                                                 start_time=start, end_time=time(start.hour + 1))
+
+    def test_unchanged_feed_is_not_modified(self):
+        self.book(time(9))
+        for url in (self.user_feed, self.court_feed):
+            response = self.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b"BEGIN:VEVENT", response.body)
+            with self.assertNumQueries(0):
+                response = self.get(url, response["ETag"])
+            self.assertEqual((response.status_code, response.body), (304, b""))
+
+    def test_changes_give_a_new_version(self):
+        booking = self.book(time(9))
+        user_etag, court_etag = self.get(self.user_feed)["ETag"], self.get(self.court_feed)["ETag"]
+        self.book(time(11))
+        for url, etag in ((self.user_feed, user_etag), (self.court_feed, court_etag)):
+            response = self.get(url, etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response["ETag"], etag)
+            self.assertEqual(response.body.count(b"BEGIN:VEVENT"), 2)
+        court_etag = self.get(self.court_feed)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.delete()
+        response = self.get(self.court_feed, court_etag)
+        self.assertEqual((response.status_code, response.body.count(b"BEGIN:VEVENT")), (200, 1))
+
+    def test_unknown_feeds(self):
+        self.assertEqual(self.get("/calendar/user/made-up.ics").status_code, 404)
+        self.assertEqual(self.get(f"/calendar/court/{self.court.id + 1}.ics").status_code, 404)
+
+
+# SQL tracing ==========================================================================================================
+
+class ConnectionSetupTests(TestCase):
+
+    def test_reconnecting_keeps_one_sql_wrapper(self):
+        # As a long-lived thread's connection does each time close_old_connections() or CONN_MAX_AGE closes it
+        reused = connections.create_connection(DEFAULT_DB_ALIAS)
+        try:
+            for _ in range(5):
+                reused.connect()
+                reused.close()
+            self.assertEqual(reused.execute_wrappers.count(tracing.record_sql), 1)
+        finally:
+            reused.close()
+
+
+# Sites ================================================================================================================
+
+class SiteTests(GraphQLTestCase):
+
+    @override_settings(ALLOWED_HOSTS=["testserver", ".example.com"])
+    def test_site_by_host(self):
+        models.Site.objects.create(name="Other site", description="", domain="other.example.com")
+        for host, name in (("other.example.com", "Other site"), ("unknown.example.com", "Test site")):
+            response = self.client.post("/graphql", {"query": "{ site { name } }"}, content_type="application/json",
+                                        HTTP_HOST=host)
+            self.assertEqual(response.json()["data"]["site"]["name"], name)
+
+    def test_unknown_names_are_answered_from_the_cache(self):
+        self.assertEqual(cache_module.find_site(str(self.site.id)), self.site)
+        with self.assertNumQueries(0):
+            for i in range(100):
+                self.assertIsNone(cache_module.find_site(f"nowhere{i}.example.com"))
+        # Until a site changes
+        models.Site.objects.create(name="Other site", description="", domain="Other.example.com")
+        self.assertEqual(cache_module.find_site("other.example.com").name, "Other site")
+
+
+class LogoVariantTests(GraphQLTestCase):
+    LOGO = """
+    { site { original: logo narrow: logo(width: 100) wide: logo(width: 1000) png: logo(width: 64, format: PNG) } }
+    """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def image(self, colour, size=(300, 150)):
+        out = io.BytesIO()
+        Image.new("RGB", size, colour).save(out, "PNG")
+        return ContentFile(out.getvalue(), name="logo.png")
+
+    def test_variants(self):
+        self.site.logo = self.image("red")
+        self.site.save()
+        variants = self.site.logo_variants
+        # The logo is narrower than the widest variant, so that is the logo's own width
+        self.assertEqual(sorted(variants["webp"], key=int), ["64", "128", "256", "300"])
+        self.assertEqual(set(variants["png"]), set(variants["webp"]))
+        for path in [*variants["webp"].values(), *variants["png"].values()]:
+            self.assertTrue(default_storage.exists(path))
+        with default_storage.open(variants["webp"]["128"]) as variant, Image.open(variant) as image:
+            self.assertEqual((image.format, image.size), ("WEBP", (128, 64)))
+
+        # Saving again keeps them, and a new logo replaces them
+        self.site.description = "Changed"
+        self.site.save()
+        self.assertEqual(self.site.logo_variants, variants)
+        self.site.logo = self.image("blue")
+        self.site.save()
+        self.assertNotEqual(self.site.logo_variants["webp"]["64"], variants["webp"]["64"])
+        self.site.logo = None
+        self.site.save()
+        self.assertEqual(self.site.logo_variants, {})
+
+    def test_logo_field(self):
+        self.site.logo = self.image("red")
+        self.site.save()
+        variants = self.site.logo_variants
+        logo = self.graphql(self.LOGO)["data"]["site"]
+        self.assertEqual(logo, {
+            "original": self.site.logo.name,
+            "narrow": default_storage.url(variants["webp"]["128"]),
+            "wide": default_storage.url(variants["webp"]["300"]),
+            "png": default_storage.url(variants["png"]["64"]),
+        })
+        response = self.client.get(logo["narrow"])
+        self.assertEqual((response.status_code, response["Content-Type"]), (200, "image/webp"))
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(self.client.get(logo["narrow"].replace(".webp", ".gif")).status_code, 404)
+
+
+class SiteAdminTests(GraphQLTestCase):
+
+    def test_site_filter_alone_is_unfiltered(self):
+        unfiltered = admin.EstimatedCountPaginator._unfiltered
+        token = models.current_site.set(self.site)
+        try:
+            bookings = models.Booking.objects.all()
+            self.assertIn("site_id", str(bookings.query))
+            self.assertTrue(unfiltered(bookings.order_by('-date')))
+            self.assertFalse(unfiltered(bookings.filter(court=self.court)))
+            self.assertFalse(unfiltered(bookings.filter(user__email__startswith="player")))
+        finally:
+            models.current_site.reset(token)
+        self.assertTrue(unfiltered(models.Booking.objects.all()))
+        self.assertFalse(unfiltered(models.Booking.objects.filter(date=date.today())))
+
+
+class BookingAdminTests(GraphQLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        admin_user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(admin_user)
+        self.other_user = User.objects.create(username="other", email="someone@example.com", last_name="Smith")
+        self.days = [date(2023, 12, 30), date(2024, 1, 2), date(2024, 3, 5)]
+        models.Booking.objects.bulk_create([
+            models.Booking(court=self.court, site=self.site, user=user, date=day, start_time=time(9), end_time=time(10))
+            for user, day in zip([self.user, self.other_user, self.user], self.days)
+        ])
+
+    def changelist(self, **params):
+        response = self.client.get("/admin/app/booking/", params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_changelist(self):
+        response = self.changelist()
+        self.assertEqual([b.date for b in response.context["cl"].result_list], self.days[::-1])
+        self.assertContains(response, "?date__year=2023")
+        self.assertContains(response, "?date__year=2024")
+
+    def test_date_hierarchy(self):
+        # Every month between the first and last booking, including those without any
+        response = self.changelist(date__year=2024)
+        for month in (1, 2, 3):
+            self.assertContains(response, f"?date__month={month}&amp;date__year=2024")
+        self.assertNotContains(response, "date__month=4")
+        response = self.changelist(date__year=2024, date__month=3, date__day=5)
+        self.assertEqual([b.date for b in response.context["cl"].result_list], [self.days[2]])
+        self.assertContains(response, "5 March")
+
+    def test_search_by_email_or_last_name(self):
+        for term in ("someone@", "smi", "SMITH"):
+            results = self.changelist(q=term).context["cl"].result_list
+            self.assertEqual([b.user for b in results], [self.other_user], term)
+        # Matches start at the beginning
+        self.assertEqual(list(self.changelist(q="mith").context["cl"].result_list), [])
+
+
+class SiteSubscriptionTests(GraphQLTestCase):
+
+    async def test_changes_are_for_the_websockets_site(self):
+        other = await models.Site.objects.acreate(name="Other site", description="", domain="other.example.com")
+        broker = InProcessBroker()
+        app = GraphQLWebSocketApp(schema)
+        day = date.today() + timedelta(days=1)
+        with mock.patch("app.pubsub._broker", broker):
+            # By Host, by the site header, and the first site for any other host
+            clients = {
+                other.id: WebSocketClient(app, headers={"Host": "other.example.com:443"}),
+                self.site.id: WebSocketClient(app, headers={"Host": "other.example.com", "X-Site": str(self.site.id)}),
+                None: WebSocketClient(app, headers={"Host": "unknown.example.com"}),
+            }
+            for client in clients.values():
+                self.assertEqual((await client.connect(self.connection_params))["type"], "connection_ack")
+                await client.send({"id": "1", "type": "subscribe", "payload": {"query": BOOKING_CHANGED}})
+            await self.wait_for(lambda: len(broker.subscribers) == len(clients))
+
+            broker.publish(BookingChange(BookingChange.DELETED, 1, self.site.id, self.court.id, day))
+            broker.publish(BookingChange(BookingChange.DELETED, 2, other.id, self.court.id, day))
+            for site_id, client in clients.items():
+                message = await client.receive()
+                self.assertEqual(message["payload"]["data"]["bookingChanged"]["bookingId"],
+                                 "2" if site_id == other.id else "1")
+                await client.disconnect()
+
+
+# Read replica =========================================================================================================
+
+class AuthenticationRoutingTests(TestCase):
+    databases = {DEFAULT_DB_ALIAS, database.REPLICA}
+
+    def test_tokens_are_read_from_default(self):
+        # The replica is a separate connection, which can't see the test's uncommitted rows
+        user = User.objects.create(username="player")
+        user.groups.add(Group.objects.create(name="captain"))
+        key = Token.objects.create(user=user).key
+        query = parse("{ site { name } }").definitions[0]
+        with CaptureQueriesContext(connections[database.REPLICA]) as replica_queries, \
+                database.route_operation(query):
+            self.assertEqual(middleware.authenticate_token(key), (user, ["captain"]))
+            self.assertEqual(middleware.get_group_names(SimpleNamespace(user=user)), ["captain"])
+        self.assertEqual(len(replica_queries), 0)
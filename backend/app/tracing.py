@@ -0,0 +1,186 @@
+import random
+import threading
+import time
+from contextvars import ContextVar
+from inspect import isawaitable
+
+from django.conf import settings
+from graphql import FieldNode
+
+
+# Request tracing for the GraphQL endpoint =============================================================================
+# Every request's wall time goes into a per-operation histogram (see graphql_timings in app/views.py). A sample of
+# requests (GRAPHQL_TRACING in config/settings.py) is also traced in detail: the time spent in each resolver, and the
+# number and time of SQL queries. Traces go out in the response's extensions, in the Apollo tracing format, and
+# as a Server-Timing header. Unsampled requests only pay for two perf_counter() calls and a dict update, plus a
+# getattr per resolved field and a ContextVar lookup per SQL query.
+
+# The trace for the current request, for the SQL wrapper. sync_to_async carries it over to the ORM's thread
+_current_trace = ContextVar("graphql_trace", default=None)
+
+# Histogram bucket upper bounds, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf"))
+
+# Operation names come from clients, so only this many are kept apart and the rest are counted as "other"
+MAX_OPERATIONS = 200
+
+
+def tracing_settings():
+    options = getattr(settings, "GRAPHQL_TRACING", {})
+    return {"sample_rate": options.get("SAMPLE_RATE", 0), "server_timing": options.get("SERVER_TIMING", True)}
+
+
+class Trace(object):
+    def __init__(self):
+        self.start_time = time.time()
+        self.start = time.perf_counter_ns()
+        self.duration = None
+        self.resolvers = []
+        self.sql_count = 0
+        self.sql_duration = 0
+
+    def record_resolver(self, info, start, end):
+        self.resolvers.append({
+            "path": info.path.as_list(),
+            "parentType": info.parent_type.name,
+            "fieldName": info.field_name,
+            "returnType": str(info.return_type),
+            "startOffset": start - self.start,
+            "duration": end - start,
+        })
+
+    def as_extensions(self):
+        return {
+            "tracing": {
+                "version": 1,
+                "startTime": _iso(self.start_time),
+                "endTime": _iso(self.start_time + self.duration / 1e9),
+                "duration": self.duration,
+                "execution": {"resolvers": self.resolvers},
+            },
+            "sql": {"queries": self.sql_count, "duration": self.sql_duration},
+        }
+
+    def server_timing(self):
+        return "graphql;dur={:.1f}, sql;dur={:.1f};desc=\"queries: {}\"".format(
+            self.duration / 1e6, self.sql_duration / 1e6, self.sql_count)
+
+
+def _iso(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + ".{:03d}Z".format(int(timestamp % 1 * 1000))
+
+
+def operation_label(operation_ast):
+    # The operation's name, or its type and root fields for anonymous operations (most of frontend/src/queries.ts)
+    if operation_ast is None:
+        return "unknown"
+    if operation_ast.name is not None:
+        return operation_ast.name.value
+    fields = [s.name.value for s in operation_ast.selection_set.selections if isinstance(s, FieldNode)]
+    return "{} {}".format(operation_ast.operation.value, ",".join(fields))
+
+
+# Resolver timing ======================================================================================================
+
+class TracingMiddleware(object):
+    def resolve(self, next, root, info, **args):
+        trace = getattr(info.context, "trace", None)
+        if trace is None:
+            return next(root, info, **args)
+        start = time.perf_counter_ns()
+        result = next(root, info, **args)
+        if isawaitable(result):
+            return self.resolve_async(trace, start, result, info)
+        trace.record_resolver(info, start, time.perf_counter_ns())
+        return result
+
+    @staticmethod
+    async def resolve_async(trace, start, result, info):
+        try:
+            return await result
+        finally:
+            trace.record_resolver(info, start, time.perf_counter_ns())
+
+
+# SQL timing, installed on every database connection by app/signals.py ================================================
+
+def record_sql(execute, sql, params, many, context):
+    trace = _current_trace.get()
+    if trace is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter_ns()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        trace.sql_count += 1
+        trace.sql_duration += time.perf_counter_ns() - start
+
+
+# Per-request bookkeeping, called by the GraphQL views =================================================================
+
+class RequestTimer(object):
+    def __init__(self, request, operation_ast):
+        self.request = request
+        self.label = operation_label(operation_ast)
+        self.start = time.perf_counter()
+        self.trace = None
+        if random.random() < tracing_settings()["sample_rate"]:
+            self.trace = request.trace = Trace()
+            self.token = _current_trace.set(self.trace)
+
+    def finish(self, result):
+        histogram.record(self.label, (time.perf_counter() - self.start) * 1000)
+        if self.trace is None:
+            return result
+        _current_trace.reset(self.token)
+        self.trace.duration = time.perf_counter_ns() - self.trace.start
+        if result is not None:
+            result.extensions = {**(result.extensions or {}), **self.trace.as_extensions()}
+        return result
+
+
+def add_server_timing(request, response):
+    trace = getattr(request, "trace", None)
+    if trace is not None and trace.duration is not None and tracing_settings()["server_timing"]:
+        response["Server-Timing"] = trace.server_timing()
+    return response
+
+
+class Histogram(object):
+    def __init__(self):
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def record(self, label, duration_ms):
+        bucket = next(i for i, bound in enumerate(BUCKETS_MS) if duration_ms <= bound)
+        with self.lock:
+            if label not in self.operations and len(self.operations) >= MAX_OPERATIONS:
+                label = "other"
+            entry = self.operations.get(label)
+            if entry is None:
+                entry = self.operations[label] = {"count": 0, "total_ms": 0.0, "buckets": [0] * len(BUCKETS_MS)}
+            entry["count"] += 1
+            entry["total_ms"] += duration_ms
+            entry["buckets"][bucket] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                label: {
+                    "count": entry["count"],
+                    "mean_ms": round(entry["total_ms"] / entry["count"], 2),
+                    "buckets": {
+                        ("le_" + str(bound)) if bound != float("inf") else "le_inf": count
+                        for bound, count in zip(BUCKETS_MS, entry["buckets"])
+                    },
+                }
+                for label, entry in self.operations.items()
+            }
+
+    def reset(self):
+        with self.lock:
+            self.operations.clear()
+
+
+# Process-wide, like the other caches. Each worker process has its own
+histogram = Histogram()
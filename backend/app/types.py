@@ -1,11 +1,37 @@
+from datetime import time
+
 from graphene_django import DjangoObjectType
+from graphene.types.generic import GenericScalar
 import graphene
-from app import models
+from django.core.files.storage import default_storage
+from app import images, models
+from app.loaders import get_loaders
+
+
+class ImageFormat(graphene.Enum):
+    WEBP = images.WEBP
+    PNG = images.PNG
 
 
 class SiteType(DjangoObjectType):
     class Meta:
         model = models.Site
+        exclude = ('logo_variants',)
+
+    logo = graphene.String(
+        width=graphene.Int(description="Display width in device pixels, for a resized copy of the logo"),
+        format=ImageFormat(default_value=images.WEBP),
+        description="Path of the original logo, or with a width, URL of the smallest resized copy at least that wide",
+    )
+
+    def resolve_logo(self, info, width=None, format=images.WEBP):
+        if not self.logo:
+            return None
+        if width is None:
+            return self.logo.name
+        # Arguments arrive as members of the Python enum behind ImageFormat
+        variant = images.pick(self.logo_variants, width, getattr(format, "value", format))
+        return default_storage.url(variant) if variant is not None else self.logo.url
 
 
 class UserType(DjangoObjectType):
@@ -23,8 +49,168 @@ class BookingType(DjangoObjectType):
     class Meta:
         model = models.Booking
 
+    # Relations already fetched by select_related are reused, otherwise the courts/users are loaded in one batch
+    def resolve_court(self, info):
+        loader = get_loaders(info).court
+        if models.Booking.court.is_cached(self):
+            return loader.prime(self.court)
+        return loader.load(self.court_id)
+
+    def resolve_user(self, info):
+        loader = get_loaders(info).user
+        if models.Booking.user.is_cached(self):
+            return loader.prime(self.user)
+        return loader.load(self.user_id)
+
+
+class BookingConnection(graphene.relay.Connection):
+    class Meta:
+        node = BookingType
+
+
+class BookingArchiveType(DjangoObjectType):
+    class Meta:
+        model = models.BookingArchive
+
+    def resolve_court(self, info):
+        loader = get_loaders(info).court
+        if models.BookingArchive.court.is_cached(self):
+            return loader.prime(self.court)
+        return loader.load(self.court_id)
+
+    def resolve_user(self, info):
+        loader = get_loaders(info).user
+        if models.BookingArchive.user.is_cached(self):
+            return loader.prime(self.user)
+        return loader.load(self.user_id)
+
+
+class BookingArchiveConnection(graphene.relay.Connection):
+    class Meta:
+        node = BookingArchiveType
+
+
+class BookingPreferenceType(graphene.ObjectType):
+    court_id = graphene.ID()
+    start_time = graphene.Time()
+    end_time = graphene.Time()
+
+
+class BookingRequestType(DjangoObjectType):
+    class Meta:
+        model = models.BookingRequest
+        fields = ("id", "court", "date", "start_time", "end_time", "description", "status", "reason", "booking",
+                  "created_at", "decided_at")
+
+    preferences = graphene.List(BookingPreferenceType)
+
+    def resolve_court(self, info):
+        loader = get_loaders(info).court
+        if models.BookingRequest.court.is_cached(self):
+            return loader.prime(self.court)
+        return loader.load(self.court_id)
+
+    def resolve_preferences(self, info):
+        return [
+            BookingPreferenceType(
+                court_id=court_id, start_time=time.fromisoformat(start_time), end_time=time.fromisoformat(end_time))
+            for court_id, start_time, end_time in self.preferences
+        ]
+
+
+class BookingConflictType(graphene.ObjectType):
+    court_id = graphene.ID()
+    date = graphene.Date()
+    start_time = graphene.Time()
+    end_time = graphene.Time()
+    reason = graphene.String()
+
+
+class BookingChangeType(graphene.ObjectType):
+    action = graphene.String(description="CREATED or DELETED")
+    booking_id = graphene.ID()
+    court_id = graphene.ID()
+    date = graphene.Date()
+    booking = graphene.Field(BookingType, description="The new booking, null when deleted")
+
 
 class SessionInfoType(graphene.ObjectType):
     is_authenticated = graphene.Boolean()
     user = graphene.Field(UserType)
     groups = graphene.List(graphene.String)
+    calendar_token = graphene.String(
+        description="Token for the user's calendar feed, /calendar/user/<calendarToken>.ics")
+
+
+class AvailabilityType(graphene.ObjectType):
+    court_id = graphene.ID()
+    date = graphene.Date()
+    opening_time = graphene.Time()
+    slot_minutes = graphene.Int()
+    booked = graphene.String(
+        description="One character per slot from the opening time, '1' where the slot is at least partly booked")
+
+
+class SlotType(graphene.ObjectType):
+    court_id = graphene.ID()
+    court = graphene.Field(CourtType)
+    date = graphene.Date()
+    start_time = graphene.Time()
+    end_time = graphene.Time()
+    free_minutes = graphene.Int(description="Length of the free interval the slot starts")
+
+
+class SlotOrder(graphene.Enum):
+    EARLIEST = "EARLIEST"
+    BEST_FIT = "BEST_FIT"
+
+    @property
+    def description(self):
+        if self == SlotOrder.BEST_FIT:
+            return "Slots in the smallest free intervals first, so long free stretches aren't split up"
+        return "Earliest slots first"
+
+
+class UsageGranularity(graphene.Enum):
+    HOUR = "HOUR"
+    DAY = "DAY"
+    WEEK = "WEEK"
+    MONTH = "MONTH"
+
+    @property
+    def description(self):
+        if self == UsageGranularity.HOUR:
+            return "Per hour of the day, over the whole window"
+        return "Per calendar " + self.name.lower() + " (weeks start on Monday)"
+
+
+class CourtUsageType(graphene.ObjectType):
+    court_id = graphene.ID()
+    court = graphene.Field(CourtType)
+    period = graphene.Date(description="First day of the day, week or month, null for HOUR")
+    hour = graphene.Int(description="Hour of the day for HOUR, otherwise null")
+    booked_minutes = graphene.Int()
+    open_minutes = graphene.Int(description="Minutes the court was open in the period, within the window")
+    utilisation = graphene.Float(description="bookedMinutes / openMinutes")
+    bookings = graphene.Int(description="Bookings starting in the period")
+
+
+class BookerType(graphene.ObjectType):
+    user_id = graphene.ID()
+    user = graphene.Field(UserType)
+    booked_minutes = graphene.Int()
+    bookings = graphene.Int()
+
+    def resolve_user(self, info):
+        return get_loaders(info).user.load(self.user_id)
+
+
+# See app/calendar_grid.py for the layout. The tables are JSON scalars, so graphql-core passes them through as they
+# are rather than completing every number in them
+class CalendarType(graphene.ObjectType):
+    from_date = graphene.Date(name="from")
+    to_date = graphene.Date(name="to")
+    courts = GenericScalar(description="[[id, name], ...], indexed by courtIdx")
+    users = GenericScalar(description="[[id, firstName, lastName, email], ...], indexed by userIdx")
+    days = GenericScalar(description="{date: [[courtIdx, startMinute, endMinute, userIdx, bookingId], ...]}")
+    descriptions = GenericScalar(description="{bookingId: description}, for bookings that have one")
@@ -1,6 +1,30 @@
+import math
+from datetime import date
+from inspect import isawaitable
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, JsonResponse
 from django.shortcuts import render, redirect
+from django.views.decorators.http import require_safe
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, set_response_etag
+from graphene_django.constants import MUTATION_ERRORS_FLAG
+from graphene_django.settings import graphene_settings
+from graphene_django.utils.utils import set_rollback
+from graphene_django.views import GraphQLView, HttpError
+from graphql import ExecutionResult, GraphQLError, OperationType, execute, get_operation_ast
 from rest_framework.decorators import api_view
 from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import PermissionDenied, ValidationError
+
+from app import cache, database, export, ical, images
+from app.documents import DocumentStore, document_store_settings, get_persisted_query_hash
+from app.limits import client_key, get_bucket, request_cost
+from app.middleware import authenticate_request, get_group_names
+from app.tracing import RequestTimer, add_server_timing, histogram
 
 # Create your views here.
 
@@ -10,4 +34,284 @@ def user_token(request):
         token, e = Token.objects.get_or_create(user=request.user)
         return redirect('https://km814.user.srcf.net/?token='+token.key)
     else:
-        return redirect('https://km814.user.srcf.net/?error=true')
\ No newline at end of file
+        return redirect('https://km814.user.srcf.net/?error=true')
+
+
+# Bookings as CSV or NDJSON for committee reports, streamed (see app/export.py). Takes the token or session login
+# of a captain, admin or staff member, and optional from, to (YYYY-MM-DD), court (ID), group (name) and archived
+# (true to include archived bookings) parameters
+@api_view(http_method_names=['get'])
+def export_bookings(request, export_format):
+    user = request.user
+    if not user.is_authenticated:
+        raise PermissionDenied("Log in to export bookings")
+    if not user.is_staff and not {"captain", "admin"} & {g.lower() for g in get_group_names(request)}:
+        raise PermissionDenied("Only captains and admins can export bookings")
+    try:
+        from_date = date.fromisoformat(request.GET['from']) if request.GET.get('from') else None
+        to_date = date.fromisoformat(request.GET['to']) if request.GET.get('to') else None
+        court_id = int(request.GET['court']) if request.GET.get('court') else None
+        return export.export_response(export_format, from_date, to_date, court_id, request.GET.get('group') or None,
+                                      include_archived=request.GET.get('archived') == 'true')
+    except ValueError as e:
+        raise ValidationError(str(e))
+
+
+# iCalendar feeds of a user's bookings (the token is sessionInfo.calendarToken) and of a court's, for calendar apps to
+# subscribe to. Unchanged feeds get a 304 without any database work, see app/ical.py
+@require_safe
+def user_calendar(request, token):
+    user_id = ical.user_id_from_token(token)
+    if user_id is None:
+        raise Http404("Unknown calendar")
+    return ical.feed_response(request, ical.USER, user_id, "Court bookings", lambda: ical.user_events(user_id),
+                              public=False)
+
+
+@require_safe
+def court_calendar(request, court_id):
+    court = next((court for court in cache.get_courts() if court.id == court_id), None)
+    if court is None:
+        raise Http404("Invalid Court ID")
+    return ical.feed_response(request, ical.COURT, court.id, court.name, lambda: ical.court_events(court),
+                              public=True)
+
+
+# Resized Site logos (see app/images.py). Their names change with their content, so browsers keep them for a year
+# without revalidating
+@require_safe
+def logo_variant(request, name):
+    image_format = name.rsplit(".", 1)[-1]
+    path = f"{images.VARIANT_DIR}/{name}"
+    if image_format not in images.CONTENT_TYPES or "/" in name or not default_storage.exists(path):
+        raise Http404("Unknown image")
+    with default_storage.open(path) as image:
+        response = HttpResponse(image.read(), content_type=images.CONTENT_TYPES[image_format])
+    patch_cache_control(response, public=True, max_age=images.MAX_AGE, immutable=True)
+    return response
+
+
+# Per-operation response time histograms for this process, see app/tracing.py
+@staff_member_required
+def graphql_timings(request):
+    if request.method == 'POST':
+        histogram.reset()
+    return JsonResponse(histogram.snapshot())
+
+
+class CachingGraphQLView(GraphQLView):
+    document_store = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # One store per process, shared by every request (as_view() builds a new view instance per request)
+        if CachingGraphQLView.document_store is None:
+            CachingGraphQLView.document_store = DocumentStore(self.schema, **document_store_settings())
+
+    # Query responses to GET requests get an ETag from their body, so a browser re-running an unchanged query (e.g.
+    # SITE_INFO, ALL_COURTS on every visit) gets an empty 304 instead of the whole payload. They depend on the
+    # Authorization header (sessionInfo) and the site, so they are private to the browser and must be revalidated each
+    # time
+    def dispatch(self, request, *args, **kwargs):
+        authenticate_request(request)
+        response = self.revalidate(request, super().dispatch(request, *args, **kwargs))
+        return add_server_timing(request, response)
+
+    def revalidate(self, request, response):
+        if request.method != 'GET' or response.status_code != 200 or \
+                not response.get('Content-Type', '').startswith('application/json'):
+            return response
+        set_response_etag(response)
+        patch_cache_control(response, private=True, no_cache=True)
+        # The site can come from a header as well as the host (see app/sites.py)
+        patch_vary_headers(response, ['Authorization', settings.SITE_HEADER])
+        return get_conditional_response(request, etag=response['ETag'], response=response)
+
+    # Same as GraphQLView.execute_graphql_request, except that the document comes from the document store, so
+    # repeat queries (and persisted query hashes) skip parsing and validation and go straight to execution
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        sha256 = get_persisted_query_hash(request, data)
+        if not query and not sha256:
+            return super().execute_graphql_request(request, data, query, variables, operation_name, show_graphiql)
+
+        document, operation_ast, errors = self.get_document(
+            request, query, sha256, variables, operation_name, show_graphiql)
+        if document is None:
+            return ExecutionResult(errors=errors) if errors else None
+        return self.execute_document(request, document, operation_ast, variables, operation_name)
+
+    def execute_document(self, request, document, operation_ast, variables, operation_name):
+        # Runs a document from get_document, which has already taken its cost from the client's bucket
+        timer = RequestTimer(request, operation_ast)
+        try:
+            options = self.get_execution_options(request, variables, operation_name)
+            if self.is_atomic_mutation(operation_ast):
+                with transaction.atomic():
+                    result = self.execute_sync(document, options)
+                    if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+                        transaction.set_rollback(True)
+            else:
+                with database.route_operation(operation_ast):
+                    result = self.execute_sync(document, options)
+        except Exception as e:
+            result = ExecutionResult(errors=[e])
+        return timer.finish(result)
+
+    # Same as GraphQLView.get_response, except that the result's extensions (see app/tracing.py) are included
+    def get_response(self, request, data, show_graphiql=False):
+        query, variables, operation_name, id = self.get_graphql_params(request, data)
+
+        execution_result = self.execute_graphql_request(request, data, query, variables, operation_name, show_graphiql)
+
+        if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+            set_rollback()
+
+        if not execution_result:
+            return None, 200
+        if execution_result.errors:
+            set_rollback()
+
+        response, status_code = self.format_execution_result(execution_result)
+        if self.batch:
+            response["id"] = id
+            response["status"] = status_code
+        return self.json_encode(request, response, pretty=show_graphiql), status_code
+
+    def format_execution_result(self, execution_result):
+        # Returns the response body as a dict, and the status code
+        response = {}
+        if execution_result.errors:
+            response["errors"] = [self.format_error(e) for e in execution_result.errors]
+        if execution_result.errors and any(not getattr(e, "path", None) for e in execution_result.errors):
+            status_code = 400
+        else:
+            response["data"] = execution_result.data
+            status_code = 200
+        if execution_result.extensions:
+            response["extensions"] = execution_result.extensions
+        return response, status_code
+
+    def get_document(self, request, query, sha256, variables, operation_name, show_graphiql=False):
+        # Returns (document, operation_ast, errors), with no document if the request shouldn't be executed
+        document, costs, errors = self.document_store.get(query, sha256)
+        if errors:
+            return None, None, errors
+
+        operation_ast = get_operation_ast(document, operation_name)
+        if request.method.lower() == "get" and operation_ast and operation_ast.operation != OperationType.QUERY:
+            if show_graphiql:
+                return None, None, []
+            raise HttpError(HttpResponseNotAllowed(
+                ["POST"], "Can only perform a {} operation from a POST request.".format(operation_ast.operation.value)
+            ))
+
+        # Every request costs at least 1, so cheap queries can't be sent in an unlimited flood either
+        cost = 1
+        if operation_ast is not None:
+            try:
+                cost = max(request_cost(self.schema.graphql_schema, document, operation_ast, costs, variables), 1)
+            except GraphQLError as e:
+                return None, None, [e]
+        retry_after = get_bucket().consume(client_key(request), cost)
+        if retry_after:
+            response = HttpResponse("Too many requests, please slow down", status=429)
+            response["Retry-After"] = str(math.ceil(retry_after))
+            raise HttpError(response)
+        return document, operation_ast, []
+
+    def get_execution_options(self, request, variables, operation_name):
+        options = {
+            "root_value": self.get_root_value(request),
+            "variable_values": variables,
+            "operation_name": operation_name,
+            "context_value": self.get_context(request),
+            "middleware": self.get_middleware(request),
+        }
+        if self.execution_context_class:
+            options["execution_context_class"] = self.execution_context_class
+        return options
+
+    @staticmethod
+    def is_atomic_mutation(operation_ast):
+        return (
+            operation_ast
+            and operation_ast.operation == OperationType.MUTATION
+            and (
+                graphene_settings.ATOMIC_MUTATIONS is True
+                or connection.settings_dict.get("ATOMIC_MUTATIONS", False) is True
+            )
+        )
+
+    def execute_sync(self, document, options):
+        # The resolvers are coroutines (see app/queries.py), so the rest of the request runs on an event loop. Their
+        # ORM calls are sent back to this thread by sync_to_async, so they still share its connection and transaction
+        result = execute(self.schema.graphql_schema, document, **options)
+        if isawaitable(result):
+            result = async_to_sync(_await)(result)
+        return result
+
+
+async def _await(awaitable):
+    return await awaitable
+
+
+class AsyncGraphQLView(CachingGraphQLView):
+    """
+    CachingGraphQLView for ASGI servers (see GRAPHQL_ASYNC in config/settings.py). Queries run on the event loop, so a
+    slow one waits on the database without holding a worker thread, and sibling fields resolve concurrently.
+    GraphiQL and batched requests are rare enough to just go through the sync view in a thread.
+    """
+    view_is_async = True
+
+    async def dispatch(self, request, *args, **kwargs):
+        # The session user is loaded lazily, which can't happen on the event loop
+        await sync_to_async(authenticate_request)(request)
+        try:
+            if request.method.lower() not in ("get", "post"):
+                raise HttpError(HttpResponseNotAllowed(
+                    ["GET", "POST"], "GraphQL only supports GET and POST requests."))
+
+            data = self.parse_body(request)
+            if self.batch or (self.graphiql and self.can_display_graphiql(request, data)):
+                return await sync_to_async(super().dispatch)(request, *args, **kwargs)
+
+            query, variables, operation_name, id = self.get_graphql_params(request, data)
+            execution_result = await self.execute_graphql_request_async(request, data, query, variables, operation_name)
+
+            result, status_code = self.format_execution_result(execution_result)
+            response = HttpResponse(
+                status=status_code, content=self.json_encode(request, result), content_type="application/json")
+
+        except HttpError as e:
+            response = e.response
+            response["Content-Type"] = "application/json"
+            response.content = self.json_encode(request, {"errors": [self.format_error(e)]})
+            return response
+
+        return add_server_timing(request, self.revalidate(request, response))
+
+    async def execute_graphql_request_async(self, request, data, query, variables, operation_name):
+        sha256 = get_persisted_query_hash(request, data)
+        if not query and not sha256:
+            # Raises the "Must provide query string" error
+            return super().execute_graphql_request(request, data, query, variables, operation_name)
+
+        document, operation_ast, errors = self.get_document(request, query, sha256, variables, operation_name)
+        if document is None:
+            return ExecutionResult(errors=errors)
+
+        # A transaction can't stay open across awaits, so ATOMIC_MUTATIONS are run by the sync view in a thread
+        if self.is_atomic_mutation(operation_ast):
+            return await sync_to_async(self.execute_document)(
+                request, document, operation_ast, variables, operation_name)
+
+        timer = RequestTimer(request, operation_ast)
+        try:
+            with database.route_operation(operation_ast):
+                result = execute(self.schema.graphql_schema, document,
+                                 **self.get_execution_options(request, variables, operation_name))
+                if isawaitable(result):
+                    result = await result
+        except Exception as e:
+            result = ExecutionResult(errors=[e])
+        return timer.finish(result)
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import math
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from graphql import ExecutionResult, GraphQLError, get_operation_ast, subscribe
+from rest_framework.authtoken.models import Token
+
+from app import models, sites
+from app.documents import DocumentStore, document_store_settings
+from app.limits import get_bucket, request_cost, user_key
+from app.middleware import authenticate_token
+
+
+class GraphQLWebSocketApp(object):
+    """
+    ASGI app serving GraphQL subscriptions over WebSockets, speaking the graphql-transport-ws protocol used by the
+    graphql-ws client (and Apollo's GraphQLWsLink). Queries and mutations still go over HTTP to the GraphQL view.
+
+    Clients authenticate in their connection_init payload (graphql-ws's connectionParams) with the same auth token
+    as over HTTP, as {"authorization": "Token <key>"}. Connections without a valid one are closed. Each connection is
+    for one site, picked from its handshake's headers as SiteMiddleware does for a request.
+
+    https://github.com/enisdenjo/graphql-ws/blob/master/PROTOCOL.md
+    """
+    subprotocol = "graphql-transport-ws"
+    # Operations one connection may have running at once. Each holds a task and a broker subscription, so this bounds
+    # what a single client can make the process keep
+    max_operations = 100
+
+    def __init__(self, schema):
+        self.schema = schema
+        # Subscriptions are held to the same cost and depth limits as queries
+        self.document_store = DocumentStore(schema, **document_store_settings())
+
+    async def __call__(self, scope, receive, send):
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        if self.subprotocol not in scope.get("subprotocols", []):
+            await send({"type": "websocket.close", "code": 4406})
+            return
+        site = await sync_to_async(sites.resolve_scope)(scope)
+        await send({"type": "websocket.accept", "subprotocol": self.subprotocol})
+
+        operations = {}
+        acknowledged = False
+        user = groups = None
+
+        async def reply(payload):
+            await send({"type": "websocket.send", "text": json.dumps(payload)})
+
+        async def close(code, reason):
+            await send({"type": "websocket.close", "code": code, "reason": reason})
+
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                try:
+                    data = json.loads(message.get("text") or message.get("bytes") or "")
+                    kind = data["type"]
+                except (ValueError, KeyError, TypeError):
+                    return await close(4400, "Invalid message")
+
+                if kind == "connection_init":
+                    if acknowledged:
+                        return await close(4429, "Too many initialisation requests")
+                    acknowledged = True
+                    try:
+                        user, groups = await sync_to_async(authenticate_token)(_token_key(data.get("payload")))
+                    except Token.DoesNotExist:
+                        return await close(4403, "Forbidden")
+                    await reply({"type": "connection_ack"})
+                elif kind == "ping":
+                    await reply({"type": "pong"})
+                elif kind == "pong":
+                    pass
+                elif kind == "subscribe":
+                    if not acknowledged:
+                        return await close(4401, "Unauthorized")
+                    if data.get("id") in operations:
+                        return await close(4409, f"Subscriber for {data.get('id')} already exists")
+                    if len(operations) >= self.max_operations:
+                        await reply({"type": "error", "id": data.get("id"), "payload": [
+                            {"message": f"Too many operations on this connection (max {self.max_operations})"}]})
+                        continue
+                    operations[data["id"]] = asyncio.ensure_future(self.run_operation(
+                        data["id"], data.get("payload") or {}, site, user, groups, reply, operations))
+                elif kind == "complete":
+                    task = operations.pop(data.get("id"), None)
+                    if task is not None:
+                        task.cancel()
+                else:
+                    return await close(4400, f"Unexpected message type {kind}")
+        finally:
+            for task in operations.values():
+                task.cancel()
+
+    async def run_operation(self, operation_id, payload, site, user, groups, reply, operations):
+        # Each operation is its own task, so this only scopes its own queries and events
+        site_token = models.current_site.set(site)
+        try:
+            document, costs, errors = self.document_store.get(payload.get("query") or "")
+            if not errors:
+                errors = self.charge(document, costs, payload, user)
+            if errors:
+                await reply({"type": "error", "id": operation_id, "payload": [e.formatted for e in errors]})
+                return
+            result = await subscribe(
+                self.schema.graphql_schema,
+                document,
+                variable_values=payload.get("variables"),
+                operation_name=payload.get("operationName"),
+                # Stands in for the request, with the connection's user (see DRFAuthorizationMiddleware) and somewhere
+                # for resolvers to keep their per-operation state (see app/loaders.py)
+                context_value=SimpleNamespace(site=site, user=user, user_groups=groups),
+            )
+            if isinstance(result, ExecutionResult):
+                errors = result.errors or [GraphQLError("Only subscriptions are supported over WebSockets")]
+                await reply({"type": "error", "id": operation_id, "payload": [e.formatted for e in errors]})
+                return
+            try:
+                async for item in result:
+                    await reply({"type": "next", "id": operation_id, "payload": item.formatted})
+            finally:
+                await result.aclose()
+            await reply({"type": "complete", "id": operation_id})
+        finally:
+            models.current_site.reset(site_token)
+            # A complete followed by a subscribe with the same ID can have replaced this task already
+            if operations.get(operation_id) is asyncio.current_task():
+                del operations[operation_id]
+
+
+    def charge(self, document, costs, payload, user):
+        # Takes a subscription's cost from its user's bucket, as the GraphQL view does for a query. Returns the errors
+        # to reply with instead of running it
+        operation = get_operation_ast(document, payload.get("operationName"))
+        cost = 1
+        if operation is not None:
+            try:
+                cost = max(request_cost(self.schema.graphql_schema, document, operation, costs,
+                                        payload.get("variables")), 1)
+            except GraphQLError as e:
+                return [e]
+        retry_after = get_bucket().consume(user_key(user), cost)
+        if retry_after:
+            return [GraphQLError("Too many requests, please slow down",
+                                 extensions={"retryAfter": math.ceil(retry_after)})]
+        return []
+
+
+def _token_key(payload):
+    # The key from a connection_init payload, or "" if there isn't one
+    authorization = payload.get("authorization") if isinstance(payload, dict) else None
+    if not isinstance(authorization, str) or not authorization.startswith("Token "):
+        return ""
+    return authorization[len("Token "):]
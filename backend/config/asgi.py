@@ -12,5 +12,19 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+os.environ.setdefault('GRAPHQL_ASYNC', 'true')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up, since the schema imports the models
+from app.schema import schema  # noqa: E402
+from app.websockets import GraphQLWebSocketApp  # noqa: E402
+
+graphql_websocket_application = GraphQLWebSocketApp(schema)
+
+
+async def application(scope, receive, send):
+    # WebSocket connections to /graphql carry GraphQL subscriptions, everything else is plain Django
+    if scope["type"] == "websocket" and scope["path"].rstrip("/") == "/graphql":
+        return await graphql_websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
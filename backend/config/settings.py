@@ -18,6 +18,8 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -30,7 +32,12 @@ SECRET_KEY = prod_config.DJANGO_SECRET
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
-ALLOWED_HOSTS = [prod_config.FRONTEND_URI, '127.0.0.1']
+# Host names of the Sites (their domain, see app/sites.py) besides FRONTEND_URI, comma-separated in the SITE_HOSTS
+# environment variable. A leading dot matches every subdomain, e.g. ".example.ac.uk". Requests for any other host are
+# refused, so a site is only picked by its host once it is listed here
+SITE_HOSTS = [host.strip() for host in os.environ.get('SITE_HOSTS', '').split(',') if host.strip()]
+
+ALLOWED_HOSTS = [prod_config.FRONTEND_URI, '127.0.0.1', *SITE_HOSTS]
 
 # Application definition
 
@@ -83,8 +90,12 @@ LOGOUT_REDIRECT_URL = prod_config.FRONTEND_URI
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Compresses responses (gzip, or brotli if installed), so it goes before anything reading the response body
+    'app.compression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    # Works out the request's site (from SITE_HEADER or the host), which scopes every query after it, see app/sites.py
+    'app.sites.SiteMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -115,13 +126,62 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# DATABASE_PATH moves the SQLite file. Connections are kept for DATABASE_CONN_MAX_AGE seconds between requests (and
+# checked before being reused), except under ASGI by default, where each request's sync code runs in a thread of its
+# own and a kept connection would only be left behind. GraphQL queries read through "replica", see app/database.py,
+# which is a query-only connection to the same file unless DATABASE_READ_REPLICA is false
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', BASE_DIR / 'db.sqlite3')
+DATABASE_CONN_MAX_AGE = int(os.environ.get(
+    'DATABASE_CONN_MAX_AGE', 0 if os.environ.get('GRAPHQL_ASYNC') == 'true' else 600))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': DATABASE_PATH,
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        # A file rather than SQLite's shared in-memory database, whose table locks fail at once instead of waiting
+        # out busy_timeout, so the threaded tests in app/tests.py lock the way the server does
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+    }
+}
+if os.environ.get('DATABASE_READ_REPLICA', 'true') == 'true':
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'TEST': {'MIRROR': 'default'},
     }
+DATABASE_ROUTERS = ['app.database.ReadReplicaRouter']
+
+# Applied to every new SQLite connection. WAL lets reads carry on during a write, and with it synchronous = NORMAL
+# only syncs at checkpoints, which can lose the last commits on power loss but never corrupts the database.
+# busy_timeout is in milliseconds, and a negative cache_size is in KiB (per connection)
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 20000,
+    "cache_size": -32000,
+    "temp_store": "memory",
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Per-process memory by default. Set CACHE_DIR to share one file-based cache between worker processes
+
+if os.environ.get('CACHE_DIR'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ['CACHE_DIR'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -167,9 +227,73 @@ MEDIA_URL = '/media/'
 
 GRAPHENE = {
     "SCHEMA": "app.schema.schema",
-    "MIDDLEWARE": ("app.middleware.DRFAuthorizationMiddleware",)
+    "MIDDLEWARE": ("app.tracing.TracingMiddleware", "app.middleware.DRFAuthorizationMiddleware")
+}
+
+# Fraction of GraphQL requests traced in detail (resolver times and SQL queries, returned in the response's
+# extensions and a Server-Timing header), see app/tracing.py. Every request is counted in the histograms at
+# /admin/graphql-timings either way
+GRAPHQL_TRACING = {
+    "SAMPLE_RATE": float(os.environ.get('GRAPHQL_TRACE_SAMPLE_RATE', 0)),
+    "SERVER_TIMING": True,
 }
 
+# Serve /graphql with AsyncGraphQLView (see app/views.py). config/asgi.py turns this on, so it is only used under an
+# ASGI server, while config/wsgi.py keeps the sync view
+GRAPHQL_ASYNC = os.environ.get('GRAPHQL_ASYNC') == 'true'
+
+# Parsed and validated GraphQL documents kept per process, see app/documents.py. Point ALLOWLIST at an Apollo
+# persisted query manifest (JSON) to reject every document not listed in it
+GRAPHQL_PERSISTED_QUERIES = {
+    "CACHE_SIZE": 100,
+    "ALLOWLIST": os.environ.get('GRAPHQL_QUERY_ALLOWLIST'),
+}
+
+# Static cost and depth limits for GraphQL documents, and the per-client token bucket each request's cost is taken
+# from (up to BURST at once, refilled at RATE a second), see app/limits.py
+GRAPHQL_QUERY_LIMITS = {
+    "MAX_DEPTH": 8,
+    "MAX_COST": 5000,
+    "DEFAULT_LIST_SIZE": 100,
+    "RATE": 2000,
+    "BURST": 20000,
+}
+
+# Header naming the site (its domain or ID) a request is for, instead of the Host, see app/sites.py
+SITE_HEADER = "X-Site"
+
+# Seconds a token's user and groups are cached in each process (0 disables the cache), see app/middleware.py
+AUTH_TOKEN_CACHE_TTL = 60
+
+# Delivers booking changes to GraphQL subscriptions (served by config/asgi.py), see app/pubsub.py. The in-process
+# broker only reaches subscribers connected to the same server process
+BOOKING_EVENT_BROKER = "app.pubsub.InProcessBroker"
+
+# The requestBooking queue, see app/admission.py. ORDER is ARRIVAL (first come, first served) or LOTTERY (requests
+# made within the same LOTTERY_WINDOW seconds are decided in a random order). ALLOCATOR "thread" decides requests in a
+# thread of the server process, which suits a single server process like the in-process event broker does. With
+# several, set it to "command" and run the allocate_bookings command alongside them instead
+BOOKING_QUEUE = {
+    "ALLOCATOR": "thread",
+    "ORDER": "ARRIVAL",
+    "LOTTERY_WINDOW": 10,
+    "BATCH_SIZE": 200,
+    "POLL_INTERVAL": 0.5,
+}
+
+# Bookings more than this many days old are moved to BookingArchive by the archive_bookings command, see app/archive.py
+BOOKING_ARCHIVE_DAYS = 365
+
+# Widths (in device pixels) the Site logo is resized to when it changes, and the WebP quality, see app/images.py
+SITE_LOGO_VARIANTS = {
+    "WIDTHS": [64, 128, 256, 512],
+    "WEBP_QUALITY": 85,
+}
+
+# Seconds the calendar feeds (/calendar/...ics) and their versions are cached, see app/ical.py. With the per-process
+# cache this is also how long a process can serve a feed another process has since changed
+CALENDAR_FEED_CACHE_TIMEOUT = 600
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.TokenAuthentication',
@@ -181,3 +305,4 @@ CORS_ORIGIN_ALLOW_ALL = False
 CORS_ORIGIN_WHITELIST = ("http://localhost:5173", prod_config.FRONTEND_URI)
 SOCIAL_AUTH_ALLOWED_REDIRECT_HOSTS = ["http://localhost:5173", prod_config.FRONTEND_URI]
 CORS_ALLOW_CREDENTIALS = True
+CORS_ALLOW_HEADERS = (*default_headers, SITE_HEADER.lower())
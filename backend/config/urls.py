@@ -17,12 +17,19 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.views.decorators.csrf import csrf_exempt
-from graphene_django.views import GraphQLView
-from app import views
+from django.conf import settings
+from app import images, views
+
+GraphQLView = views.AsyncGraphQLView if settings.GRAPHQL_ASYNC else views.CachingGraphQLView
 
 urlpatterns = [
+    path('admin/graphql-timings', views.graphql_timings),
     path('admin/', admin.site.urls),
     path("graphql", csrf_exempt(GraphQLView.as_view(graphiql=True))),
+    path('export/bookings.<str:export_format>', views.export_bookings),
+    path('calendar/user/<str:token>.ics', views.user_calendar),
+    path('calendar/court/<int:court_id>.ics', views.court_calendar),
+    path(f'{settings.MEDIA_URL.lstrip("/")}{images.VARIANT_DIR}/<str:name>', views.logo_variant),
     path('login-complete/google-oauth2/', views.user_token),
     path('accounts/', include('social_django.urls', namespace='social')),
     path('accounts/', include('django.contrib.auth.urls')),
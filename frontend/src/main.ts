@@ -9,6 +9,7 @@ import {useTokenStore} from "@/stores/token";
 
 import {DefaultApolloClient} from "@vue/apollo-composable"
 import {ApolloClient, ApolloLink, concat, createHttpLink, InMemoryCache} from "@apollo/client/core"
+import {createPersistedQueryLink} from "@apollo/client/link/persisted-queries"
 
 import App from "./App.vue"
 import router from "./router"
@@ -16,9 +17,19 @@ import router from "./router"
 const URI = 'https://km814.user.srcf.net/graphql'
 
 const httpLink = createHttpLink({
-    uri: URI
+    uri: URI,
+    useGETForQueries: true // lets the browser revalidate unchanged query responses with the server's ETags (304s)
 })
 
+// Send a SHA-256 of each query instead of its text. The server replies PersistedQueryNotFound the first time it sees a
+// hash, and the link then retries once with the full query
+async function sha256(query: string): Promise<string> {
+    const digest = await crypto.subtle.digest("SHA-256", new TextEncoder().encode(query))
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, "0")).join("")
+}
+
+const persistedQueryLink = createPersistedQueryLink({sha256, useGETForHashedQueries: true})
+
 const app = createApp(App)
 app.use(createPinia())
 app.use(router)
@@ -38,7 +49,7 @@ const authMiddleware = new ApolloLink((operation, forward) => {
 })
 
 
-const apolloClient = new ApolloClient({link: concat(authMiddleware, httpLink), cache: cache})
+const apolloClient = new ApolloClient({link: concat(authMiddleware, persistedQueryLink.concat(httpLink)), cache: cache})
 
 app.provide(DefaultApolloClient, apolloClient)
 app.mount('#app')
\ No newline at end of file
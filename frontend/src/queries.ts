@@ -32,6 +32,28 @@ export const ALL_BOOKINGS = gql `
     }
 `
 
+export const BOOKINGS = gql`
+    query Bookings($courtId: ID, $from: Date!, $to: Date!) {
+        bookings(courtId: $courtId, from: $from, to: $to) {
+            id
+            court {
+                id
+                name
+            }
+            date
+            startTime
+            endTime
+            description
+            user {
+                id
+                firstName
+                lastName
+                email
+            }
+        }
+    }
+`
+
 export const ALL_COURTS = gql`
     query {
         allCourts {
@@ -76,6 +98,32 @@ export const BOOKINGS_BY_USER = gql`
     }
 `
 
+export const UPCOMING_BOOKINGS_BY_USER = gql`
+    query UpcomingBookingsByUser($userId: ID!, $from: Date!, $first: Int, $after: String) {
+        bookingsByUserConnection(userId: $userId, from: $from, first: $first, after: $after) {
+            edges {
+                node {
+                    id
+                    court {
+                        id
+                        name
+                    }
+                    date
+                    startTime
+                    endTime
+                    user {
+                        id
+                    }
+                }
+            }
+            pageInfo {
+                hasNextPage
+                endCursor
+            }
+        }
+    }
+`
+
 export const CREATE_BOOKING = gql`
     mutation  ($courtID: ID!, $date: Date!, $startTime: Time!, $endTime: Time!, $description: String!) {
         createBooking(courtId: $courtID, date: $date, startTime: $startTime, endTime: $endTime, description: $description) {